@@ -0,0 +1,571 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys
+import optparse
+import subprocess
+import threading
+import multiprocessing
+import distutils.spawn
+import random
+import math
+import array
+import wave
+import json
+import time
+import shutil
+import tempfile
+import errno
+import socket
+import logging
+import base64
+import mutagen, mutagen.flac, mutagen.oggvorbis, mutagen.mp4
+
+# Scripts under test, from the same directory as this one
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Version of the results document
+RESULTS_VERSION = 1
+
+# Default fraction by which a result may exceed its baseline
+DEFAULT_TOLERANCE = 0.10
+
+# Differences smaller than this many seconds are never regressions
+NOISE_FLOOR = 0.5
+
+# Seconds after which a run is killed and counted as a failure
+DEFAULT_TIMEOUT = 3600.0
+
+SAMPLE_RATE = 44100
+
+# Distinct one-second blocks of audio that generated files are built from
+BLOCK_COUNT = 8
+
+# Commands that encode 'in' (a WAV) to 'out', in order of preference
+FORMAT_ENCODERS = {
+    'wav': [],
+    'flac': [['flac', '-s', '-f', '-o', '{out}', '{in}']],
+    'ogg': [['oggenc', '-Q', '-o', '{out}', '{in}']],
+    'm4a': [['faac', '-w', '-o', '{out}', '{in}'],
+        ['ffmpeg', '-loglevel', 'error', '-y', '-i', '{in}', '-c:a', 'aac', \
+            '{out}']],
+    }
+
+
+class CorpusSpec(object):
+    """Parameters that (with the seed) fully determine a corpus"""
+
+    def __init__(self, seed=1, files=40, minDuration=30.0, \
+            maxDuration=240.0, formats=('wav', 'flac', 'ogg', 'm4a')):
+        self.seed = seed
+        self.files = files
+        self.minDuration = minDuration
+        self.maxDuration = maxDuration
+        self.formats = list(formats)
+
+    def toDict(self):
+        return {'seed': self.seed, 'files': self.files, \
+            'minDuration': self.minDuration, 'maxDuration': self.maxDuration, \
+            'formats': self.formats}
+
+
+class CorpusBuilder(object):
+    """Generates a reproducible tree of tagged audio files.
+
+    Files are laid out as 'Artist/Album/NN - Title.ext', with some
+    compilations a level deeper, and carry text tags and cover art.
+    """
+
+    SPEC_NAME = 'corpus.json'
+
+    def __init__(self, root, spec):
+        self.root = root
+        self.spec = spec
+        self.encoders = {}
+
+    def isCurrent(self):
+        try:
+            with open(os.path.join(self.root, CorpusBuilder.SPEC_NAME)) as fd:
+                return json.load(fd).get('spec') == self.spec.toDict()
+        except (IOError, ValueError):
+            return False
+
+    def findEncoder(self, fmt):
+        """Returns the command template encoding to 'fmt', or None"""
+        if fmt == 'wav':
+            return []
+        for args in FORMAT_ENCODERS.get(fmt, []):
+            if distutils.spawn.find_executable(args[0]) != None:
+                return args
+        return None
+
+    def build(self):
+        for fmt in self.spec.formats:
+            encoder = self.findEncoder(fmt)
+            if encoder == None:
+                raise ValueError("No encoder is installed for '%s'" % fmt)
+            self.encoders[fmt] = encoder
+
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+
+        rng = random.Random(self.spec.seed)
+        blocks = [self.buildBlock(rng) for i in range(BLOCK_COUNT)]
+        covers = {}
+        logging.info("Generating %d files beneath [%s]...", \
+            self.spec.files, self.root)
+        total = 0
+        workdir = tempfile.mkdtemp(prefix='bench-audio-')
+        try:
+            for i in range(self.spec.files):
+                (relpath, tags) = self.buildLayout(rng, i)
+                fmt = self.spec.formats[i % len(self.spec.formats)]
+                path = os.path.join(self.root, '%s.%s' % (relpath, fmt))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                duration = rng.uniform(self.spec.minDuration, \
+                    self.spec.maxDuration)
+                wavPath = os.path.join(workdir, 'input.wav')
+                self.writeWav(wavPath, rng, blocks, duration)
+                self.encode(fmt, wavPath, path)
+
+                album = tags['album']
+                if album not in covers:
+                    covers[album] = self.buildCover(rng)
+                self.tag(fmt, path, tags, covers[album])
+                total += os.path.getsize(path)
+                logging.debug("Generated [%s] (%.0fs)", path, duration)
+        finally:
+            shutil.rmtree(workdir, True)
+
+        with open(os.path.join(self.root, CorpusBuilder.SPEC_NAME), 'w') \
+                as fd:
+            json.dump({'spec': self.spec.toDict(), 'bytes': total}, fd)
+        logging.info("Generated %.1f MB of audio", total / 1e6)
+
+    def buildBlock(self, rng):
+        """One second of stereo 16-bit PCM: two tones and some noise"""
+        (f1, f2) = (rng.uniform(110, 880), rng.uniform(220, 1760))
+        samples = array.array('h')
+        for n in range(SAMPLE_RATE):
+            t = float(n) / SAMPLE_RATE
+            tone = 6000 * math.sin(2 * math.pi * f1 * t) + \
+                3000 * math.sin(2 * math.pi * f2 * t)
+            samples.append(int(tone + rng.gauss(0, 800)))
+            samples.append(int(tone * 0.8 + rng.gauss(0, 800)))
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        return samples.tostring()
+
+    def buildLayout(self, rng, i):
+        """Returns the path (without extension) and tags of file 'i'"""
+        track = i % 12 + 1
+        if rng.random() < 0.2:
+            artist = 'Various Artists'
+            album = 'Compilation %02d' % rng.randint(1, 3)
+            disc = 'Disc %d' % rng.randint(1, 2)
+            directory = os.path.join('Compilations', album, disc)
+        else:
+            artist = 'Artist %02d' % (i / 24 + 1)
+            album = 'Album %02d' % (i / 12 + 1)
+            directory = os.path.join(artist, album)
+        title = 'Track %03d' % (i + 1)
+        tags = {'artist': artist, 'album': album, 'title': title, \
+            'tracknumber': track}
+        return (os.path.join(directory, '%02d - %s' % (track, title)), tags)
+
+    def buildCover(self, rng):
+        # Only the JPEG markers are real; nothing here decodes the image
+        size = rng.randint(20, 200) * 1024
+        data = ''.join(chr(rng.getrandbits(8)) for i in range(size))
+        return '\xff\xd8\xff\xe0' + data + '\xff\xd9'
+
+    def writeWav(self, path, rng, blocks, duration):
+        out = wave.open(path, 'wb')
+        try:
+            out.setnchannels(2)
+            out.setsampwidth(2)
+            out.setframerate(SAMPLE_RATE)
+            seconds = int(duration)
+            for i in range(seconds):
+                out.writeframes(rng.choice(blocks))
+            fraction = int((duration - seconds) * SAMPLE_RATE) * 4
+            out.writeframes(rng.choice(blocks)[:fraction])
+        finally:
+            out.close()
+
+    def encode(self, fmt, wavPath, path):
+        if fmt == 'wav':
+            shutil.copyfile(wavPath, path)
+            return
+        args = [a.replace('{in}', wavPath).replace('{out}', path) \
+            for a in self.encoders[fmt]]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(args, stdout=devnull)
+
+    def tag(self, fmt, path, tags, cover):
+        if fmt == 'wav':
+            return
+
+        pic = mutagen.flac.Picture()
+        pic.type = 3
+        pic.mime = 'image/jpeg'
+        pic.desc = u''
+        pic.data = cover
+        if fmt == 'flac':
+            audio = mutagen.flac.FLAC(path)
+            audio.add_picture(pic)
+        elif fmt == 'ogg':
+            audio = mutagen.oggvorbis.OggVorbis(path)
+            audio['metadata_block_picture'] = [base64.b64encode(pic.write())]
+        else:
+            audio = mutagen.mp4.MP4(path)
+            audio['\xa9ART'] = [tags['artist']]
+            audio['\xa9alb'] = [tags['album']]
+            audio['\xa9nam'] = [tags['title']]
+            audio['trkn'] = [(tags['tracknumber'], 0)]
+            audio['covr'] = [mutagen.mp4.MP4Cover(cover, \
+                imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
+            audio.save()
+            return
+
+        for key in ('artist', 'album', 'title', 'tracknumber'):
+            audio[key] = [unicode(tags[key])]
+        audio.save()
+
+
+class Tool(object):
+    """A transcoding script under test"""
+
+    def __init__(self, name, script, threadArgs=None):
+        self.name = name
+        self.script = script
+        self.threadArgs = threadArgs
+
+    def getArgs(self, corpus, outdir, metricsPath, threads):
+        raise NotImplementedError
+
+    def getCwd(self, corpus):
+        return None
+
+    def supportsThreads(self):
+        return self.threadArgs != None
+
+
+class ValidatorTool(Tool):
+
+    def __init__(self):
+        super(ValidatorTool, self).__init__('validate', \
+            'validate-auto-audio.py', \
+            lambda n: ['-t', str(n), '--cpu-jobs', str(n)])
+
+    def getArgs(self, corpus, outdir, metricsPath, threads):
+        # Preserve the corpus; write the outputs elsewhere
+        args = ['-g', '-p', '-T', 'mp3:%s' % outdir, '--metrics', metricsPath]
+        if threads != None:
+            args += self.threadArgs(threads)
+        return args + [corpus]
+
+
+class ResamplerTool(Tool):
+
+    def __init__(self):
+        super(ResamplerTool, self).__init__('resample', 'resample-mp3.py', \
+            lambda n: ['-j', str(n)])
+
+    def getArgs(self, corpus, outdir, metricsPath, threads):
+        # Output paths are built from the (relative) input paths
+        args = ['-o', outdir, '--progress', 'none', '--metrics', metricsPath]
+        if threads != None:
+            args += self.threadArgs(threads)
+        return args + [os.path.basename(corpus)]
+
+    def getCwd(self, corpus):
+        return os.path.dirname(corpus)
+
+
+TOOLS = dict((t.name, t) for t in (ValidatorTool(), ResamplerTool()))
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) / 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def waitProcess(proc):
+    """Waits for 'proc'; returns its return code and its own resource
+    usage (including its descendants), or None if that is unavailable"""
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            return (proc.wait(), None)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return (proc.returncode, usage)
+
+
+def readStages(metricsPath):
+    """Totals the per-stage records a tool wrote to 'metricsPath'"""
+    stages = {}
+    if not os.path.exists(metricsPath):
+        return stages
+    with open(metricsPath) as fd:
+        for line in fd:
+            record = json.loads(line)
+            if record.get('stage') in (None, 'run'):
+                continue
+            totals = stages.setdefault(record['stage'], \
+                {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            totals['count'] += 1
+            totals['wall'] += record.get('wall') or 0.0
+            totals['cpu'] += record.get('cpu') or 0.0
+    return stages
+
+
+class Benchmark(object):
+    """Times each tool over the corpus at each thread count"""
+
+    def __init__(self, corpus, repeat=3, timeout=DEFAULT_TIMEOUT):
+        self.corpus = os.path.abspath(corpus)
+        self.repeat = repeat
+        self.timeout = timeout
+
+    def runTool(self, tool, threads):
+        walls = []
+        cpus = []
+        runs = []
+        failures = 0
+        for i in range(self.repeat):
+            workdir = tempfile.mkdtemp(prefix='bench-audio-')
+            try:
+                run = self.runOnce(tool, threads, workdir)
+            finally:
+                shutil.rmtree(workdir, True)
+            logging.info("%s (threads=%s) run %d: %.2fs wall, %.2fs CPU", \
+                tool.name, threads, i + 1, run['wall'], run['cpu'])
+            if run['returncode'] != 0:
+                failures += 1
+            runs.append(run)
+
+        # Report the stages of the median run
+        runs.sort(key=lambda r: r['wall'])
+        return {'tool': tool.name, 'threads': threads, \
+            'wall': [r['wall'] for r in runs], \
+            'cpu': [r['cpu'] for r in runs], \
+            'median': median([r['wall'] for r in runs]), \
+            'medianCpu': median([r['cpu'] for r in runs]), \
+            'maxRss': max(r['maxRss'] for r in runs), \
+            'failures': failures, \
+            'stages': runs[len(runs) / 2]['stages']}
+
+    def runOnce(self, tool, threads, workdir):
+        outdir = os.path.join(workdir, 'out')
+        metricsPath = os.path.join(workdir, 'metrics.jsonl')
+        args = [sys.executable, os.path.join(BIN_DIR, tool.script)] + \
+            tool.getArgs(self.corpus, outdir, metricsPath, threads)
+        logging.debug("Running: %s", ' '.join(args))
+
+        start = time.time()
+        with open(os.path.join(workdir, 'log'), 'w') as log:
+            proc = subprocess.Popen(args, cwd=tool.getCwd(self.corpus), \
+                stdout=log, stderr=subprocess.STDOUT)
+            timer = threading.Timer(self.timeout, proc.kill)
+            timer.start()
+            try:
+                (returncode, usage) = waitProcess(proc)
+            finally:
+                timer.cancel()
+        wall = time.time() - start
+        if returncode != 0:
+            with open(os.path.join(workdir, 'log')) as log:
+                logging.warning("%s exited with status %d:\n%s", tool.name, \
+                    returncode, log.read()[-2000:])
+        # Usage of this run alone, rather than of every child reaped so far
+        cpu = usage and (usage.ru_utime + usage.ru_stime) or 0.0
+        return {'wall': wall, 'cpu': cpu, \
+            'maxRss': usage and usage.ru_maxrss or 0, \
+            'returncode': returncode, 'stages': readStages(metricsPath)}
+
+
+def compareResults(baseline, results, tolerance):
+    """Logs each result against its baseline; returns the regressions"""
+    def key(r):
+        return (r['tool'], r['threads'])
+    base = dict((key(r), r) for r in baseline['results'])
+    if baseline.get('corpus', {}).get('spec') != \
+            results.get('corpus', {}).get('spec'):
+        logging.warning("The baseline was measured on a different corpus")
+
+    regressions = []
+    def check(name, old, new):
+        if old == None or new == None:
+            return
+        change = (old and (new - old) / old) or 0.0
+        flag = ''
+        if new - old > NOISE_FLOOR and change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        logging.info("%-40s %9.2f %9.2f %+7.1f%%%s", name, old, new, \
+            100 * change, flag)
+
+    logging.info("%-40s %9s %9s %8s", 'Measurement', 'Baseline', 'Current', \
+        'Change')
+    for r in results['results']:
+        old = base.get(key(r))
+        if old == None:
+            logging.info("%s (threads=%s) has no baseline", r['tool'], \
+                r['threads'])
+            continue
+        label = '%s/%s' % (r['tool'], r['threads'])
+        check('%s wall' % label, old['median'], r['median'])
+        check('%s cpu' % label, old.get('medianCpu'), r.get('medianCpu'))
+        for stage in sorted(r['stages']):
+            if stage in old['stages']:
+                check('%s %s cpu' % (label, stage), \
+                    old['stages'][stage]['cpu'], r['stages'][stage]['cpu'])
+    return regressions
+
+
+def parseList(value, convert=str):
+    return [convert(v) for v in value.split(',') if v]
+
+
+def main():
+    usage = '%prog: [options] corpus-dir'
+    parser = optparse.OptionParser(usage, description='Benchmarks the ' \
+        'transcoding scripts over a generated corpus, which is created in ' \
+        'corpus-dir (or regenerated if its parameters change).')
+
+    parser.add_option('-v', '--verbose', \
+            action='store_true', dest='verbose', default=False, \
+            help='Enables verbose debug output')
+    parser.add_option('--seed', metavar='SEED', \
+            action='store', type='int', dest='seed', default=1, \
+            help='Generates the corpus from SEED (default: %default)')
+    parser.add_option('-n', '--files', metavar='COUNT', \
+            action='store', type='int', dest='files', default=40, \
+            help='Generates COUNT files (default: %default)')
+    parser.add_option('--durations', metavar='MIN,MAX', \
+            action='store', dest='durations', default='30,240', \
+            help='Generates files between MIN and MAX seconds long ' \
+                 '(default: %default)')
+    parser.add_option('--formats', metavar='LIST', \
+            action='store', dest='formats', default='wav,flac,ogg,m4a', \
+            help='Generates files in each of LIST (default: %default)')
+    parser.add_option('-G', '--generate-only', \
+            action='store_true', dest='generateOnly', default=False, \
+            help='Generates the corpus without running any benchmarks')
+    parser.add_option('-T', '--tools', metavar='LIST', \
+            action='store', dest='tools', default=','.join(sorted(TOOLS)), \
+            help='Benchmarks each of LIST (default: %default)')
+    parser.add_option('-t', '--threads', metavar='LIST', \
+            action='store', dest='threads', \
+            default='1,%d' % multiprocessing.cpu_count(), \
+            help='Runs each tool that supports it with each thread count in ' \
+                 'LIST (default: %default)')
+    parser.add_option('-r', '--repeat', metavar='COUNT', \
+            action='store', type='int', dest='repeat', default=3, \
+            help='Runs each benchmark COUNT times, reporting the median ' \
+                 '(default: %default)')
+    parser.add_option('--timeout', metavar='SECONDS', \
+            action='store', type='float', dest='timeout', \
+            default=DEFAULT_TIMEOUT, \
+            help='Kills runs that take longer than SECONDS, counting them ' \
+                 'as failures (default: %default)')
+    parser.add_option('-o', '--output', metavar='PATH', \
+            action='store', dest='output', default=None, \
+            help='Writes the results to PATH as JSON (default: stdout)')
+    parser.add_option('-b', '--baseline', metavar='PATH', \
+            action='store', dest='baseline', default=None, \
+            help='Compares the results with those stored at PATH, exiting ' \
+                 'non-zero on a regression')
+    parser.add_option('--tolerance', metavar='FRACTION', \
+            action='store', type='float', dest='tolerance', \
+            default=DEFAULT_TOLERANCE, \
+            help='Flags results more than FRACTION slower than the ' \
+                 'baseline (default: %default)')
+
+    (opts, args) = parser.parse_args()
+    if opts.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if len(args) != 1:
+        logging.error("You must specify the corpus directory!")
+        parser.print_usage()
+        sys.exit(1)
+
+    try:
+        (minDuration, maxDuration) = parseList(opts.durations, float)
+        tools = [TOOLS[t] for t in parseList(opts.tools)]
+        threadCounts = parseList(opts.threads, int)
+    except (ValueError, KeyError), e:
+        logging.error("Invalid option value: %s", e)
+        parser.print_usage()
+        sys.exit(1)
+
+    spec = CorpusSpec(opts.seed, opts.files, minDuration, maxDuration, \
+        parseList(opts.formats))
+    builder = CorpusBuilder(os.path.abspath(args[0]), spec)
+    if builder.isCurrent():
+        logging.info("Using the existing corpus in [%s]", builder.root)
+    else:
+        try:
+            builder.build()
+        except (ValueError, EnvironmentError, \
+                subprocess.CalledProcessError), e:
+            logging.error("Unable to generate the corpus: %s", e)
+            sys.exit(1)
+    if opts.generateOnly:
+        return
+
+    with open(os.path.join(builder.root, CorpusBuilder.SPEC_NAME)) as fd:
+        corpus = json.load(fd)
+    results = {'version': RESULTS_VERSION, 'time': time.time(), \
+        'host': {'name': socket.gethostname(), \
+            'cpus': multiprocessing.cpu_count(), \
+            'python': sys.version.split()[0]}, \
+        'corpus': corpus, 'repeat': opts.repeat, 'results': []}
+
+    bench = Benchmark(builder.root, opts.repeat, opts.timeout)
+    for tool in tools:
+        if tool.supportsThreads():
+            counts = threadCounts
+        else:
+            counts = [None]
+        for threads in counts:
+            results['results'].append(bench.runTool(tool, threads))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            fd.write(text + '\n')
+    else:
+        print text
+
+    if opts.baseline:
+        with open(opts.baseline) as fd:
+            baseline = json.load(fd)
+        regressions = compareResults(baseline, results, opts.tolerance)
+        if regressions:
+            logging.error("%d measurement(s) regressed: %s", \
+                len(regressions), ', '.join(regressions))
+            sys.exit(1)
+        logging.info("No regressions against [%s]", opts.baseline)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -8,17 +8,77 @@ import subprocess
 import threading
 import types
 import tempfile
+import shutil
+import select
+import fcntl
+import distutils.spawn
+import hashlib
+import json
+import math
+import multiprocessing
+import Queue
+import traceback
+import time
+import wave
 
 import mutagen
 import mutagen.id3
 import mutagen.mp3
 import mutagen.easyid3
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Approximate average bitrate (kbps) of lame's default VBR setting; inputs
+# at or below the target are passed through rather than re-encoded
+DEFAULT_TARGET_BITRATE = 165
+
+# Seconds between progress reports: redraws of the status line on a
+# terminal, and JSON lines otherwise
+TTY_PROGRESS_INTERVAL = 0.5
+JSON_PROGRESS_INTERVAL = 10
+
+# Directory listings in flight at once; over NFS/SMB the walk is bound by
+# round trips rather than by this process
+DEFAULT_WALKERS = 8
+
+# Average bitrates (kbps) that lame documents for its VBR quality levels,
+# -V0 to -V9; used to estimate output sizes in budget mode
+VBR_BITRATES = [245, 225, 190, 175, 165, 130, 115, 100, 85, 65]
+
+# Allocation unit assumed for the device, which every file is rounded up
+# to, and room for the tags copied to each file
+CLUSTER_SIZE = 32 * 1024
+TAG_ALLOWANCE = 4 * 1024
+
+# Fraction of a capacity left free for errors in the estimates
+DEFAULT_CAPACITY_RESERVE = 0.02
+
+targetBitrate = DEFAULT_TARGET_BITRATE
+explicitBitrate = False
+
 class AudioFile(object):
+
+    # The lowest bitrate (kbps) expected of the format, from which an upper
+    # bound on the duration is worked out when it can't be read
+    MIN_KBPS = 64
+
     def __init__(self, path):
         self.path = path
+        self.decoder = None
+        self.passedThrough = False
+        self.duration = None
+        self.genre = None
+        # The lame VBR quality chosen in budget mode
+        self.quality = None
 
     def getLameStream(self):
+        """Returns a file object that 'lame' reads its input from"""
         raise NotImplementedError
 
     def getLameArgs(self):
@@ -32,75 +92,624 @@ class AudioFile(object):
     def getMutagenFile(self):
         return mutagen.File(self.path)
 
+    def getDuration(self):
+        """Returns the length of the audio in seconds (0 if unknown)"""
+        if self.duration == None:
+            try:
+                self.duration = float(self.getMutagenFile().info.length)
+            except Exception:
+                # Unreadable, or a format 'mutagen' doesn't know
+                self.duration = 0.0
+        return self.duration
+
+    def getMaxDuration(self):
+        """Returns the longest the audio could be, given its size"""
+        return os.path.getsize(self.path) * 8 / (self.MIN_KBPS * 1000.0)
+
+    def getGenre(self):
+        """Returns the first genre tagged, in lower case, or ''"""
+        if self.genre == None:
+            self.genre = ''
+            try:
+                genres = mutagen.File(self.path, easy=True).get('genre')
+                if genres:
+                    self.genre = genres[0].strip().lower()
+            except Exception:
+                pass
+        return self.genre
+
+    def getTargetBitrate(self):
+        if self.quality != None:
+            return VBR_BITRATES[self.quality]
+        return targetBitrate
+
+    def isPassThrough(self):
+        """True if the file is already small enough to use as it is"""
+        return False
+
+    def cleanup(self):
+        pass
+
 
 class CompatibleAudioFile(AudioFile):
     
-    def getLameInput(self):
-        fd = open(self.path, 'rb')
-        data = fd.read()
-        fd.close()
-        return data
+    def getLameStream(self):
+        # 'lame' reads the file itself
+        return open(self.path, 'rb')
+
+
+class WavAudioFile(CompatibleAudioFile):
+
+    # 16 bit mono at 22.05 kHz
+    MIN_KBPS = 352
+
+    def getDuration(self):
+        if self.duration != None:
+            # Including a failure to read it, which isn't retried
+            return self.duration
+        duration = super(WavAudioFile, self).getDuration()
+        if duration == 0.0:
+            # Older versions of 'mutagen' don't read WAV
+            try:
+                w = wave.open(self.path)
+                try:
+                    duration = float(w.getnframes()) / w.getframerate()
+                finally:
+                    w.close()
+            except (wave.Error, EOFError, IOError, ZeroDivisionError):
+                pass
+            self.duration = duration
+        return duration
 
 
 class Mp3AudioFile(CompatibleAudioFile):
+
+    def __init__(self, path):
+        super(Mp3AudioFile, self).__init__(path)
+        self.bitrate = None
     
     def getLameArgs(self):
         return ['--mp3input']
 
+    def getBitrate(self):
+        """Returns the bitrate mode and average bitrate (kbps), from the
+        Xing/VBRI header if there is one, or else the frame headers"""
+        if self.bitrate == None:
+            info = mutagen.mp3.MP3(self.path).info
+            mode = getattr(info, 'bitrate_mode', None)
+            if mode == None:
+                # Versions of 'mutagen' that don't report the mode
+                mode = 'unknown'
+            else:
+                mode = str(mode).split('.')[-1]
+            self.bitrate = (mode, info.bitrate / 1000)
+        return self.bitrate
+
+    def fitsBitrate(self, target):
+        """True if the file is already at or below 'target' kbps"""
+        (mode, bitrate) = self.getBitrate()
+        return bitrate > 0 and bitrate <= target
+
+    def isPassThrough(self):
+        target = self.getTargetBitrate()
+        try:
+            if not self.fitsBitrate(target):
+                return False
+        except Exception, inst:
+            print "Unable to read the bitrate of '%s': %s" % (self.path, inst)
+            return False
+        (mode, bitrate) = self.getBitrate()
+        print "Passing '%s' through (%s, %d kbps <= %d kbps)" % \
+            (os.path.basename(self.path), mode, bitrate, target)
+        return True
+
 
 class FlacAudioFile(AudioFile):
+
+    MIN_KBPS = 256
    
-    def getLameInput(self):
+    def getLameStream(self):
         print "Decoding FLAC '%s'..." % self.path
-        proc = subprocess.Popen( 
+        self.decoder = subprocess.Popen( 
             ['flac', '-s', '-c', '-d', self.path], 
             stdout=subprocess.PIPE )
+        return self.decoder.stdout
 
-        data = proc.stdout.read()
-        proc.wait()
-        del(proc)
-        return data
 	
 class M4aAudioFile(AudioFile):
 
-    def getLameInput(self):
-	print "Decoding M4A '%s'..." % self.path
-	
-	# Create a temporary file for 'mplayer' to use
-	tmp = tempfile.NamedTemporaryFile(suffix='.wav')
-	
-	proc = subprocess.Popen(
-	    ['mplayer', '-ao', 'pcm', self.path, 
-	     '-ao', 'pcm:file=%s' % tmp.name ] )
-	proc.wait()
-	del(proc)
-	
-	# Now, read the data from the temporary file
-	tmp.seek(0)
-	data = tmp.read()
-	tmp.close()
-	return data
+    def __init__(self, path):
+        super(M4aAudioFile, self).__init__(path)
+        self.scratch = None
+        self.lameArgs = []
+
+    def getLameStream(self):
+        print "Decoding M4A '%s'..." % self.path
+        if distutils.spawn.find_executable('faad') != None:
+            # 'faad' can write the decoded WAV to a pipe
+            self.decoder = subprocess.Popen(
+                ['faad', '-q', '-w', self.path],
+                stdout=subprocess.PIPE )
+            return self.decoder.stdout
+
+        # 'mplayer' only writes to files, so give it a FIFO; only if that
+        # isn't possible does the audio spill to the scratch directory
+        self.scratch = tempfile.mkdtemp(prefix='resample-', dir=scratchDir)
+        fifo = os.path.join(self.scratch, 'pcm')
+        try:
+            os.mkfifo(fifo)
+        except OSError, inst:
+            print "Unable to create a FIFO (%s); decoding to '%s'" % \
+                (inst, self.scratch)
+            return self.getSpilledStream()
+
+        info = self.getMutagenFile().info
+        self.lameArgs = ['-r', '-s', '%g' % (info.sample_rate / 1000.0),
+            '--bitwidth', '16', '--signed', '--little-endian']
+        if info.channels == 1:
+            self.lameArgs += ['-m', 'm']
+        self.decoder = subprocess.Popen(
+            ['mplayer', '-really-quiet', '-vo', 'null', '-vc', 'null',
+             '-af', 'format=s16le', '-ao', 'pcm:nowaveheader:file=%s' % fifo,
+             self.path] )
+        return openFifo(fifo, self.decoder)
+
+    def getSpilledStream(self):
+        wav = os.path.join(self.scratch, 'pcm.wav')
+        start = time.time()
+        proc = subprocess.Popen(
+            ['mplayer', '-ao', 'pcm', self.path, 
+             '-ao', 'pcm:file=%s' % wav ] )
+        usage = waitProcess(proc)
+        printUsage(self.path, 'mplayer', usage)
+        recordStage(self.path, 'spill', time.time() - start, usage, \
+            fileSize(self.path), fileSize(wav), proc.returncode)
+        return open(wav, 'rb')
+
+    def getLameArgs(self):
+        return self.lameArgs
+
+    def cleanup(self):
+        if self.scratch != None:
+            shutil.rmtree(self.scratch, True)
+            self.scratch = None
+
+
+def defaultScratchDir():
+    # Prefer a RAM-backed directory for anything spilled to disk
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+scratchDir = defaultScratchDir()
+
+def openFifo(path, writer):
+    """Opens the FIFO at 'path' for reading, without blocking forever if
+    'writer' exits before opening the other end"""
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        # Readable once there is data, or once the writer has come and gone
+        while not select.select([fd], [], [], 0.5)[0]:
+            if writer.poll() != None:
+                break
+        fcntl.fcntl(fd, fcntl.F_SETFL, \
+            fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    except:
+        os.close(fd)
+        raise
+    return os.fdopen(fd, 'rb')
+
+def waitProcess(proc):
+    """Waits for 'proc' and returns its resource usage"""
+    try:
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+    except OSError:
+        proc.wait()
+        return None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return usage
+
+def cpuTime(usage):
+    if usage == None:
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageLog(object):
+    """Appends a JSON line per stage of each file, in the format of
+    validate-auto-audio.py's '--metrics'"""
+
+    def __init__(self, path):
+        self.fd = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, path, stage, wall, usage=None, bytesIn=None, \
+            bytesOut=None, returncode=0):
+        with self.lock:
+            self.fd.write(json.dumps({'time': time.time(), 'path': path,
+                'stage': stage, 'wall': wall, 'cpu': cpuTime(usage),
+                'maxRss': usage and usage.ru_maxrss,
+                'bytesIn': bytesIn, 'bytesOut': bytesOut,
+                'returncode': returncode}) + '\n')
+            self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+stageLog = None
+
+def recordStage(path, stage, wall, usage=None, bytesIn=None, \
+        bytesOut=None, returncode=0):
+    if stageLog != None:
+        stageLog.record(path, stage, wall, usage, bytesIn, bytesOut, \
+            returncode)
+
+def fileSize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def printUsage(path, name, usage):
+    if usage != None:
+        # 'ru_maxrss' is in kilobytes
+        print "  %s for '%s': peak RSS %d KB, CPU %.1fs" % (name, \
+            os.path.basename(path), usage.ru_maxrss, \
+            usage.ru_utime + usage.ru_stime)
+
+
+def readFirstLine(path):
+    try:
+        fd = open(path)
+        try:
+            return fd.readline().strip()
+        finally:
+            fd.close()
+    except IOError:
+        return None
+
+def affinityCpus():
+    """Returns the number of CPUs this process may run on, or None"""
+    try:
+        fd = open('/proc/self/status')
+        try:
+            for line in fd:
+                if line.startswith('Cpus_allowed:'):
+                    mask = line.split(':', 1)[1].strip().replace(',', '')
+                    return bin(int(mask, 16)).count('1')
+        finally:
+            fd.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+def cgroupCpuQuota():
+    """Returns the CPU quota of this process's cgroup (in CPUs), or None"""
+    try:
+        fd = open('/proc/self/cgroup')
+        try:
+            groups = [line.strip().split(':', 2) for line in fd]
+        finally:
+            fd.close()
+    except IOError:
+        return None
+
+    for (hierarchy, controllers, path) in groups:
+        if hierarchy == '0' and controllers == '':
+            # cgroup v2: "<quota> <period>", or "max <period>"
+            dirs = ['/sys/fs/cgroup' + path, '/sys/fs/cgroup']
+            names = ['cpu.max']
+        elif 'cpu' in controllers.split(','):
+            # cgroup v1: the quota is -1 when there is none
+            dirs = ['/sys/fs/cgroup/cpu' + path, '/sys/fs/cgroup/cpu']
+            names = ['cpu.cfs_quota_us', 'cpu.cfs_period_us']
+        else:
+            continue
+
+        # Inside a container, the group is usually mounted as the root
+        for d in dirs:
+            values = [readFirstLine(os.path.join(d, n)) for n in names]
+            if None in values:
+                continue
+            values = ' '.join(values).split()
+            try:
+                quota = int(values[0])
+                period = int(values[1])
+            except (ValueError, IndexError):
+                # Includes "max"
+                return None
+            if quota <= 0 or period <= 0:
+                return None
+            return float(quota) / period
+    return None
+
+def usableCpus():
+    """Returns the number of CPUs this process can actually make use of,
+    honouring its affinity mask and any cgroup CPU quota"""
+    try:
+        count = multiprocessing.cpu_count()
+    except NotImplementedError:
+        count = 1
+    affinity = affinityCpus()
+    if affinity:
+        count = min(count, affinity)
+    quota = cgroupCpuQuota()
+    if quota:
+        count = min(count, int(math.ceil(quota)))
+    return max(count, 1)
+
+
+class Results(object):
+    """Outcomes and progress of the files processed, gathered from every
+    worker"""
+
+    def __init__(self, total=0):
+        self.lock = threading.Lock()
+        self.total = total
+        self.encoded = 0
+        self.passed = 0
+        self.failed = []
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.start = time.time()
+
+        # Audio seconds finished (encoded or failed, and passed through
+        # unchanged), and the durations read so far of all the files to
+        # process
+        self.seconds = 0.0
+        self.passedSeconds = 0.0
+        self.totalSeconds = 0.0
+        self.probed = 0
+
+        # Per worker: the file in hand, and the audio and wall seconds of
+        # the files it has finished
+        self.active = {}
+        self.workers = {}
+
+    def probe(self, handlers):
+        """Reads the duration of each file in the background, so that the
+        ETA can be weighted by audio rather than file count"""
+        def run():
+            for handler in handlers:
+                seconds = handler.getDuration()
+                with self.lock:
+                    self.totalSeconds += seconds
+                    self.probed += 1
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def begin(self, worker, handler):
+        with self.lock:
+            self.active[worker] = (handler, time.time())
+            self.workers.setdefault(worker, [0.0, 0.0])
+
+    def add(self, handler, resamplePath, ok, worker=None):
+        # Read before anything is counted, so a failure here leaves the
+        # totals as they were
+        seconds = handler.getDuration()
+        if ok:
+            sizes = (os.path.getsize(handler.path), \
+                os.path.getsize(resamplePath))
+        # A copy takes no encoding, so it is kept out of the speeds
+        passed = ok and handler.passedThrough
+        with self.lock:
+            if worker in self.active:
+                (active, started) = self.active.pop(worker)
+                if not passed:
+                    stats = self.workers[worker]
+                    stats[0] += seconds
+                    stats[1] += time.time() - started
+            if passed:
+                self.passedSeconds += seconds
+            else:
+                self.seconds += seconds
+
+            if not ok:
+                self.failed.append(handler.path)
+                return
+            if handler.passedThrough:
+                self.passed += 1
+            else:
+                self.encoded += 1
+            self.bytesIn += sizes[0]
+            self.bytesOut += sizes[1]
+
+    def fail(self, handler, worker=None):
+        """Counts a file as failed without reading anything about it"""
+        with self.lock:
+            self.active.pop(worker, None)
+            self.failed.append(handler.path)
+
+    def snapshot(self):
+        """Returns the progress so far as a dictionary"""
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.start
+            done = self.encoded + self.passed + len(self.failed)
+            state = {'files': done, 'total': self.total,
+                'encoded': self.encoded, 'passed': self.passed,
+                'failed': len(self.failed),
+                'bytesIn': self.bytesIn, 'bytesOut': self.bytesOut,
+                'seconds': round(self.seconds, 1),
+                'passedSeconds': round(self.passedSeconds, 1),
+                'elapsed': round(elapsed, 1),
+                'speed': None, 'eta': None, 'workers': {}}
+
+            for (worker, (audio, wall)) in self.workers.items():
+                # Count the file in hand, so a slow one shows up at once
+                if worker in self.active:
+                    wall += now - self.active[worker][1]
+                state['workers'][worker] = \
+                    round(audio / wall, 2) if wall > 0 else None
+
+            if self.seconds > 0 and elapsed > 0:
+                # Real-time factor of the pool as a whole
+                state['speed'] = round(self.seconds / elapsed, 2)
+                if self.probed > 0:
+                    # Scale up for the files not yet probed
+                    expected = self.totalSeconds * self.total / self.probed
+                    finished = self.seconds + self.passedSeconds
+                    remaining = max(expected - finished, 0.0)
+                    # Expect the same share of the rest to be copied as is
+                    remaining *= self.seconds / finished
+                    state['eta'] = round(remaining / state['speed'], 1)
+            return state
+
+    def report(self):
+        print "Resampled %i files and passed %i through: %d --> %d bytes" % \
+            (self.encoded, self.passed, self.bytesIn, self.bytesOut)
+        if self.failed:
+            print "Failed to resample %i files:" % len(self.failed)
+            for path in self.failed:
+                print "  %s" % path
+
+
+def formatDuration(seconds):
+    if seconds == None:
+        return '?'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+def formatBytes(count):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if count < 1024:
+            if unit == 'B':
+                return '%d B' % count
+            return '%.1f %s' % (count, unit)
+        count /= 1024.0
+    return '%.1f TB' % count
+
+
+class Progress(object):
+    """Reports the progress in 'results' from a thread of its own.
+
+    On a terminal this is a status line, kept beneath the rest of the
+    output by standing in for 'sys.stdout'. Otherwise a JSON line is
+    written every so often to a stream of its own (stderr, or a file),
+    so that it can be read apart from the log on stdout.
+    """
+
+    def __init__(self, results, stream, tty):
+        self.results = results
+        self.stream = stream
+        self.tty = tty
+        self.lock = threading.RLock()
+        self.done = threading.Event()
+        self.thread = None
+        self.status = False
+        if tty:
+            self.interval = TTY_PROGRESS_INTERVAL
+        else:
+            self.interval = JSON_PROGRESS_INTERVAL
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        with self.lock:
+            self.render()
+            if self.tty:
+                self.stream.write('\n')
+                self.status = False
+            self.stream.flush()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            with self.lock:
+                self.render()
+                self.stream.flush()
+
+    def render(self):
+        state = self.results.snapshot()
+        if not self.tty:
+            self.stream.write(json.dumps(state, sort_keys=True) + '\n')
+            return
+
+        speeds = [v for v in state['workers'].values() if v != None]
+        line = '%d/%d files, %s audio, %s -> %s' % (state['files'], \
+            state['total'], \
+            formatDuration(state['seconds'] + state['passedSeconds']), \
+            formatBytes(state['bytesIn']), formatBytes(state['bytesOut']))
+        if state['speed'] != None:
+            line += ', %.1fx real time' % state['speed']
+        if speeds:
+            line += ' (%.1fx-%.1fx per worker)' % (min(speeds), max(speeds))
+        if state['failed']:
+            line += ', %d failed' % state['failed']
+        line += ', ETA %s' % formatDuration(state['eta'])
+        self.stream.write('\r\x1b[K' + line)
+        self.status = True
+
+    def write(self, data):
+        # Output from the workers goes above the status line
+        with self.lock:
+            if self.status:
+                self.stream.write('\r\x1b[K')
+                self.status = False
+            self.stream.write(data)
+            if self.tty and data.endswith('\n'):
+                self.render()
+
+    def flush(self):
+        self.stream.flush()
 
 
 class TranscoderThread(threading.Thread):
-    def __init__(self, sem, text, handler, basedir):
+    """Worker that processes handlers from 'queue' until it gets None"""
+
+    def __init__(self, queue, results, basedir, mirror=None):
         threading.Thread.__init__(self)
-        self.sem = sem
-        self.text = text
-        self.handler = handler
+        self.queue = queue
+        self.results = results
         self.basedir = basedir
+        self.mirror = mirror
 
     def run(self):
-        print "Processing '%s' (%s)" % (self.handler.path, self.text)
-        process(self.handler, self.basedir)
-        sem.release()
+        while True:
+            job = self.queue.get()
+            if job == None:
+                break
+            (text, handler) = job
+            print "Processing '%s' (%s)" % (handler.path, text)
+            self.results.begin(self.getName(), handler)
+            ok = False
+            try:
+                ok = process(handler, self.basedir)
+                if ok and self.mirror != None:
+                    self.mirror.record(handler)
+            except Exception:
+                # Keep the worker alive for the rest of the queue
+                print "ERROR: Unable to process '%s'" % handler.path
+                # Through 'sys.stdout', which may be the progress display
+                traceback.print_exc(file=sys.stdout)
+                ok = False
+            try:
+                self.results.add(handler, \
+                    getResamplePath(handler, self.basedir), ok, \
+                    self.getName())
+            except Exception:
+                # A dead worker would leave the queue full and main()
+                # blocked putting the next file
+                print "ERROR: Unable to record the result of '%s'" % \
+                    handler.path
+                traceback.print_exc(file=sys.stdout)
+                self.results.fail(handler, self.getName())
 
     def __str__(self):
-        return "Transcoder(%s)" % self.text
+        return "Transcoder(%s)" % self.getName()
 
 
 RESAMPLE_EXTENSIONS = {
-    'wav': CompatibleAudioFile,
+    'wav': WavAudioFile,
     'mp3': Mp3AudioFile, 
     'flac': FlacAudioFile,
     'm4a': M4aAudioFile,
@@ -116,19 +725,363 @@ def getHandler(path):
         return RESAMPLE_EXTENSIONS[ext](path)
     return None
 
-def parseFile(path):
+def getResamplePath(handler, basedir):
+    # Sources given as absolute paths are still mirrored beneath 'basedir'
+    (drive, sourceDir) = os.path.splitdrive(os.path.dirname(handler.path))
+    return os.path.join(basedir, sourceDir.lstrip(os.sep),
+        handler.getLameFilename())
+
+def fingerprint(path, blockSize=1<<16):
+    """Cheap content fingerprint: the size and the first and last blocks"""
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    h.update(str(size))
+    fd = open(path, 'rb')
+    try:
+        h.update(fd.read(blockSize))
+        if size > blockSize:
+            fd.seek(max(blockSize, size - blockSize))
+            h.update(fd.read(blockSize))
+    finally:
+        fd.close()
+    return h.hexdigest()
+
+
+class Mirror(object):
+    """Record of the source behind each file in an output tree.
+
+    A sync encodes only the sources that are new, or whose size, time and
+    fingerprint no longer match those recorded for their target, and then
+    removes the targets it recorded whose source has gone. Only sources
+    beneath the roots of the sync are considered, so syncing part of a
+    library leaves the rest of the mirror alone.
+    """
+
+    STATE_NAME = '.resample-mirror.json'
+    SAVE_INTERVAL = 20
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.path = os.path.join(basedir, Mirror.STATE_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.unsaved = 0
+        if os.path.exists(self.path):
+            fd = open(self.path)
+            try:
+                self.entries = json.load(fd)
+            finally:
+                fd.close()
+
+    def getKey(self, handler):
+        return os.path.relpath(getResamplePath(handler, self.basedir),
+            self.basedir)
+
+    def isCurrent(self, handler):
+        key = self.getKey(handler)
+        entry = self.entries.get(key)
+        if entry == None or \
+                not os.path.exists(os.path.join(self.basedir, key)):
+            return False
+
+        st = os.stat(handler.path)
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return True
+        if entry['fingerprint'] == fingerprint(handler.path):
+            # Touched, but not changed
+            entry['size'] = st.st_size
+            entry['mtime'] = st.st_mtime
+            self.unsaved += 1
+            return True
+        return False
+
+    def select(self, handlers):
+        """Returns the handlers whose targets need (re-)encoding"""
+        return [h for h in handlers if not self.isCurrent(h)]
+
+    def record(self, handler):
+        st = os.stat(handler.path)
+        with self.lock:
+            self.entries[self.getKey(handler)] = {
+                'source': os.path.abspath(handler.path),
+                'size': st.st_size, 'mtime': st.st_mtime,
+                'fingerprint': fingerprint(handler.path) }
+            self.unsaved += 1
+            if self.unsaved >= Mirror.SAVE_INTERVAL:
+                self.save()
+
+    def isGone(self, entry, roots):
+        """True if the entry's source, beneath one of 'roots', is gone"""
+        source = entry.get('source')
+        if source == None or os.path.exists(source):
+            return False
+        for root in roots:
+            if source == root:
+                # A file given by name
+                return os.path.isdir(os.path.dirname(root))
+            if source.startswith(os.path.join(root, '')):
+                # An unmounted or unreadable root isn't a deleted library
+                return os.path.isdir(root)
+        return False
+
+    def prune(self, roots):
+        """Removes recorded targets whose source beneath 'roots' has gone"""
+        roots = [os.path.abspath(r) for r in roots]
+        removed = 0
+        with self.lock:
+            for key in sorted(self.entries):
+                if not self.isGone(self.entries[key], roots):
+                    continue
+                target = os.path.join(self.basedir, key)
+                if os.path.exists(target):
+                    print "Removing '%s'; its source has gone" % key
+                    os.remove(target)
+                    removed += 1
+
+                    # Tidy up directories left empty
+                    d = os.path.dirname(target)
+                    while d != self.basedir and not os.listdir(d):
+                        os.rmdir(d)
+                        d = os.path.dirname(d)
+                del self.entries[key]
+                self.unsaved += 1
+        return removed
+
+    def save(self):
+        # Write atomically; called with the lock held
+        if self.unsaved == 0:
+            return
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        tmp = self.path + '.tmp'
+        fd = open(tmp, 'w')
+        try:
+            json.dump(self.entries, fd)
+        finally:
+            fd.close()
+        os.rename(tmp, self.path)
+        self.unsaved = 0
+
+def parseSize(text):
+    """Parses a size in bytes, with an optional K, M, G or T suffix (powers
+    of 1024); returns None if it isn't one"""
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    scale = 1
+    if text and text[-1] in 'KMGT':
+        scale = 1024 ** ('KMGT'.index(text[-1]) + 1)
+        text = text[:-1]
+    try:
+        size = int(float(text) * scale)
+    except ValueError:
+        return None
+    if size <= 0:
+        return None
+    return size
+
+
+class Budget(object):
+    """Picks the highest lame VBR quality whose output fits a capacity.
+
+    Each file's output is estimated from its duration and the average
+    bitrate of the candidate quality level, so no trial encodes are needed.
+    Genres may be given an offset, so that e.g. speech is encoded a number
+    of levels below the music around it.
+    """
+
+    def __init__(self, capacity, reserve=DEFAULT_CAPACITY_RESERVE):
+        self.capacity = capacity
+        self.usable = int(capacity * (1.0 - reserve))
+        self.offsets = {}
+        # Paths already warned of as having no known duration
+        self.unknown = set()
+
+    def setGenreOffset(self, genre, offset):
+        self.offsets[genre.strip().lower()] = offset
+
+    def getQuality(self, handler, level):
+        if self.offsets:
+            level += self.offsets.get(handler.getGenre(), 0)
+        return min(max(level, 0), len(VBR_BITRATES) - 1)
+
+    def estimate(self, handler, quality):
+        """Returns the estimated size on the device of 'handler' encoded at
+        'quality'"""
+        kbps = VBR_BITRATES[quality]
+        size = None
+        if isinstance(handler, Mp3AudioFile):
+            try:
+                if handler.fitsBitrate(kbps):
+                    # Passed through as it is
+                    size = os.path.getsize(handler.path)
+            except Exception:
+                pass
+        if size == None:
+            duration = handler.getDuration()
+            if duration <= 0.0:
+                # Assume the worst rather than count it as tags alone
+                duration = handler.getMaxDuration()
+                if handler.path not in self.unknown:
+                    self.unknown.add(handler.path)
+                    print "WARNING: Unable to read the duration of '%s'; " \
+                        "assuming up to %s from its size" % \
+                        (handler.path, formatDuration(duration))
+            size = int(duration * kbps * 1000 / 8) + TAG_ALLOWANCE
+        return roundToCluster(size)
+
+    def fit(self, handlers, fixed=0):
+        """Assigns each handler the quality of the highest level that fits
+        alongside 'fixed' bytes already on the device, returning the level
+        and the estimated total, or None and the smallest total"""
+        for level in range(len(VBR_BITRATES)):
+            total = fixed
+            for h in handlers:
+                total += self.estimate(h, self.getQuality(h, level))
+            if total <= self.usable:
+                for h in handlers:
+                    h.quality = self.getQuality(h, level)
+                return (level, total)
+        return (None, total)
+
+def roundToCluster(size):
+    return (size + CLUSTER_SIZE - 1) / CLUSTER_SIZE * CLUSTER_SIZE
+
+def parseFile(path, visited=None):
+    """Serial walk beneath 'path', with a stat per entry"""
     result = []
+    if visited == None:
+        visited = set()
     
     if os.path.isdir(path):
+        if not isFirstVisit(path, visited):
+            return result
         for name in os.listdir(path):
-            result += parseFile(os.path.join(path,name))
+            result += parseFile(os.path.join(path,name), visited)
     else:
         handler = getHandler(path)
         if handler != None:
             result.append(handler)
     
     return result
-    
+
+def getDirectoryKey(path):
+    """Returns what identifies the directory at 'path' whatever the route"""
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+def isFirstVisit(path, visited, key=None):
+    """Records the directory at 'path' in 'visited', returning False if it
+    was already there (a symbolic link loop, or another route to it).
+    'key' is that of 'getDirectoryKey', where it has been read already."""
+    if key == None:
+        key = getDirectoryKey(path)
+    if key in visited:
+        print "Skipping '%s'; already listed by another path" % path
+        return False
+    visited.add(key)
+    return True
+
+def listDirectory(path):
+    """Returns the files and the subdirectories in 'path'.
+
+    Where 'scandir' is available the directory entry types are used, so
+    only symbolic links need a stat. Like 'os.path.isdir', symbolic links
+    to directories are followed.
+    """
+    files = []
+    subdirs = []
+    if scandir == None:
+        for name in os.listdir(path):
+            p = os.path.join(path, name)
+            if os.path.isdir(p):
+                subdirs.append(p)
+            else:
+                files.append(p)
+    else:
+        for entry in scandir(path):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    return (files, subdirs)
+
+
+class DirectoryWalker(object):
+    """Walks directory trees with several listings in flight at once.
+
+    Listing threads only talk to the filesystem; the generator returned by
+    'walk' owns the bookkeeping, queueing each subdirectory as its parent's
+    listing comes back and yielding handlers as they are found.
+    """
+
+    def __init__(self, threads=DEFAULT_WALKERS):
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.visited = set()
+
+    def walk(self, paths):
+        requests = Queue.Queue()
+        listings = Queue.Queue()
+        listers = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self.lister, \
+                args=(requests, listings))
+            t.daemon = True
+            t.start()
+            listers.append(t)
+
+        try:
+            pending = 0
+            for path in paths:
+                if os.path.isdir(path):
+                    requests.put(path)
+                    pending += 1
+                else:
+                    handler = getHandler(path)
+                    if handler != None:
+                        yield handler
+
+            while pending > 0:
+                (files, subdirs) = listings.get()
+                pending -= 1
+                for d in subdirs:
+                    requests.put(d)
+                    pending += 1
+                for f in files:
+                    handler = getHandler(f)
+                    if handler != None:
+                        yield handler
+        finally:
+            # Listings still in flight are discarded
+            for t in listers:
+                requests.put(None)
+            for t in listers:
+                t.join()
+
+    def lister(self, requests, listings):
+        while True:
+            path = requests.get()
+            if path == None:
+                break
+            listing = ([], [])
+            try:
+                # Only the check against 'visited' needs the lock; the
+                # stat may block on a slow filesystem
+                key = getDirectoryKey(path)
+                with self.lock:
+                    first = isFirstVisit(path, self.visited, key)
+                if first:
+                    listing = listDirectory(path)
+            except Exception, inst:
+                # 'walk' waits for a listing of every directory it queued
+                print "ERROR: Unable to list '%s': %s" % (path, inst)
+            listings.put(listing)
+
+    def getDirectoryCount(self):
+        with self.lock:
+            return len(self.visited)
+
 def copyTags(sourceHandler, destPath):
     source = sourceHandler.getMutagenFile()
     dest = mutagen.mp3.MP3(destPath)
@@ -167,73 +1120,320 @@ def copyTags(sourceHandler, destPath):
     del(source)
     del(dest)
     
+def passThrough(handler, resamplePath):
+    """Links (or, across filesystems, copies) the source, tags and all"""
+    removePartial(resamplePath)
+    try:
+        os.link(handler.path, resamplePath)
+    except OSError:
+        shutil.copy2(handler.path, resamplePath)
+    return True
+
+def removePartial(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def getPartialPath(resamplePath):
+    """Where 'lame' writes, so that an earlier output (perhaps a hard link
+    to the source itself) is only replaced once the encode is complete"""
+    return resamplePath + '.part'
+
 def process(handler, basedir):
     filename = os.path.basename(handler.path)
     print "Processing '%s'..." % filename
-    resampleDir = os.path.join(basedir,os.path.dirname(handler.path))
-    resamplePath = os.path.join(resampleDir, handler.getLameFilename())
+    resamplePath = getResamplePath(handler, basedir)
+    resampleDir = os.path.dirname(resamplePath)
     
     try:
         os.makedirs(resampleDir)
     except os.error:
         pass
+
+    # Don't spend a decode, an encode and a generation on no saving
+    start = time.time()
+    if handler.isPassThrough():
+        handler.passedThrough = True
+        passThrough(handler, resamplePath)
+        recordStage(handler.path, 'passthrough', time.time() - start, \
+            bytesIn=fileSize(handler.path), bytesOut=fileSize(resamplePath))
+        return True
     
-    # Get the lame stream from the handler
-    lameData = handler.getLameInput()
-    if lameData == None:
-        print "ERROR: LAME input data is empty for '%s'!" % filename
-        return
-
-    lameArgs = [ 'lame', '-S', '-v' ]
-    args = handler.getLameArgs()
-    if args != None:
-        lameArgs += args
-    lameArgs += ['-', resamplePath]
-
-    lameProc = subprocess.Popen(
-        lameArgs, 
-        stdin=subprocess.PIPE )
-
-    try:
-        lameProc.stdin.write(lameData)
-        lameProc.stdin.close()
-        lameProc.wait()
-    except IOError, inst:
-        print "IOError while processing '%s': %s'" % (filename, inst)
-        return
-
-    copyTags(handler, resamplePath)
+    # Connect the decoder (or input file) straight to 'lame', so that no
+    # audio passes through this process
+    partialPath = getPartialPath(resamplePath)
+    removePartial(partialPath)
+    try:
+        stream = handler.getLameStream()
+        try:
+            lameArgs = [ 'lame', '-S' ]
+            if handler.quality != None:
+                lameArgs += [ '-V', str(handler.quality) ]
+            elif explicitBitrate:
+                lameArgs += [ '--abr', str(targetBitrate) ]
+            else:
+                lameArgs += [ '-v' ]
+            args = handler.getLameArgs()
+            if args != None:
+                lameArgs += args
+            lameArgs += ['-', partialPath]
+
+            lameProc = subprocess.Popen(
+                lameArgs, 
+                stdin=stream )
+        finally:
+            stream.close()
+    except (IOError, OSError), inst:
+        print "ERROR: Unable to start encoding '%s': %s" % (filename, inst)
+        if handler.decoder != None:
+            handler.decoder.kill()
+            waitProcess(handler.decoder)
+        handler.cleanup()
+        return False
+
+    lameUsage = waitProcess(lameProc)
+    decoderUsage = None
+    if handler.decoder != None:
+        decoderUsage = waitProcess(handler.decoder)
+    handler.cleanup()
+
+    # Decoder and encoder run side by side, so share the wall time
+    wall = time.time() - start
+    ext = os.path.splitext(handler.path)[1][1:].lower()
+    printUsage(handler.path, 'lame', lameUsage)
+    recordStage(handler.path, 'encode:mp3', wall, lameUsage, \
+        fileSize(handler.path), fileSize(partialPath), lameProc.returncode)
+    if handler.decoder != None:
+        printUsage(handler.path, 'decoder', decoderUsage)
+        recordStage(handler.path, 'decode:%s' % ext, wall, decoderUsage, \
+            fileSize(handler.path), None, handler.decoder.returncode)
+        if handler.decoder.returncode != 0:
+            print "ERROR: Decoder returned %d for '%s'" % \
+                (handler.decoder.returncode, filename)
+            removePartial(partialPath)
+            return False
+    if lameProc.returncode != 0:
+        print "ERROR: lame returned %d for '%s'" % \
+            (lameProc.returncode, filename)
+        removePartial(partialPath)
+        return False
+
+    start = time.time()
+    try:
+        copyTags(handler, partialPath)
+    except Exception:
+        removePartial(partialPath)
+        raise
+    recordStage(handler.path, 'tags', time.time() - start, \
+        bytesOut=fileSize(partialPath))
+
+    # Replaces the entry, never writing through it to a linked source
+    os.rename(partialPath, resamplePath)
     
     print "Resampled '%s': %d --> %d" % \
         (filename, os.path.getsize(handler.path), 
          os.path.getsize(resamplePath))
+    return True
     
 if __name__ == '__main__':
     try:
-        opts, args = getopt.getopt( sys.argv[1:], "o:", ["output="] )
+        opts, args = getopt.getopt( sys.argv[1:], "o:s:mb:j:w:c:g:",
+            ["output=", "scratch=", "mirror", "bitrate=", "jobs=",
+             "walkers=", "scan-only", "progress=", "capacity=", "genre=",
+             "metrics=", "progress-file="] )
     except getopt.GetoptError, inst:
         print str(inst)
         sys.exit(1)
 
     output = "./Resample"
+    mirror = None
+    jobs = None
+    walkers = DEFAULT_WALKERS
+    scanOnly = False
+    progressMode = 'auto'
+    progressPath = None
+    budget = None
+    genreOffsets = []
     for o, a in opts:
         if o in ( '-o', '--output' ):
             output = a
+        elif o in ( '-s', '--scratch' ):
+            scratchDir = a
+        elif o in ( '-b', '--bitrate' ):
+            # Encode to an average bitrate, passing through MP3s under it
+            try:
+                targetBitrate = int(a)
+            except ValueError:
+                print "Invalid bitrate '%s'" % a
+                sys.exit(1)
+            explicitBitrate = True
+        elif o in ( '-j', '--jobs' ):
+            try:
+                jobs = int(a)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print "Invalid number of jobs '%s'" % a
+                sys.exit(1)
+        elif o in ( '-w', '--walkers' ):
+            # 0 walks serially, one stat per entry
+            try:
+                walkers = int(a)
+            except ValueError:
+                walkers = -1
+            if walkers < 0:
+                print "Invalid number of walkers '%s'" % a
+                sys.exit(1)
+        elif o == '--scan-only':
+            # Just time the walk
+            scanOnly = True
+        elif o == '--progress':
+            # 'tty' for a status line, 'json' for JSON lines, or 'none'
+            if a not in ( 'auto', 'tty', 'json', 'none' ):
+                print "Invalid progress mode '%s'" % a
+                sys.exit(1)
+            progressMode = a
+        elif o == '--progress-file':
+            # Where JSON progress lines go, rather than stderr
+            progressPath = a
+        elif o in ( '-c', '--capacity' ):
+            # Choose the quality that fills, but doesn't overflow, a device
+            capacity = parseSize(a)
+            if capacity == None:
+                print "Invalid capacity '%s'" % a
+                sys.exit(1)
+            budget = Budget(capacity)
+        elif o in ( '-g', '--genre' ):
+            # GENRE=OFFSET: levels below (or above) the chosen quality
+            try:
+                (genre, offset) = a.rsplit('=', 1)
+                genreOffsets.append((genre, int(offset)))
+            except ValueError:
+                print "Invalid genre offset '%s'; expected GENRE=OFFSET" % a
+                sys.exit(1)
+        elif o == '--metrics':
+            # Per-stage timings, as JSON lines
+            stageLog = StageLog(a)
+        elif o in ( '-m', '--mirror' ):
+            # Created once the output directory is known
+            mirror = True
         else:
             assert False, "unhandled option '%s'" % o
 
-    handlerList = []
-    for path in args:
-        handlerList += parseFile(path)
+    if budget != None and explicitBitrate:
+        print "A capacity and a bitrate can't both be given"
+        sys.exit(1)
+    if genreOffsets and budget == None:
+        print "Genre offsets need a capacity"
+        sys.exit(1)
+    for (genre, offset) in genreOffsets:
+        budget.setGenreOffset(genre, offset)
+
+    if jobs == None:
+        # Each job runs its own decoder and 'lame', so one per usable CPU
+        jobs = usableCpus()
+
+    scanStart = time.time()
+    if walkers > 0:
+        walker = DirectoryWalker(walkers)
+        # Gathered in full: the totals, mirror selection and capacity
+        # budget all need every file before the first is encoded
+        handlerList = list(walker.walk(args))
+        directories = walker.getDirectoryCount()
+    else:
+        visited = set()
+        handlerList = []
+        for path in args:
+            handlerList += parseFile(path, visited)
+        directories = len(visited)
+    scanTime = time.time() - scanStart
+    print "Found %i files in %i directories in %.2fs (%.0f directories/s)" % \
+        (len(handlerList), directories, scanTime, \
+         directories / max(scanTime, 1e-6))
+    if scanOnly:
+        sys.exit(0)
+
+    fixed = 0
+    if mirror:
+        # Only encode what is new or has changed since the last sync
+        mirror = Mirror(output)
+        total = len(handlerList)
+        selected = mirror.select(handlerList)
+        print "Mirroring %i files; %i are up to date" % \
+            (total, total - len(selected))
+
+        # Targets that are up to date stay on the device as they are
+        for h in set(handlerList) - set(selected):
+            fixed += roundToCluster(
+                os.path.getsize(getResamplePath(h, output)))
+        handlerList = selected
 
-    NUM_THREADS = 2
-    sem = threading.Semaphore(NUM_THREADS)
-        
-    print "Resampling %i files..." % len(handlerList)
+    if budget != None:
+        print "Estimating the output of %i files..." % len(handlerList)
+        (level, estimate) = budget.fit(handlerList, fixed)
+        if level == None:
+            print "ERROR: An estimated %s is needed even at -V%d; only " \
+                "%s of %s is usable" % (formatBytes(estimate), \
+                len(VBR_BITRATES) - 1, formatBytes(budget.usable), \
+                formatBytes(budget.capacity))
+            sys.exit(1)
+        print "Encoding at -V%d (about %d kbps): an estimated %s of %s" % \
+            (level, VBR_BITRATES[level], formatBytes(estimate), \
+             formatBytes(budget.capacity))
+
+    # Bounded, so that the queue is never far ahead of the workers
+    queue = Queue.Queue(jobs * 2)
+    results = Results(len(handlerList))
+    results.probe(handlerList)
+
+    progress = None
+    progressFile = None
+    if progressMode == 'auto':
+        if sys.stdout.isatty() and progressPath == None:
+            progressMode = 'tty'
+        else:
+            progressMode = 'json'
+    if progressMode == 'tty':
+        progress = Progress(results, sys.stdout, True)
+        sys.stdout = progress
+        progress.start()
+    elif progressMode == 'json':
+        if progressPath != None:
+            progressFile = open(progressPath, 'w')
+            progress = Progress(results, progressFile, False)
+        else:
+            progress = Progress(results, sys.stderr, False)
+        progress.start()
+    workers = []
+    for i in range(max(min(jobs, len(handlerList)), 1)):
+        t = TranscoderThread(queue, results, output, mirror)
+        t.start()
+        workers.append(t)
+
+    print "Resampling %i files with %i workers..." % \
+        (len(handlerList), len(workers))
     for i in range(len(handlerList)):
-        path = handlerList[i]
         text = '%i / %i' % ((i+1), len(handlerList))
-        sem.acquire()
-        t = TranscoderThread(sem, text, path, output)
-        t.start()
-        
+        queue.put((text, handlerList[i]))
+    for t in workers:
+        queue.put(None)
+    for t in workers:
+        t.join()
+    if progress != None:
+        progress.stop()
+        if progress.tty:
+            sys.stdout = progress.stream
+    if progressFile != None:
+        progressFile.close()
+
+    if mirror:
+        removed = mirror.prune(args)
+        with mirror.lock:
+            mirror.save()
+        print "Removed %i files whose source has gone" % removed
+
+    if stageLog != None:
+        stageLog.close()
+
+    results.report()
+    if results.failed:
+        sys.exit(1)
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import os, sys, optparse, logging, types
+import threading, Queue, multiprocessing
 import mutagen, mutagen.id3, mutagen.mp3, mutagen.mp4, mutagen.ogg
 import mutagen.easyid3
 
@@ -13,15 +14,20 @@ M4A_TRANSLATIONS = { \
     '\xa9alb': 'album', '\xa9nam': 'title', '\xa9ART': 'artist', \
     '\xa9wrt': 'composer', '\xa9gen': 'genre' }
 
+# Extensions of the files a tree of MP3s may have been made from
+SOURCE_EXTENSIONS = ('.mp3', '.m4a', '.mp4', '.ogg', '.flac')
+
 
 def copyTags(sourcePath, destPath):
     # Make sure the files are valid
     for f in (sourcePath, destPath):
         if not os.path.isfile(f):
-            raise TagCopyError("File [%s] is invalid", f)
+            raise TagCopyError("File [%s] is invalid" % f)
     
     source = mutagen.File(sourcePath)
     logging.debug("Using 'mutagen' source object [%s]", str(source))
+    if source == None:
+        raise TagCopyError("Format of [%s] is not recognised" % sourcePath)
 
     dest = mutagen.mp3.MP3(destPath)
     try:
@@ -64,7 +70,7 @@ def copyTagsTranslate(source, dest):
 
             values = source[key]
             if isinstance(values, types.StringTypes):
-                values = [value]
+                values = [values]
 
             for value in values:
                 frame = frameClass(encoding=3, text=value)
@@ -84,13 +90,120 @@ def translateTagKey(obj, key):
     return key
 
 
+def readPairs(stream):
+    """Reads <source><TAB><dest> lines, skipping blank lines and comments.
+
+    Returns the pairs and the number of lines that could not be read.
+    """
+    pairs = []
+    errors = 0
+    for (number, line) in enumerate(stream, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 2:
+            logging.error("Line %d is not <source><TAB><dest>: [%s]", \
+                    number, line)
+            errors += 1
+            continue
+        pairs.append(tuple(fields))
+    return (pairs, errors)
+
+
+def matchTrees(sourceDir, destDir):
+    """Pairs each MP3 beneath 'destDir' with the source file at the same
+    relative path, with the same stem, beneath 'sourceDir'.
+
+    Returns the pairs and the number of MP3s with more than one candidate.
+    """
+    sources = {}
+    for (dirpath, dirnames, filenames) in os.walk(sourceDir):
+        rel = os.path.relpath(dirpath, sourceDir)
+        for name in filenames:
+            (stem, ext) = os.path.splitext(name)
+            if ext.lower() in SOURCE_EXTENSIONS:
+                sources.setdefault((rel, stem), []).append( \
+                        os.path.join(dirpath, name))
+
+    pairs = []
+    errors = 0
+    for (dirpath, dirnames, filenames) in os.walk(destDir):
+        rel = os.path.relpath(dirpath, destDir)
+        for name in sorted(filenames):
+            (stem, ext) = os.path.splitext(name)
+            if ext.lower() != '.mp3':
+                continue
+            destPath = os.path.join(dirpath, name)
+
+            # The trees may be one and the same
+            candidates = [c for c in sources.get((rel, stem), []) \
+                    if not os.path.samefile(c, destPath)]
+            if len(candidates) == 1:
+                pairs.append((candidates[0], destPath))
+            elif not candidates:
+                logging.warning("No source for [%s]", destPath)
+            else:
+                logging.error("More than one source for [%s]: %s", \
+                        destPath, ', '.join(candidates))
+                errors += 1
+    return (pairs, errors)
+
+
+def copyAllTags(pairs, jobs):
+    """Copies tags for each (source, dest) pair using 'jobs' threads,
+    carrying on past failures; returns the pairs that failed"""
+    queue = Queue.Queue()
+    failures = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            pair = queue.get()
+            if pair == None:
+                break
+            try:
+                copyTags(*pair)
+                logging.debug("Copied tags from [%s] to [%s]", *pair)
+            except Exception, e:
+                logging.error("Unable to copy tags from [%s] to [%s]: %s", \
+                        pair[0], pair[1], e)
+                with lock:
+                    failures.append(pair)
+
+    threads = [threading.Thread(target=worker) \
+            for i in range(max(min(jobs, len(pairs)), 1))]
+    for t in threads:
+        t.start()
+    for pair in pairs:
+        queue.put(pair)
+    for t in threads:
+        queue.put(None)
+    for t in threads:
+        t.join()
+    return failures
+
+
 def main():
-    usage = 'Usage: %prog [options] <source-file> <dest-file>'
+    usage = 'Usage: %prog [options] <source-file> <dest-file>\n' \
+            '       %prog [options] <source-dir> <dest-dir>\n' \
+            '       %prog [options] --batch [--manifest FILE]'
     parser = optparse.OptionParser(usage)
 
     parser.add_option('-d', '--debug', \
             action='store_true', dest='debug', default=False, \
             help='Enable debug logging')
+    parser.add_option('-b', '--batch', \
+            action='store_true', dest='batch', default=False, \
+            help='Read <source><TAB><dest> pairs, one per line, from ' \
+                 'standard input')
+    parser.add_option('-f', '--manifest', metavar='FILE', \
+            action='store', dest='manifest', default=None, \
+            help='Read the pairs from FILE rather than standard input')
+    parser.add_option('-j', '--jobs', metavar='COUNT', \
+            action='store', type='int', dest='jobs', \
+            default=multiprocessing.cpu_count(), \
+            help='Copies tags for COUNT pairs at a time (default: %default)')
 
     (options, args) = parser.parse_args()
 
@@ -98,15 +211,48 @@ def main():
     if options.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    if options.jobs < 1:
+        logging.error("Invalid number of jobs (%d)", options.jobs)
+        sys.exit(2)
+
     # Handle the arguments
-    if len(args) != 2:
+    if options.batch or options.manifest != None:
+        if len(args) != 0:
+            logging.error("No arguments are taken with a batch of pairs")
+            parser.print_usage()
+            sys.exit(2)
+        if options.manifest != None:
+            try:
+                fd = open(options.manifest)
+            except IOError, e:
+                raise TagCopyError("Unable to read manifest [%s]: %s" % \
+                        (options.manifest, e.strerror))
+            try:
+                (pairs, errors) = readPairs(fd)
+            finally:
+                fd.close()
+        else:
+            (pairs, errors) = readPairs(sys.stdin)
+    elif len(args) != 2:
         logging.error("Incorrect number of arguments (%d)", len(args))
         parser.print_usage()
         sys.exit(2)
-    (sourcePath, destPath) = args
+    elif os.path.isdir(args[0]) and os.path.isdir(args[1]):
+        (pairs, errors) = matchTrees(*args)
+    else:
+        (sourcePath, destPath) = args
     
-    # Perform the copy    
-    copyTags(sourcePath, destPath)
+        # Perform the copy    
+        copyTags(sourcePath, destPath)
+        return
+
+    # One process for the whole batch, rather than one per pair
+    failures = copyAllTags(pairs, options.jobs)
+    logging.info("Copied tags for %d of %d pairs", \
+            len(pairs) - len(failures), len(pairs))
+    if failures or errors:
+        raise TagCopyError("%d pairs failed and %d more could not be " \
+                "paired" % (len(failures), errors))
 
 
 if __name__ == "__main__":
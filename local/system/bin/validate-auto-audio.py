@@ -3,18 +3,96 @@
 
 import os, sys, types, string, threading
 import optparse
+import Queue
+import multiprocessing
+import hashlib
+import sqlite3
+import time
+import tempfile
+import shutil
+import struct
+import re
+import mmap
+import heapq
+import json
+import resource
+import select
+import signal
+import errno
+import ctypes, ctypes.util
+import socket
+import SimpleXMLRPCServer, xmlrpclib
+import fcntl
 import subprocess
 import logging
 import StringIO
+import base64
 import mutagen, mutagen.id3, mutagen.mp3, mutagen.mp4, mutagen.ogg
-import mutagen.easyid3
+import mutagen.easyid3, mutagen.flac
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Outcomes reported by a 'FileProcessor' for each file it handles
+OUTCOME_CONVERTED = 'converted'
+OUTCOME_DELETED = 'deleted'
+OUTCOME_SKIPPED = 'skipped'
+OUTCOME_FAILED = 'failed'
+OUTCOME_UNCHANGED = 'unchanged'
+OUTCOME_VERIFIED = 'verified'
+OUTCOME_DAMAGED = 'damaged'
+
+# Default number of concurrent I/O-bound stages
+DEFAULT_IO_JOBS = 2
+
+# Seconds a file must be left alone in watch mode before it is processed
+DEFAULT_SETTLE = 5.0
+
+# Seconds a coordinator's lease on a job lasts without a heartbeat
+DEFAULT_LEASE_TIME = 60.0
+
+# The coordinator's XML-RPC is unauthenticated, so it only listens more
+# widely than this when given a host explicitly
+DEFAULT_COORDINATOR_HOST = '127.0.0.1'
+
+# Seconds a decode/encode pipeline may go without moving any data before
+# it is killed
+DEFAULT_STALL_TIMEOUT = 120.0
+
+# Prefix of the scratch directories that segmented encodes spool PCM into
+SEGMENT_DIR_PREFIX = '.validate-segments-'
+
+# ID3 picture type for front cover art
+COVER_FRONT = 3
+
+def pictureToApic(pic):
+    """Converts a FLAC-style picture block to an ID3 'APIC' frame"""
+    return mutagen.id3.APIC(encoding=3, mime=pic.mime, type=pic.type, \
+        desc=pic.desc, data=pic.data)
 
-THREAD_MAX = 3
 
 class AudioFile(object):
+    # Estimated CPU seconds to decode one second of CD-quality audio, and
+    # bytes per second of audio (for when the header cannot be read)
+    DECODE_COST = 0.0
+    BYTES_PER_SECOND = 176400
+
     def __init__(self, path, t):
         self.path = path
         self.t = t
+        self.tagSize = None
+        self.decoder = None
+        self.encodeCpu = 0.0
+        self.pipeline = None
+        self.aborted = None
+        # (staged, final) output paths; they differ only when outputs are
+        # written aside until the job is confirmed
+        self.staged = []
 
         if not os.path.exists(self.path):
             raise Exception, "AudioFile created from non-existent path [%s]" % \
@@ -26,6 +104,48 @@ class AudioFile(object):
     def convert(self, v):
         raise NotImplementedError
 
+    def abort(self, reason):
+        """Stops the conversion from another thread, killing its processes;
+        nothing more is written to its outputs"""
+        self.aborted = reason
+        pipeline = self.pipeline
+        if pipeline != None:
+            pipeline.abort(reason)
+        elif self.decoder != None and self.decoder.returncode == None:
+            try:
+                self.decoder.kill()
+            except OSError:
+                pass
+
+    def estimateCost(self, v):
+        """Estimates the CPU seconds needed to convert this file"""
+        return 0.0
+
+    def getFingerprint(self):
+        """Identifies the audio content, ignoring any tags"""
+        h = hashlib.sha1()
+        fd = open(self.path, 'rb')
+        try:
+            self.hashPayload(fd, h)
+        finally:
+            fd.close()
+        return '%s:%s' % (self.t, h.hexdigest())
+
+    def hashPayload(self, fd, h):
+        # Default implementation: the whole file
+        hashStream(fd, h)
+
+    def getAudioInfo(self):
+        """Returns (duration, sample rate, channels) from the header"""
+        try:
+            info = self.getMutagenFile().info
+            return (info.length, getattr(info, 'sample_rate', 44100), \
+                getattr(info, 'channels', 2))
+        except Exception:
+            logging.debug("Unable to read the header of [%s]", self.path)
+            return (float(os.path.getsize(self.path)) / \
+                self.BYTES_PER_SECOND, 44100, 2)
+
 
 class Mp3CompatibleAudioFile(AudioFile):
 
@@ -34,67 +154,274 @@ class Mp3CompatibleAudioFile(AudioFile):
 
     def getLameFilename(self):
         # Default to just the original name with 'mp3' on the end
-        (root, ext) = os.path.splitext(self.path)
-        return '%s.%s' % (root, 'mp3')
+        return self.getOutputFilename('mp3')
+
+    def estimateCost(self, v):
+        (duration, sampleRate, channels) = self.getAudioInfo()
+        scale = duration * sampleRate * channels / (44100.0 * 2)
+        return scale * (self.DECODE_COST + \
+            sum(profile.cost for profile in v.getTargets()))
+
+    def getOutputFilename(self, ext):
+        (root, oldExt) = os.path.splitext(self.path)
+        return '%s.%s' % (root, ext)
+
+    def prepare(self, v):
+        """Resolves the output targets and builds the tags to copy.
+
+        Returns (targets, frames), or None for a simulated run.
+        """
+        targets = []
+        self.staged = []
+        for profile in v.getTargets():
+            final = profile.getOutputPath(v, self)
+            logging.info("Converting %s [%s] to %s [%s]...", \
+                self.t, self.path, profile.name, final)
+            outpath = v.stagePath(final)
+            if outpath != final:
+                # The final path is only replaced once the job is confirmed
+                if os.path.exists(outpath) and not v.isSimulation():
+                    os.remove(outpath)
+            elif os.path.exists(outpath):
+                logging.warning("Output path [%s] already exists!", outpath)
+                v.deletePath(outpath)
+            targets.append((profile, outpath))
+            self.staged.append((outpath, final))
 
-    def convert(self, v):
-        (root, ext) = os.path.splitext(self.path)
-        outpath = self.getLameFilename()
+        if v.isSimulation():
+            return None
 
-        logging.info("Converting %s [%s] to MP3 [%s]...", \
-            self.t, self.path, outpath)
-        if os.path.exists(outpath):
-            logging.warning("Output path [%s] already exists!", outpath)
-            v.deletePath(outpath)
+        for (profile, outpath) in targets:
+            outdir = os.path.dirname(outpath)
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
 
-        logging.info("Converting [%s] to [%s]...", self.path, outpath)
-        if v.isSimulation():
-            return
+        # Build the tags up front so the encoder can reserve room for them
+        frames = self.getTagFrames(v)
+        self.tagSize = estimateTagSize(frames)
+        return (targets, frames)
 
-        src = self.getRawStream(v)
-        args = ['lame', '-h', '-v', '-', outpath]
-        lame = subprocess.Popen(args, stdin=src)
-        lame.wait()
+    def convert(self, v):
+        prepared = self.prepare(v)
+        if prepared == None:
+            return True
+        (targets, frames) = prepared
+        try:
+            if not self.convertTo(v, targets, frames):
+                return False
+            if not self.publish(v):
+                return False
+        finally:
+            self.discardStaged()
 
-        src.close()
+        # Delete the original file
+        v.deletePath(self.path)
+        return True
 
-        if lame.returncode != 0:
-            logging.error( "Recieved return code [%d] after conversion!", \
-            lame.returncode )
-            return
+    def convertTo(self, v, targets, frames):
+
+        # Identical audio that another job has (or is) encoding is cloned
+        dedup = v.getDeduplicator()
+        entry = None
+        if dedup != None:
+            try:
+                with v.limits.io:
+                    (entry, leader) = dedup.claim(self)
+            except (EnvironmentError, ValueError), e:
+                logging.warning("Unable to fingerprint [%s]: %s", \
+                    self.path, e)
+                (entry, leader) = (None, True)
+            if not leader:
+                if dedup.clone(entry, self, targets, frames, v):
+                    return True
+                entry = None
+
+        success = False
+        try:
+            if self.isSegmentable(v, targets):
+                # Takes a CPU slot per segment
+                success = self.encodeSegmented(v, targets)
+            else:
+                with v.limits.cpu:
+                    success = self.encode(v, targets)
+            if not success or self.aborted != None:
+                return False
         
+            self.copyTagsToTargets(v, targets, frames)
+        finally:
+            if entry != None:
+                dedup.complete(entry, success, targets, frames, \
+                    self.encodeCpu)
+        return True
+
+    def publish(self, v):
+        """Moves staged outputs into place once the job is confirmed;
+        returns False (leaving them to be discarded) if it is not"""
+        staged = [(s, f) for (s, f) in self.staged if s != f]
+        if not staged:
+            return True
+        if self.aborted != None or not v.confirmPath(self.path):
+            logging.warning("Discarding the outputs of [%s]: it has been " \
+                "handed to another worker", self.nameForLog(v))
+            return False
+        for (stagedPath, final) in staged:
+            os.rename(stagedPath, final)
+        self.staged = []
+        return True
+
+    def discardStaged(self):
+        for (stagedPath, final) in self.staged:
+            if stagedPath != final and os.path.exists(stagedPath):
+                os.remove(stagedPath)
+        self.staged = []
+
+    def copyTagsToTargets(self, v, targets, frames):
         # Copy the original tags over, if possible
-        self.copyTagsTo(outpath, v)
+        for (profile, outpath) in targets:
+            if profile.isMp3():
+                self.copyTagsTo(outpath, v, frames)
+
+    def encode(self, v, targets):
+        # Decode once; the encoders are fed copies of the decoded stream
+        # and killed if the decoder fails or stalls
+        pipeline = Pipeline(v, self, targets, v.getStallTimeout())
+        self.pipeline = pipeline
+        if self.aborted != None:
+            pipeline.abort(self.aborted)
+        pipeline.run()
+        self.encodeCpu += pipeline.getCpu()
+        return pipeline.complete()
+
+    def recordDecode(self, v, start, pcmBytes=None):
+        """Reaps the decoder process and records its metrics"""
+        usage = None
+        returncode = 0
+        if self.decoder != None:
+            usage = waitProcess(self.decoder)
+            returncode = self.decoder.returncode
+            self.encodeCpu += cpuTime(usage) or 0.0
+        v.metrics.record(self.path, 'decode:%s' % self.t, \
+            time.time() - start, cpuTime(usage), fileSize(self.path), \
+            pcmBytes, returncode)
+
+    def abandonDecoder(self):
+        """Kills and reaps a decoder whose output is no longer wanted"""
+        if self.decoder == None:
+            return
+        try:
+            # Harmless if it has already exited, as it isn't reaped yet
+            self.decoder.kill()
+        except OSError:
+            pass
+        self.encodeCpu += cpuTime(waitProcess(self.decoder)) or 0.0
+        self.decoder = None
 
-        # Delete the original file
-        v.deletePath(self.path)
+    def isSegmentable(self, v, targets):
+        threshold = v.getSegmentThreshold()
+        if threshold == None:
+            return False
+        for (profile, outpath) in targets:
+            if not profile.isLame():
+                return False
+
+        try:
+            info = self.getMutagenFile().info
+            duration = info.length
+        except Exception:
+            logging.debug("Unable to read the duration of [%s]", self.path)
+            return False
+        if duration < threshold:
+            return False
+
+        # Rule out what the spool can't take (e.g. 24-bit or 96 kHz) before
+        # starting a decoder, where the header says
+        bits = getattr(info, 'bits_per_sample', None)
+        sampleRate = getattr(info, 'sample_rate', None)
+        valid = [r for rates in MPEG_SAMPLE_RATES.values() for r in rates]
+        if (bits != None and bits != 16) or \
+                (sampleRate != None and sampleRate not in valid):
+            logging.info("Input [%s] (%s bit, %s Hz) cannot be segmented; " \
+                "encoding in a single pass", self.nameForLog(v), bits, \
+                sampleRate)
+            return False
+        return True
+
+    def encodeSegmented(self, v, targets):
+        # The PCM spool can be large; by default keep it on the output's
+        # filesystem rather than in a (possibly small) /tmp
+        scratch = v.getSegmentDir() or os.path.dirname(targets[0][1])
+        workdir = tempfile.mkdtemp(prefix=SEGMENT_DIR_PREFIX, dir=scratch)
+        try:
+            with v.limits.cpu:
+                start = time.time()
+                # Held to --stall-timeout, like a 'Pipeline'
+                src = SupervisedStream(self.getRawStream(v), \
+                    v.getStallTimeout())
+                try:
+                    spool = PcmSpool.fromWav(src, \
+                        os.path.join(workdir, 'pcm'))
+                except StallError, e:
+                    logging.error("Aborted conversion of [%s]: %s", \
+                        self.nameForLog(v), e)
+                    if self.decoder != None:
+                        try:
+                            self.decoder.kill()
+                        except OSError:
+                            pass
+                    self.recordDecode(v, start)
+                    return False
+                finally:
+                    src.close()
+                if spool == None:
+                    # The decoder was left part-way through the stream, so
+                    # its exit status (often EPIPE) means nothing
+                    self.abandonDecoder()
+                    logging.info("Input [%s] cannot be segmented; encoding " \
+                        "in a single pass", self.nameForLog(v))
+                    return self.encode(v, targets)
+                self.recordDecode(v, start, fileSize(spool.path))
+                if self.decoder != None and self.decoder.returncode != 0:
+                    logging.error("Decoder for [%s] exited with status %d", \
+                        self.nameForLog(v), self.decoder.returncode)
+                    return False
+
+            logging.info("Encoding [%s] (%.0fs) in segments...", \
+                self.nameForLog(v), spool.getDuration())
+            success = True
+            for (profile, outpath) in targets:
+                if self.aborted != None:
+                    return False
+                start = time.time()
+                encoder = SegmentedEncoder(v, profile, spool, workdir, \
+                    profile.getTagArgs(self.tagSize))
+                result = encoder.encode(outpath)
+                self.encodeCpu += encoder.cpu
+                v.metrics.record(self.path, 'encode:%s' % profile.name, \
+                    time.time() - start, encoder.cpu, fileSize(spool.path), \
+                    fileSize(outpath), int(not result))
+                if not result:
+                    success = False
+            return success
+        finally:
+            shutil.rmtree(workdir, True)
+
+    def nameForLog(self, v):
+        return v.nameForPath(self.path)
       
 
-    def copyTagsTo(self, destPath, v):
+    def getTagFrames(self, v):
+        """Builds the ID3 frames (including cover art) for converted files"""
         source = self.getMutagenFile()
         logging.debug("Using 'mutagen' source object [%s]", str(source))
-        
-        if not v.isSimulation():
-            if not os.path.exists(destPath):
-                raise Exception, "Destination path [%s] does not exist!" % \
-                        destPath
-        
-        dest = mutagen.mp3.MP3(destPath)
-        try:
-            dest.add_tags()
-            dest.delete()
-        except mutagen.id3.error:
-            # Already has tags
-            pass
 
-        # Add any tags that are supported
+        frames = []
         if source == None:
             logging.debug("No tag source provided!")
         elif isinstance(source, mutagen.mp3.MP3):
             # Copy directly from the source to the destination
             logging.debug( "Copying tags from MP3 to MP3..." )
-            if not v.isSimulation():
-                dest.update(source)
+            if source.tags != None:
+                frames += source.tags.values()
         else:
             # On a key-by-key basis, translate to text ID3 tags
             for key in source.keys():
@@ -113,19 +440,53 @@ class Mp3CompatibleAudioFile(AudioFile):
 
                     values = source[key]
                     if isinstance(values, types.StringTypes):
-                        values = [value]
+                        values = [values]
                 
                     for value in values:
                         frame = frameClass(encoding=3, text=value)
                         logging.debug("Appending frame [%s] = [%s]", \
                                 frameName, str(frame))
-                        if not v.isSimulation():
-                            dest.tags.add(frame)
+                        frames.append(frame)
+
+            frames += self.getCoverFrames(source)
 
-        if not v.isSimulation():
-            dest.save()
-        del(dest)
         del(source)
+        return frames
+
+    def getCoverFrames(self, source):
+        # Default implementation: no cover art
+        return []
+
+    def copyTagsTo(self, destPath, v, frames=None):
+        if frames == None:
+            frames = self.getTagFrames(v)
+        if v.isSimulation():
+            return
+
+        if not os.path.exists(destPath):
+            raise Exception, "Destination path [%s] does not exist!" % \
+                    destPath
+        
+        with v.limits.io, v.metrics.stage(self.path, 'tags') as stage:
+            stage.bytesIn = fileSize(destPath)
+
+            # Replace the tag in memory; if the encoder reserved enough
+            # space for it, it is saved in place without rewriting the audio
+            dest = mutagen.mp3.MP3(destPath)
+            if dest.tags == None:
+                dest.add_tags()
+            else:
+                dest.tags.clear()
+            for frame in frames:
+                dest.tags.add(frame)
+
+            try:
+                dest.save(padding=keepPadding)
+            except TypeError:
+                # Versions of 'mutagen' without padding control
+                dest.save()
+            del(dest)
+            stage.bytesOut = fileSize(destPath)
 
     def translateTagKey(self, key):
         # Default implementation: no translation
@@ -133,6 +494,9 @@ class Mp3CompatibleAudioFile(AudioFile):
 
 
 class FlacAudioFile(Mp3CompatibleAudioFile):
+    DECODE_COST = 0.005
+    BYTES_PER_SECOND = 88200
+
     def __init__(self, path):
         super(FlacAudioFile, self).__init__(path, 'FLAC')
 
@@ -142,9 +506,47 @@ class FlacAudioFile(Mp3CompatibleAudioFile):
             args.append('-s')
         args += ['-c', '-d', self.path]
 
-        flac = subprocess.Popen(args, stdout=subprocess.PIPE)    
+        flac = subprocess.Popen(v.wrapCommand(args), \
+            stdout=subprocess.PIPE)
+        self.decoder = flac    
         return flac.stdout
 
+    def getCoverFrames(self, source):
+        return [pictureToApic(pic) for pic in source.pictures]
+
+    def getFingerprint(self):
+        # STREAMINFO carries an MD5 of the decoded audio
+        try:
+            info = self.getMutagenFile().info
+            if info.md5_signature:
+                return 'FLAC:%032x:%d' % (info.md5_signature, \
+                    info.total_samples)
+        except Exception:
+            pass
+        return super(FlacAudioFile, self).getFingerprint()
+
+    def hashPayload(self, fd, h):
+        # Skip the metadata blocks, which hold the tags and pictures
+        header = fd.read(4)
+        if header[:3] == 'ID3':
+            fd.seek(skipId3v2(header + fd.read(6)))
+            header = fd.read(4)
+        if header != 'fLaC':
+            raise ValueError("[%s] is not a FLAC file" % self.path)
+        while True:
+            block = fd.read(4)
+            if len(block) < 4:
+                return
+            (size,) = struct.unpack('>I', '\0' + block[1:])
+            if ord(block[0]) & 0x7F == 0:
+                # STREAMINFO describes the audio itself
+                h.update(fd.read(size))
+            else:
+                fd.seek(size, 1)
+            if ord(block[0]) & 0x80:
+                break
+        hashStream(fd, h)
+
 class WavAudioFile(Mp3CompatibleAudioFile):
     def __init__(self, path):
         super(WavAudioFile, self).__init__(path, 'WAV')
@@ -152,8 +554,26 @@ class WavAudioFile(Mp3CompatibleAudioFile):
     def getRawStream(self, v):
         return open(self.path, 'r')
 
+    def hashPayload(self, fd, h):
+        # Only the format and sample data; 'LIST' and other chunks may
+        # hold tags
+        if fd.read(12)[8:] != 'WAVE':
+            raise ValueError("[%s] is not a WAV file" % self.path)
+        while True:
+            chunk = fd.read(8)
+            if len(chunk) < 8:
+                return
+            (chunkId, size) = struct.unpack('<4sI', chunk)
+            if chunkId in ('fmt ', 'data'):
+                hashStream(fd, h, size)
+                fd.seek(size & 1, 1)
+            else:
+                fd.seek(size + (size & 1), 1)
+
 
 class M4aAudioFile(Mp3CompatibleAudioFile):
+    DECODE_COST = 0.01
+    BYTES_PER_SECOND = 32000
     KEY_TRANSLATIONS = { \
         '\xa9alb': 'album', '\xa9nam': 'title', '\xa9ART': 'artist', \
         '\xa9wrt': 'composer', '\xa9gen': 'genre' }
@@ -167,9 +587,44 @@ class M4aAudioFile(Mp3CompatibleAudioFile):
             args.append('-q')
         args += ['-o', '-', self.path]
 
-        faad = subprocess.Popen(args, stdout=subprocess.PIPE)    
+        faad = subprocess.Popen(v.wrapCommand(args), \
+            stdout=subprocess.PIPE)
+        self.decoder = faad    
         return faad.stdout
 
+    def getCoverFrames(self, source):
+        frames = []
+        for cover in (source.tags or {}).get('covr', []):
+            if cover.imageformat == mutagen.mp4.MP4Cover.FORMAT_PNG:
+                mime = 'image/png'
+            else:
+                mime = 'image/jpeg'
+            frames.append(mutagen.id3.APIC(encoding=3, mime=mime, \
+                type=COVER_FRONT, desc=u'', data=str(cover)))
+        return frames
+
+    def hashPayload(self, fd, h):
+        # Tags live in 'moov'; the encoded audio is in the 'mdat' atoms
+        while True:
+            atom = fd.read(8)
+            if len(atom) < 8:
+                return
+            (size, atomType) = struct.unpack('>I4s', atom)
+            header = 8
+            if size == 1:
+                (size,) = struct.unpack('>Q', fd.read(8))
+                header = 16
+            if size == 0:
+                length = None
+            else:
+                length = size - header
+            if atomType == 'mdat':
+                hashStream(fd, h, length)
+            elif length == None:
+                return
+            else:
+                fd.seek(length, 1)
+
     def translateTagKey(self, key):
         if key in M4aAudioFile.KEY_TRANSLATIONS:
             return M4aAudioFile.KEY_TRANSLATIONS[key]
@@ -178,6 +633,9 @@ class M4aAudioFile(Mp3CompatibleAudioFile):
 
 
 class OggAudioFile(Mp3CompatibleAudioFile):
+    DECODE_COST = 0.01
+    BYTES_PER_SECOND = 24000
+
     def __init__(self, path):
         super(OggAudioFile, self).__init__(path, 'OGG')
 
@@ -187,11 +645,842 @@ class OggAudioFile(Mp3CompatibleAudioFile):
             args.append('-Q')
         args += ['-o', '-', self.path]
 
-        oggdec = subprocess.Popen(args, stdout=subprocess.PIPE)
+        oggdec = subprocess.Popen(v.wrapCommand(args), \
+            stdout=subprocess.PIPE)
+        self.decoder = oggdec
         return oggdec.stdout
+
+    def hashPayload(self, fd, h):
+        # Hash the packet data after the three header packets (the second
+        # holds the comments); page boundaries may move when retagging
+        packets = 0
+        while True:
+            header = fd.read(27)
+            if len(header) < 27:
+                return
+            if header[:4] != 'OggS':
+                raise ValueError("[%s] has a bad Ogg page" % self.path)
+            lacing = [ord(c) for c in fd.read(ord(header[26]))]
+            if packets >= 3:
+                hashStream(fd, h, sum(lacing))
+                continue
+            for size in lacing:
+                data = fd.read(size)
+                if packets >= 3:
+                    h.update(data)
+                if size < 255:
+                    packets += 1
+
+    def getCoverFrames(self, source):
+        frames = []
+        for data in (source.tags or {}).get('metadata_block_picture', []):
+            try:
+                pic = mutagen.flac.Picture(base64.b64decode(data))
+            except (TypeError, mutagen.flac.error):
+                logging.debug("Skipping unreadable cover art in [%s]", \
+                    self.path)
+                continue
+            frames.append(pictureToApic(pic))
+        return frames
     
+# MPEG audio (layer III) frame header tables
+MPEG_VERSION_1 = 3
+MPEG_VERSION_2 = 2
+MPEG_VERSION_25 = 0
+MPEG_LAYER_3 = 1
+MPEG_MODE_MONO = 3
+
+MPEG_BITRATES = {
+    MPEG_VERSION_1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+        256, 320),
+    MPEG_VERSION_2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128,
+        144, 160),
+    }
+MPEG_BITRATES[MPEG_VERSION_25] = MPEG_BITRATES[MPEG_VERSION_2]
+
+MPEG_SAMPLE_RATES = {
+    MPEG_VERSION_1: (44100, 48000, 32000),
+    MPEG_VERSION_2: (22050, 24000, 16000),
+    MPEG_VERSION_25: (11025, 12000, 8000),
+    }
+
+
+class FrameHeader(object):
+    """Decoded 4-byte MPEG audio layer III frame header"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.version = (raw >> 19) & 0x3
+        self.protected = not ((raw >> 16) & 0x1)
+        self.bitrate = MPEG_BITRATES[self.version][(raw >> 12) & 0xF]
+        self.sampleRate = MPEG_SAMPLE_RATES[self.version][(raw >> 10) & 0x3]
+        self.padding = (raw >> 9) & 0x1
+        self.mode = (raw >> 6) & 0x3
+
+        if self.version == MPEG_VERSION_1:
+            self.samples = 1152
+            self.length = 144000 * self.bitrate / self.sampleRate + \
+                self.padding
+        else:
+            self.samples = 576
+            self.length = 72000 * self.bitrate / self.sampleRate + \
+                self.padding
+
+    def getSideInfoLength(self):
+        mono = (self.mode == MPEG_MODE_MONO)
+        if self.version == MPEG_VERSION_1:
+            return mono and 17 or 32
+        return mono and 9 or 17
+
+    def getDataOffset(self):
+        # Offset of the side information from the start of the frame
+        return self.protected and 6 or 4
+
+    @staticmethod
+    def parse(data, offset):
+        """Returns the header at 'offset', or None if there isn't one"""
+        if offset + 4 > len(data):
+            return None
+        (raw,) = struct.unpack('>I', data[offset:offset+4])
+        return FrameHeader.fromRaw(raw)
+
+    @staticmethod
+    def fromRaw(raw):
+        """Returns the header for 'raw', or None if it isn't valid"""
+        if (raw >> 21) & 0x7FF != 0x7FF:
+            return None
+        if ((raw >> 19) & 0x3) == 1 or ((raw >> 17) & 0x3) != MPEG_LAYER_3:
+            return None
+        if ((raw >> 12) & 0xF) in (0, 0xF) or ((raw >> 10) & 0x3) == 3:
+            return None
+        return FrameHeader(raw)
+
+
+def skipId3v2(data):
+    """Returns the offset just past any leading ID3v2 tag"""
+    if len(data) < 10 or data[:3] != 'ID3':
+        return 0
+    size = 0
+    for c in data[6:10]:
+        size = (size << 7) | (ord(c) & 0x7F)
+    if ord(data[5]) & 0x10:
+        # Footer present
+        size += 10
+    return 10 + size
+
+
+def scanFrames(data, offset):
+    """Returns (offset, header) for each consecutive frame from 'offset'"""
+    frames = []
+    while True:
+        header = FrameHeader.parse(data, offset)
+        if header == None or offset + header.length > len(data):
+            break
+        frames.append((offset, header))
+        offset += header.length
+    return frames
+
+
+def findInfoTag(data, offset, header):
+    """Returns the offset of a Xing/Info tag in the frame, or -1"""
+    pos = offset + header.getDataOffset() + header.getSideInfoLength()
+    if data[pos:pos+4] in ('Xing', 'Info'):
+        return pos
+    return -1
+
+
+CRC16_TABLE = []
+for i in range(256):
+    crc = i
+    for j in range(8):
+        if crc & 1:
+            crc = (crc >> 1) ^ 0xA001
+        else:
+            crc >>= 1
+    CRC16_TABLE.append(crc)
+del(i, j, crc)
+
+def crc16(data, crc=0):
+    """CRC-16 (as used by the LAME info tag)"""
+    for c in data:
+        crc = CRC16_TABLE[(crc ^ ord(c)) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+CRC16_MPEG_TABLE = []
+for i in range(256):
+    crc = i << 8
+    for j in range(8):
+        if crc & 0x8000:
+            crc = ((crc << 1) ^ 0x8005) & 0xFFFF
+        else:
+            crc = (crc << 1) & 0xFFFF
+    CRC16_MPEG_TABLE.append(crc)
+del(i, j, crc)
+
+def crc16Mpeg(data, crc=0xFFFF):
+    """CRC-16 protecting an MPEG audio frame's header and side info"""
+    for c in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_MPEG_TABLE[(crc >> 8) ^ ord(c)]
+    return crc
+
+
+class Mp3Scan(object):
+    """Integrity check of an MP3 file's framing, without decoding it.
+
+    The file is memory-mapped and walked frame header to frame header,
+    checking sync, frame lengths, frame CRCs and the Xing/LAME info tag.
+    A 'deep' scan also checks the LAME music CRC, which reads every byte.
+    """
+
+    # Encoders that write a LAME-style extension with a tag CRC
+    LAME_TAGGERS = ('LAME', 'Lavf', 'Lavc')
 
-class FileProcessorThread(threading.Thread):
+    def __init__(self, path, deep=False):
+        self.path = path
+        self.deep = deep
+        self.problems = []
+        self.frames = 0
+        self.badCrcs = 0
+
+    def isDamaged(self):
+        return len(self.problems) > 0
+
+    def addProblem(self, fmt, *args):
+        self.problems.append(fmt % args)
+
+    def run(self):
+        if os.path.getsize(self.path) == 0:
+            self.addProblem("empty file")
+            return self
+        with open(self.path, 'rb') as fd:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.scan(data)
+        finally:
+            data.close()
+        return self
+
+    def getAudioEnd(self, data):
+        """Returns the offset of any trailing ID3v1 or APEv2 tag"""
+        end = len(data)
+        if end >= 128 and data[end-128:end-125] == 'TAG':
+            end -= 128
+        if end >= 32 and data[end-32:end-24] == 'APETAGEX':
+            (size, items, flags) = struct.unpack('<III', data[end-20:end-8])
+            if flags & 0x80000000:
+                # Header present
+                size += 32
+            end = max(0, end - size)
+        return end
+
+    def scan(self, data):
+        end = self.getAudioEnd(data)
+        pos = skipId3v2(data[:10])
+        if pos > end:
+            self.addProblem("ID3v2 tag runs past the end of the file")
+            return
+
+        # Headers repeat throughout a file, so decode each one only once
+        headers = {}
+        first = None
+        firstPos = None
+        lost = None
+        while pos + 4 <= end:
+            (raw,) = struct.unpack('>I', data[pos:pos+4])
+            if raw not in headers:
+                headers[raw] = FrameHeader.fromRaw(raw)
+            header = headers[raw]
+            if header != None and first != None and \
+                    (header.version != first.version or \
+                     header.sampleRate != first.sampleRate):
+                header = None
+            if header != None and (first == None or lost != None):
+                # Don't trust a sync word found by searching until the
+                # frame after it checks out too
+                after = pos + header.length
+                if after + 4 <= end:
+                    header = self.confirm(data, after, header, headers)
+
+            if header == None:
+                if lost == None:
+                    lost = pos
+                pos = data.find('\xff', pos + 1, end)
+                if pos < 0:
+                    pos = end
+                continue
+
+            if lost != None:
+                self.addGarbage(data, lost, pos)
+                lost = None
+            if pos + header.length > end:
+                self.addProblem("truncated frame at offset %d (%d of %d " \
+                    "bytes)", pos, end - pos, header.length)
+                pos = end
+                break
+            if first == None:
+                (first, firstPos) = (header, pos)
+            if header.protected:
+                self.checkFrameCrc(data, pos, header)
+            self.frames += 1
+            audioEnd = pos + header.length
+            pos = audioEnd
+
+        if pos < end and lost == None:
+            lost = pos
+        if lost != None:
+            self.addGarbage(data, lost, end)
+        if first == None:
+            self.addProblem("no MPEG audio frames found")
+            return
+        if self.badCrcs:
+            self.addProblem("%d frame(s) failed their CRC check", \
+                self.badCrcs)
+        self.checkInfoTag(data, firstPos, first, audioEnd)
+
+    def confirm(self, data, pos, header, headers):
+        (raw,) = struct.unpack('>I', data[pos:pos+4])
+        if raw not in headers:
+            headers[raw] = FrameHeader.fromRaw(raw)
+        after = headers[raw]
+        if after == None or after.version != header.version or \
+                after.sampleRate != header.sampleRate:
+            return None
+        return header
+
+    def addGarbage(self, data, start, end):
+        # Zero padding (e.g. after an ID3v2 tag) is harmless
+        if data[start:end].strip('\0'):
+            self.addProblem("%d bytes of garbage at offset %d", \
+                end - start, start)
+
+    def checkFrameCrc(self, data, pos, header):
+        side = pos + header.getDataOffset()
+        (stored,) = struct.unpack('>H', data[pos+4:pos+6])
+        crc = crc16Mpeg(data[pos+2:pos+4] + \
+            data[side:side+header.getSideInfoLength()])
+        if crc != stored:
+            self.badCrcs += 1
+
+    def checkInfoTag(self, data, pos, header, audioEnd):
+        tag = findInfoTag(data, pos, header)
+        if tag < 0:
+            return
+
+        # Each field is present only if its flag is set
+        (flags,) = struct.unpack('>I', data[tag+4:tag+8])
+        offset = tag + 8
+        if flags & 0x1:
+            (frames,) = struct.unpack('>I', data[offset:offset+4])
+            offset += 4
+            if frames != self.frames - 1:
+                self.addProblem("info tag declares %d frames but %d were " \
+                    "found", frames, self.frames - 1)
+        if flags & 0x2:
+            (length,) = struct.unpack('>I', data[offset:offset+4])
+            offset += 4
+            if length > len(data) - pos:
+                self.addProblem("info tag declares %d bytes but only %d " \
+                    "follow it", length, len(data) - pos)
+        if flags & 0x4:
+            offset += 100
+        if flags & 0x8:
+            offset += 4
+
+        if data[offset:offset+4] not in Mp3Scan.LAME_TAGGERS or \
+                offset + 36 > pos + header.length:
+            return
+        (musicCrc, tagCrc) = struct.unpack('>HH', data[offset+32:offset+36])
+        if crc16(data[pos:offset+34]) != tagCrc:
+            self.addProblem("LAME tag fails its CRC check")
+        elif self.deep and musicCrc != 0:
+            # A zero music CRC means it wasn't recorded
+            if crc16(data[pos+header.length:audioEnd]) != musicCrc:
+                self.addProblem("audio data fails the LAME music CRC check")
+
+
+class StallError(Exception):
+    pass
+
+
+class SupervisedStream(object):
+    """A decoder's output, read with blocking reads that give up once it
+    has gone 'timeout' seconds without producing anything"""
+
+    def __init__(self, src, timeout=None):
+        self.src = src
+        self.timeout = timeout
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self.timeout:
+                try:
+                    (readable, writable, x) = select.select([self.src], \
+                        [], [], self.timeout)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if not readable:
+                    raise StallError("no progress for %.0f seconds" % \
+                        self.timeout)
+            data = os.read(self.src.fileno(), size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def close(self):
+        self.src.close()
+
+
+class PcmSpool(object):
+    """Decoded 16-bit little-endian PCM spooled to a local file"""
+
+    def __init__(self, path, channels, sampleRate):
+        self.path = path
+        self.channels = channels
+        self.sampleRate = sampleRate
+
+    def getFrameSize(self):
+        return 2 * self.channels
+
+    def getSamples(self):
+        return os.path.getsize(self.path) / self.getFrameSize()
+
+    def getDuration(self):
+        return float(self.getSamples()) / self.sampleRate
+
+    def getLameArgs(self):
+        """Arguments describing the spooled data as raw 'lame' input"""
+        rate = '%g' % (self.sampleRate / 1000.0)
+        mode = (self.channels == 1) and 'm' or 'j'
+        return ['-r', '-s', rate, '--bitwidth', '16', '--signed', \
+            '--little-endian', '-m', mode, '--resample', rate]
+
+    def feed(self, sink, start, end, blockSize=1<<16):
+        """Writes samples [start, end) to 'sink' and closes it"""
+        fd = open(self.path, 'rb')
+        try:
+            fd.seek(start * self.getFrameSize())
+            remaining = (end - start) * self.getFrameSize()
+            while remaining > 0:
+                data = fd.read(min(blockSize, remaining))
+                if not data:
+                    break
+                sink.write(data)
+                remaining -= len(data)
+        except IOError, e:
+            logging.warning("Encoder input closed early: %s", e)
+        finally:
+            fd.close()
+            sink.close()
+
+    @staticmethod
+    def fromWav(src, path):
+        """Spools the WAV stream 'src' to 'path'.
+
+        Returns None if the stream is not 16-bit PCM at a sample rate and
+        channel count that MPEG layer III supports.
+        """
+        if src.read(4) != 'RIFF':
+            return None
+        src.read(4)
+        if src.read(4) != 'WAVE':
+            return None
+
+        fmt = None
+        while True:
+            chunk = src.read(8)
+            if len(chunk) < 8:
+                return None
+            (chunkId, size) = struct.unpack('<4sI', chunk)
+            if chunkId == 'data':
+                break
+            body = src.read(size + (size & 1))
+            if chunkId == 'fmt ':
+                fmt = struct.unpack('<HHIIHH', body[:16])
+        if fmt == None:
+            return None
+
+        (tag, channels, sampleRate, byteRate, align, bits) = fmt
+        valid = [r for rates in MPEG_SAMPLE_RATES.values() for r in rates]
+        if tag not in (1, 0xFFFE) or bits != 16 or channels not in (1, 2) \
+                or sampleRate not in valid:
+            return None
+
+        # Streaming decoders may not know the data length up front
+        if size in (0, 0xFFFFFFFF, 0x7FFFFFFF):
+            size = None
+        dest = open(path, 'wb')
+        try:
+            while size == None or size > 0:
+                data = src.read(size == None and 1<<16 or min(1<<16, size))
+                if not data:
+                    break
+                dest.write(data)
+                if size != None:
+                    size -= len(data)
+        finally:
+            dest.close()
+        return PcmSpool(path, channels, sampleRate)
+
+
+class SegmentError(Exception):
+    pass
+
+
+class SegmentedEncoder(object):
+    """Encodes spooled PCM to one MP3 using several 'lame' processes.
+
+    The stream is cut on frame boundaries into one segment per job. Each
+    segment is encoded with extra lead-in and lead-out audio and without
+    the bit reservoir, so that frames are self-contained and the frames at
+    each cut come from an encoder that had already settled; the surplus
+    frames are dropped when the segments are joined. The first segment's
+    Xing/LAME info frame is then rewritten to describe the joined stream,
+    keeping playback gapless.
+    """
+
+    OVERLAP_FRAMES = 8
+
+    def __init__(self, v, profile, spool, workdir, tagArgs=[]):
+        self.v = v
+        self.profile = profile
+        self.spool = spool
+        self.workdir = workdir
+        self.jobs = max(1, v.getSegmentJobs())
+        self.verify = v.isVerifyingSegments()
+        self.tagArgs = tagArgs
+        self.cpu = 0.0
+        self.lock = threading.Lock()
+
+    def getArgs(self, outpath, first=True):
+        args = self.profile.args + self.spool.getLameArgs()
+        if first:
+            # Only the first segment carries the tag and the info frame
+            args += self.tagArgs
+        else:
+            args += ['-t']
+        return args + ['--nores', '-', outpath]
+
+    def encode(self, outpath):
+        try:
+            self.encodeSegments(outpath)
+            if self.verify and not self.verifyAgainstSinglePass(outpath):
+                return self.encodeSinglePass(outpath)
+        except Exception, e:
+            # Includes a malformed frame in lame's output (IndexError,
+            # struct.error); a single pass encode is always possible
+            logging.warning("Segmented encoding of [%s] failed (%s); " \
+                "encoding in a single pass", outpath, e)
+            return self.encodeSinglePass(outpath)
+        return True
+
+    def encodeSinglePass(self, outpath, tagged=True):
+        args = self.profile.args + self.spool.getLameArgs()
+        if tagged:
+            args += self.tagArgs
+        args += ['-', outpath]
+        fd = open(self.spool.path, 'rb')
+        try:
+            with self.v.limits.cpu:
+                lame = subprocess.Popen(self.v.wrapCommand(args), stdin=fd)
+                self.cpu += cpuTime(waitProcess(lame)) or 0.0
+        finally:
+            fd.close()
+        if lame.returncode != 0:
+            logging.error( "Recieved return code [%d] after conversion!", \
+                lame.returncode )
+            return False
+        return True
+
+    def getBoundaries(self, frameSamples):
+        total = self.spool.getSamples()
+        frames = (total + frameSamples - 1) / frameSamples
+        count = max(1, min(self.jobs, frames / (4 * self.OVERLAP_FRAMES)))
+        return [(frames * i / count) * frameSamples for i in range(count)] + \
+            [total]
+
+    def encodeSegments(self, outpath):
+        # MPEG-1 rates use 1152-sample frames; MPEG-2/2.5 use 576
+        if self.spool.sampleRate in MPEG_SAMPLE_RATES[MPEG_VERSION_1]:
+            frameSamples = 1152
+        else:
+            frameSamples = 576
+        bounds = self.getBoundaries(frameSamples)
+        overlap = self.OVERLAP_FRAMES * frameSamples
+        total = bounds[-1]
+
+        segments = []
+        for i in range(len(bounds) - 1):
+            start = max(0, bounds[i] - overlap)
+            end = min(total, bounds[i+1] + overlap)
+            segpath = os.path.join(self.workdir, 'segment-%d.mp3' % i)
+            segments.append((start, end, segpath))
+
+        # Run the segment encoders concurrently, as CPU slots allow
+        returncodes = [None] * len(segments)
+        threads = []
+        for (i, segment) in enumerate(segments):
+            t = threading.Thread(target=self.encodeSegment, \
+                args=(i, segment, returncodes))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            while t.is_alive():
+                t.join(1.0)
+        for returncode in returncodes:
+            if returncode != 0:
+                raise SegmentError("encoder returned %s" % returncode)
+
+        self.join(segments, bounds, frameSamples, outpath)
+
+    def encodeSegment(self, i, segment, returncodes):
+        (start, end, segpath) = segment
+        with self.v.limits.cpu:
+            lame = subprocess.Popen(self.v.wrapCommand( \
+                self.getArgs(segpath, i == 0)), stdin=subprocess.PIPE)
+            self.spool.feed(lame.stdin, start, end)
+            usage = waitProcess(lame)
+        with self.lock:
+            self.cpu += cpuTime(usage) or 0.0
+        returncodes[i] = lame.returncode
+
+    def join(self, segments, bounds, frameSamples, outpath):
+        out = open(outpath, 'wb')
+        try:
+            prefix = None
+            audio = []
+            for (i, (start, end, segpath)) in enumerate(segments):
+                fd = open(segpath, 'rb')
+                try:
+                    data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                finally:
+                    fd.close()
+
+                offset = skipId3v2(data)
+                frames = scanFrames(data, offset)
+                if not frames:
+                    raise SegmentError("segment %d has no frames" % i)
+                if i == 0:
+                    info = findInfoTag(data, frames[0][0], frames[0][1])
+                    if info < 0:
+                        raise SegmentError("no info frame")
+                    prefix = (data[:offset], data[frames[0][0]: \
+                        frames[0][0] + frames[0][1].length], info - \
+                        frames[0][0])
+                    frames = frames[1:]
+                if frames[0][1].samples != frameSamples:
+                    raise SegmentError("unexpected frame size")
+
+                # Keep only the frames that fall inside this segment
+                first = (bounds[i] - start) / frameSamples
+                if i == len(segments) - 1:
+                    last = len(frames)
+                else:
+                    last = (bounds[i+1] - start) / frameSamples
+                if last > len(frames):
+                    raise SegmentError("segment %d is truncated" % i)
+                audio.append((data, frames[first:last]))
+
+            (tag, infoFrame, infoOffset) = prefix
+            out.write(tag)
+            out.write(self.buildInfoFrame(infoFrame, infoOffset, audio, \
+                bounds[-1]))
+            for (data, frames) in audio:
+                begin = frames[0][0]
+                end = frames[-1][0] + frames[-1][1].length
+                for pos in range(begin, end, 1<<20):
+                    out.write(data[pos:min(end, pos + (1<<20))])
+                data.close()
+        except Exception:
+            out.close()
+            os.remove(outpath)
+            raise
+        out.close()
+
+    def buildInfoFrame(self, frame, offset, audio, totalSamples):
+        frame = bytearray(frame)
+        (flags,) = struct.unpack('>I', str(frame[offset+4:offset+8]))
+        if flags & 0xF != 0xF:
+            raise SegmentError("unsupported info tag flags %x" % flags)
+
+        sizes = [header.length for (data, frames) in audio \
+            for (pos, header) in frames]
+        frameCount = len(sizes)
+        musicLength = len(frame) + sum(sizes)
+
+        # Frame count, byte count and seek table
+        struct.pack_into('>II', frame, offset + 8, frameCount, musicLength)
+        positions = []
+        pos = len(frame)
+        for size in sizes:
+            positions.append(pos)
+            pos += size
+        for i in range(100):
+            target = positions[min(frameCount - 1, i * frameCount / 100)]
+            frame[offset + 16 + i] = min(255, 256 * target / musicLength)
+
+        lame = offset + 120
+        if frame[lame:lame+4] != 'LAME':
+            raise SegmentError("no LAME extension")
+
+        # Encoder delay is unchanged; padding covers the joined stream
+        (delayPadding,) = struct.unpack('>I', '\0' + \
+            str(frame[lame+21:lame+24]))
+        delay = delayPadding >> 12
+        padding = frameCount * audio[0][1][0][1].samples - delay - \
+            totalSamples
+        if padding < 0 or padding > 0xFFF:
+            raise SegmentError("padding %d is out of range" % padding)
+        frame[lame+21:lame+24] = struct.pack('>I', \
+            (delay << 12) | padding)[1:]
+
+        # The music CRC is cleared rather than recomputed byte-by-byte in
+        # Python; the tag CRC covers everything that precedes it
+        struct.pack_into('>IH', frame, lame + 28, musicLength, 0)
+        struct.pack_into('>H', frame, lame + 34, \
+            crc16(str(frame[:lame+34])))
+        return str(frame)
+
+    def verifyAgainstSinglePass(self, outpath):
+        """Compares the joined output with a single-pass encode"""
+        reference = os.path.join(self.workdir, 'reference.mp3')
+        if not self.encodeSinglePass(reference, False):
+            return True
+
+        results = []
+        for path in (outpath, reference):
+            fd = open(path, 'rb')
+            try:
+                data = fd.read()
+            finally:
+                fd.close()
+            frames = scanFrames(data, skipId3v2(data))
+            info = findInfoTag(data, frames[0][0], frames[0][1])
+            lame = info + 120
+            (delayPadding,) = struct.unpack('>I', '\0' + data[lame+21:lame+24])
+            results.append((len(frames) - 1, frames[1][1].sampleRate, \
+                frames[1][1].samples * (len(frames) - 1) - \
+                (delayPadding >> 12) - (delayPadding & 0xFFF)))
+        os.remove(reference)
+
+        if results[0] != results[1]:
+            logging.error("Segmented output [%s] does not match a single " \
+                "pass encode (frames, rate, samples): %s != %s", outpath, \
+                results[0], results[1])
+            return False
+        logging.info("Segmented output [%s] matches a single pass encode " \
+            "(%d frames, %d samples)", outpath, results[0][0], results[0][2])
+        return True
+
+
+class EncoderProfile(object):
+    """An encoder command line and the location of its output files.
+
+    Without an output directory, output is written alongside the source;
+    otherwise it is written beneath 'outdir' at the source's path relative
+    to the directory being validated.
+    """
+
+    def __init__(self, name, args, ext, outdir=None, cost=0.05):
+        self.name = name
+        self.args = args
+        self.ext = ext
+        self.outdir = outdir
+        self.cost = cost
+
+    def isMp3(self):
+        return self.ext == 'mp3'
+
+    def isLame(self):
+        return os.path.basename(self.args[0]) == 'lame'
+
+    def getTagArgs(self, tagSize):
+        """Arguments reserving 'tagSize' bytes for an ID3v2 tag"""
+        if tagSize == None or not self.isLame():
+            return []
+        return ['--id3v2-only', '--pad-id3v2-size', str(tagSize)]
+
+    def getArgs(self, outpath, tagSize=None):
+        return self.args + self.getTagArgs(tagSize) + ['-', outpath]
+
+    def getOutputPath(self, v, audioFile):
+        outpath = audioFile.getOutputFilename(self.ext)
+        if self.outdir == None:
+            return outpath
+        return os.path.join(self.outdir, v.relativePath(outpath))
+
+
+# Available '--target' profiles: (encoder arguments, output extension,
+# estimated CPU seconds per second of CD-quality audio)
+ENCODER_PROFILES = {
+    'mp3': (['lame', '-h', '-v'], 'mp3', 0.05),
+    'v0': (['lame', '-h', '-V', '0'], 'mp3', 0.06),
+    'v5': (['lame', '-h', '-V', '5'], 'mp3', 0.04),
+    'opus': (['opusenc', '--quiet', '--bitrate', '96'], 'opus', 0.02),
+    }
+
+def buildProfile(spec):
+    """Builds an 'EncoderProfile' from a 'NAME[:DIR]' specification"""
+    (name, sep, outdir) = spec.partition(':')
+    if not name in ENCODER_PROFILES:
+        raise ValueError("Unknown target profile [%s]" % name)
+
+    (args, ext, cost) = ENCODER_PROFILES[name]
+    if outdir:
+        outdir = os.path.abspath(os.path.expanduser(outdir))
+    else:
+        outdir = None
+    return EncoderProfile(name, list(args), ext, outdir, cost)
+
+
+def buildTargets(specs):
+    """Builds the profiles for 'NAME[:DIR]' specifications, refusing any
+    two that would write the same output files"""
+    targets = []
+    written = {}
+    for spec in specs:
+        profile = buildProfile(spec)
+        key = (profile.outdir, profile.ext)
+        if key in written:
+            raise ValueError("Targets [%s] and [%s] would both write " \
+                "[%s] files %s" % (written[key], spec, profile.ext, \
+                profile.outdir and "beneath [%s]" % profile.outdir or \
+                "alongside the source"))
+        written[key] = spec
+        targets.append(profile)
+    return targets
+
+
+def estimateTagSize(frames, slack=1024):
+    """Upper bound on the size of an ID3v2 tag holding 'frames'"""
+    size = 10 + slack
+    for frame in frames:
+        # Frame header, encoding byte and terminators
+        size += 16
+        if isinstance(frame, mutagen.id3.APIC):
+            size += len(frame.data) + len(frame.mime) + \
+                3 * len(frame.desc or u'')
+        elif isinstance(frame, mutagen.id3.TextFrame):
+            size += sum(3 * len(unicode(t)) + 2 for t in frame.text)
+        else:
+            size += 256
+    return size
+
+
+def keepPadding(info):
+    """'mutagen' padding policy that never shrinks an existing tag"""
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+
+class FileProcessor(object):
     VALID_EXTENSIONS = {
         'mp3': None,
         'wav': WavAudioFile,
@@ -201,20 +1490,63 @@ class FileProcessorThread(threading.Thread):
         }
 
     def __init__(self, v, path):
-        super(FileProcessorThread, self).__init__()
         self.v = v
-        self.sem = None
         self.path = path
-
-    def setSem(self, sem):
-        self.sem = sem
-
-    def run(self):
-        self.process()
-
-        # Release the semaphore
-        if self.sem != None:
-            self.sem.release()
+        self.stat = None
+        self.digest = None
+        self.converter = None
+
+    def __call__(self):
+        outcome = self.begin()
+        if outcome == None:
+            outcome = self.process()
+            self.finish(outcome)
+        return outcome
+
+    def begin(self):
+        """Returns OUTCOME_UNCHANGED if the manifest says to skip the file"""
+        manifest = self.v.getManifest()
+        if manifest == None:
+            return None
+
+        if self.stat == None:
+            self.stat = os.stat(self.path)
+        if manifest.isHashing():
+            with self.v.limits.io:
+                self.digest = hashPath(self.path)
+            if manifest.isUnchanged(self.path, self.stat, self.digest):
+                logging.debug("Skipping unchanged file [%s]", self.path)
+                if not self.v.isSimulation():
+                    manifest.touch(self.path, self.stat)
+                return OUTCOME_UNCHANGED
+        return None
+
+    def finish(self, outcome):
+        manifest = self.v.getManifest()
+        if manifest != None and not self.v.isSimulation():
+            manifest.record(self.path, self.stat, outcome, self.digest)
+
+    def abort(self, reason):
+        conv = self.converter
+        if conv != None:
+            conv.abort(reason)
+
+    def getConverter(self):
+        """Returns the converter for this file, or None if not converted"""
+        convType = FileProcessor.VALID_EXTENSIONS.get(self.getExtension())
+        if convType == None:
+            return None
+        return convType(self.path)
+
+    def getExtension(self):
+        (root, ext) = os.path.splitext(os.path.basename(self.path))
+        return ext.lower()[1:]
+
+    def estimateCost(self):
+        convType = FileProcessor.VALID_EXTENSIONS.get(self.getExtension())
+        if convType == None:
+            return 0.0
+        return convType(self.path).estimateCost(self.v)
 
     def process(self):
         # Parse the path name
@@ -222,18 +1554,1500 @@ class FileProcessorThread(threading.Thread):
         (root, ext) = os.path.splitext(base)
         logging.debug("Basename=[%s]; root=[%s]; ext=[%s];", base, root, ext)
 
-        ext = ext.lower()[1:]
-        if ext in FileProcessorThread.VALID_EXTENSIONS:
-            convType = FileProcessorThread.VALID_EXTENSIONS[ext]
-            if convType != None:
-                conv = convType(self.path)
-
-                # Run the converter
-                logging.info("Running converter [%s] on file [%s]...", \
-                    conv.t, self.v.nameForPath(self.path))
-                conv.convert(self.v)
+        ext = self.getExtension()
+        if ext in FileProcessor.VALID_EXTENSIONS:
+            convType = FileProcessor.VALID_EXTENSIONS[ext]
+            if convType == None:
+                if ext == 'mp3' and self.v.isCheckingMp3():
+                    return self.checkMp3()
+                return OUTCOME_SKIPPED
+
+            conv = convType(self.path)
+            self.converter = conv
+
+            # Run the converter
+            logging.info("Running converter [%s] on file [%s]...", \
+                conv.t, self.v.nameForPath(self.path))
+            if not conv.convert(self.v):
+                return OUTCOME_FAILED
+            return OUTCOME_CONVERTED
         else:
             self.v.deletePath(self.path)
+            return OUTCOME_DELETED
+
+    def checkMp3(self):
+        with self.v.metrics.stage(self.path, 'scan') as stage:
+            stage.bytesIn = fileSize(self.path)
+            scan = Mp3Scan(self.path, self.v.isDeepChecking()).run()
+        if not scan.isDamaged():
+            logging.debug("Verified %d frames in [%s]", scan.frames, \
+                self.path)
+            return OUTCOME_VERIFIED
+
+        logging.warning("Damaged MP3 [%s]: %s", \
+            self.v.nameForPath(self.path), '; '.join(scan.problems))
+        self.v.quarantinePath(self.path)
+        return OUTCOME_DAMAGED
+
+
+# The outputs of every target profile are left alone, like MP3s
+for (args, ext, cost) in ENCODER_PROFILES.values():
+    FileProcessor.VALID_EXTENSIONS.setdefault(ext, None)
+
+
+class DedupEntry(object):
+    """Outputs of the first job to encode a particular audio stream"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = threading.Event()
+        self.success = False
+        self.outputs = {}
+        self.tagKey = None
+        self.cpu = 0.0
+
+
+class Deduplicator(object):
+    """Encodes each unique audio stream once per run.
+
+    The first job to claim a fingerprint encodes it; later jobs with the
+    same fingerprint wait for it and then clone its outputs, hardlinking
+    when the tags are also identical and otherwise reflinking (or copying)
+    and rewriting the tags.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.cloned = 0
+        self.cpuSaved = 0.0
+        self.bytesSaved = 0
+
+    def claim(self, audioFile):
+        """Returns (entry, True if the caller should encode it)"""
+        fingerprint = audioFile.getFingerprint()
+        logging.debug("Fingerprint of [%s] is [%s]", audioFile.path, \
+            fingerprint)
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry != None:
+                return (entry, False)
+            entry = DedupEntry(audioFile.path)
+            self.entries[fingerprint] = entry
+            return (entry, True)
+
+    def complete(self, entry, success, targets, frames, cpu):
+        entry.success = success
+        entry.outputs = dict((profile.name, outpath) \
+            for (profile, outpath) in targets)
+        entry.tagKey = tagKey(frames)
+        entry.cpu = cpu
+        entry.done.set()
+
+    def clone(self, entry, audioFile, targets, frames, v):
+        """Clones the entry's outputs to 'targets'; False if it can't"""
+        while not entry.done.is_set():
+            entry.done.wait(1.0)
+        if not entry.success:
+            return False
+        for (profile, outpath) in targets:
+            if not os.path.isfile(entry.outputs.get(profile.name, '')):
+                return False
+
+        sameTags = (entry.tagKey == tagKey(frames))
+        logging.info("Cloning [%s] from duplicate [%s]...", \
+            v.nameForPath(audioFile.path), v.nameForPath(entry.path))
+        saved = 0
+        for (profile, outpath) in targets:
+            source = entry.outputs[profile.name]
+            with v.limits.io, v.metrics.stage(audioFile.path, 'clone') \
+                    as stage:
+                stage.bytesIn = fileSize(source)
+                if (sameTags or not profile.isMp3()) and \
+                        linkFile(source, outpath):
+                    saved += fileSize(outpath)
+                    continue
+                if reflinkFile(source, outpath):
+                    saved += fileSize(outpath)
+                stage.bytesOut = fileSize(outpath)
+            if profile.isMp3() and not sameTags:
+                audioFile.copyTagsTo(outpath, v, frames)
+
+        with self.lock:
+            self.cloned += 1
+            self.cpuSaved += entry.cpu
+            self.bytesSaved += saved
+        return True
+
+    def log(self):
+        with self.lock:
+            logging.info("Deduplicated %d file(s): saved %.0fs of CPU and " \
+                "%.1f MB of disk", self.cloned, self.cpuSaved, \
+                self.bytesSaved / 1e6)
+
+
+def tagKey(frames):
+    """Digest identifying a set of ID3 frames"""
+    return hashlib.sha1(repr(sorted(repr(f) for f in frames))).hexdigest()
+
+
+def linkFile(source, dest):
+    try:
+        os.link(source, dest)
+        return True
+    except OSError, e:
+        logging.debug("Unable to link [%s]: %s", dest, e)
+        return False
+
+
+def reflinkFile(source, dest):
+    """Copies 'source' sharing its blocks if possible; True if shared"""
+    null = open(os.devnull, 'w')
+    try:
+        if subprocess.call(['cp', '--reflink=always', source, dest], \
+                stderr=null) == 0:
+            return True
+    except OSError:
+        pass
+    finally:
+        null.close()
+    shutil.copyfile(source, dest)
+    return False
+
+
+class Manifest(object):
+    """On-disk (SQLite) record of the outcome of each processed file.
+
+    Files are keyed by path and matched on size and modification time; if
+    hashing is enabled, a file whose size or time changed but whose content
+    hash did not is also treated as unchanged. Files that failed are always
+    retried.
+    """
+
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path, hashing=False):
+        self.path = path
+        self.hashing = hashing
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime REAL NOT NULL,'
+            ' hash TEXT,'
+            ' outcome TEXT NOT NULL,'
+            ' updated REAL NOT NULL)')
+        self.db.commit()
+
+    def isHashing(self):
+        return self.hashing
+
+    def lookup(self, path):
+        with self.lock:
+            return self.db.execute(
+                'SELECT size, mtime, hash, outcome FROM files WHERE path=?',
+                (path,)).fetchone()
+
+    def isUnchanged(self, path, st, digest=None):
+        row = self.lookup(path)
+        if row == None:
+            return False
+
+        (size, mtime, oldDigest, outcome) = row
+        if outcome in (OUTCOME_FAILED, OUTCOME_DAMAGED):
+            return False
+        if size == st.st_size and mtime == st.st_mtime:
+            return True
+        return (digest != None) and (digest == oldDigest)
+
+    def touch(self, path, st):
+        self.execute('UPDATE files SET size=?, mtime=? WHERE path=?',
+            (st.st_size, st.st_mtime, path))
+
+    def record(self, path, st, outcome, digest=None):
+        self.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (path, st.st_size, st.st_mtime, digest, outcome, time.time()))
+
+    def execute(self, sql, params):
+        with self.lock:
+            self.db.execute(sql, params)
+            self.pending += 1
+            if self.pending >= Manifest.COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class JobTable(object):
+    """Lease-based (SQLite) table of files to process, for 'Coordinator'.
+
+    Workers claim pending jobs for 'leaseTime' seconds and extend their
+    leases by heartbeating; a job whose lease expires is handed to another
+    worker, at most 'maxAttempts' times. Only the current leaseholder may
+    commit to or report on a job.
+    """
+
+    STATE_PENDING = 'pending'
+    STATE_LEASED = 'leased'
+    STATE_DONE = 'done'
+
+    def __init__(self, path=':memory:', leaseTime=DEFAULT_LEASE_TIME, \
+            maxAttempts=3):
+        self.leaseTime = leaseTime
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        self.sealed = False
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id INTEGER PRIMARY KEY,'
+            ' path TEXT UNIQUE NOT NULL,'
+            ' type TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' state TEXT NOT NULL,'
+            ' worker TEXT,'
+            ' expires REAL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' outcome TEXT)')
+
+        # Leases from a previous run are void
+        self.db.execute('UPDATE jobs SET state=?, worker=NULL WHERE state=?',
+            (JobTable.STATE_PENDING, JobTable.STATE_LEASED))
+        self.db.commit()
+
+    def add(self, path, t, size):
+        """Adds a pending job; returns its id, or None if already known"""
+        with self.lock:
+            cursor = self.db.execute('INSERT OR IGNORE INTO jobs '
+                '(path, type, size, state) VALUES (?, ?, ?, ?)',
+                (path, t, size, JobTable.STATE_PENDING))
+            self.db.commit()
+            if cursor.rowcount == 0:
+                return None
+            return cursor.lastrowid
+
+    def seal(self):
+        """Marks the table complete; no more jobs will be added"""
+        self.sealed = True
+
+    def expireLeases(self):
+        """Re-queues the jobs whose leases have expired; returns the (id,
+        path) of those given up on instead"""
+        with self.lock:
+            gaveUp = self.expire(time.time())
+            self.db.commit()
+        return gaveUp
+
+    def expire(self, now):
+        gaveUp = []
+        for (jobId, path, worker, attempts) in self.db.execute(
+                'SELECT id, path, worker, attempts FROM jobs '
+                'WHERE state=? AND expires<?',
+                (JobTable.STATE_LEASED, now)).fetchall():
+            if attempts >= self.maxAttempts:
+                logging.error("Giving up on [%s] after %d expired leases", \
+                    path, attempts)
+                self.db.execute('UPDATE jobs SET state=?, outcome=? '
+                    'WHERE id=?', (JobTable.STATE_DONE, OUTCOME_FAILED, jobId))
+                gaveUp.append((jobId, path))
+            else:
+                logging.warning("Lease on [%s] held by [%s] expired; " \
+                    "reassigning it", path, worker)
+                self.db.execute('UPDATE jobs SET state=?, worker=NULL '
+                    'WHERE id=?', (JobTable.STATE_PENDING, jobId))
+        return gaveUp
+
+    def claim(self, worker, count, largestFirst=False):
+        """Leases up to 'count' pending jobs to 'worker'; expired leases
+        are left to 'expireLeases'"""
+        order = largestFirst and 'size DESC' or 'id'
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute('SELECT id, path, type, size FROM jobs '
+                'WHERE state=? ORDER BY %s LIMIT ?' % order,
+                (JobTable.STATE_PENDING, count)).fetchall()
+            for row in rows:
+                self.db.execute('UPDATE jobs SET state=?, worker=?, '
+                    'expires=?, attempts=attempts+1 WHERE id=?',
+                    (JobTable.STATE_LEASED, worker, now + self.leaseTime,
+                     row[0]))
+            self.db.commit()
+        return [list(row) for row in rows]
+
+    def isHeld(self, worker, jobId):
+        row = self.db.execute('SELECT worker, expires FROM jobs '
+            'WHERE id=? AND state=?', (jobId, JobTable.STATE_LEASED)).fetchone()
+        return row != None and row[0] == worker and row[1] >= time.time()
+
+    def heartbeat(self, worker, jobIds):
+        """Extends the worker's leases; returns the ids it no longer holds"""
+        lost = []
+        with self.lock:
+            for jobId in jobIds:
+                if self.isHeld(worker, jobId):
+                    self.db.execute('UPDATE jobs SET expires=? WHERE id=?',
+                        (time.time() + self.leaseTime, jobId))
+                else:
+                    lost.append(jobId)
+            self.db.commit()
+        return lost
+
+    def commit(self, worker, jobId):
+        """Confirms the lease before an irreversible step (e.g. deleting
+        the source), extending it; False if the job was reassigned"""
+        return len(self.heartbeat(worker, [jobId])) == 0
+
+    def report(self, worker, jobId, outcome):
+        """Completes a job; returns its path, or None if not leaseholder"""
+        with self.lock:
+            if not self.isHeld(worker, jobId):
+                return None
+            self.db.execute('UPDATE jobs SET state=?, outcome=?, worker=NULL '
+                'WHERE id=?', (JobTable.STATE_DONE, outcome, jobId))
+            self.db.commit()
+            return self.db.execute('SELECT path FROM jobs WHERE id=?',
+                (jobId,)).fetchone()[0]
+
+    def getCounts(self):
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def isFinished(self):
+        if not self.sealed:
+            return False
+        counts = self.getCounts()
+        return counts.get(JobTable.STATE_PENDING, 0) == 0 and \
+            counts.get(JobTable.STATE_LEASED, 0) == 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def waitProcess(proc):
+    """Waits for 'proc' and returns its resource usage, if available"""
+    if proc.returncode != None:
+        return None
+    try:
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+    except OSError:
+        proc.wait()
+        return None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return usage
+
+
+def cpuTime(usage):
+    if usage == None:
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+
+# 'resource.RUSAGE_THREAD' is missing from Python 2, but Linux supports it
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', \
+    sys.platform.startswith('linux') and 1 or None)
+
+def threadCpuTime():
+    """CPU time used by the calling thread, or None if unavailable"""
+    if RUSAGE_THREAD == None:
+        return None
+    return cpuTime(resource.getrusage(RUSAGE_THREAD))
+
+
+def fileSize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class StageTimer(object):
+    """Context manager recording the wall and CPU time of a stage"""
+
+    def __init__(self, metrics, path, stage):
+        self.metrics = metrics
+        self.path = path
+        self.stage = stage
+        self.bytesIn = None
+        self.bytesOut = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpuStart = threadCpuTime()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        cpu = None
+        if self.cpuStart != None:
+            cpu = threadCpuTime() - self.cpuStart
+        self.metrics.record(self.path, self.stage, time.time() - self.start, \
+            cpu, self.bytesIn, self.bytesOut, excType != None and 1 or 0)
+        return False
+
+
+class Metrics(object):
+    """Per-file, per-stage timing and throughput records.
+
+    Records are aggregated per stage for the summary table and, if a path
+    is set, streamed as JSON lines.
+    """
+
+    FIELDS = ('count', 'failed', 'wall', 'cpu', 'bytesIn', 'bytesOut')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.jsonFile = None
+
+    def setJsonPath(self, path):
+        self.jsonFile = open(path, 'a')
+
+    def stage(self, path, stage):
+        return StageTimer(self, path, stage)
+
+    def record(self, path, stage, wall, cpu=None, bytesIn=None, \
+            bytesOut=None, returncode=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, dict.fromkeys( \
+                Metrics.FIELDS, 0))
+            totals['count'] += 1
+            totals['failed'] += (returncode != 0) and 1 or 0
+            totals['wall'] += wall
+            totals['cpu'] += cpu or 0.0
+            totals['bytesIn'] += bytesIn or 0
+            totals['bytesOut'] += bytesOut or 0
+
+            if self.jsonFile != None:
+                self.jsonFile.write(json.dumps({'time': time.time(), \
+                    'path': path, 'stage': stage, 'wall': wall, 'cpu': cpu, \
+                    'bytesIn': bytesIn, 'bytesOut': bytesOut, \
+                    'returncode': returncode}) + '\n')
+
+    def log(self, pool):
+        with self.lock:
+            stages = dict((k, dict(v)) for (k, v) in self.stages.items())
+        if stages:
+            logging.info("%-16s %6s %6s %10s %10s %10s %10s %8s", 'Stage', \
+                'Count', 'Failed', 'Wall (s)', 'CPU (s)', 'In (MB)', \
+                'Out (MB)', 'MB/s')
+        for name in sorted(stages):
+            t = stages[name]
+            rate = t['wall'] and (t['bytesIn'] / t['wall'] / 1e6) or 0.0
+            logging.info("%-16s %6d %6d %10.1f %10.1f %10.1f %10.1f %8.1f", \
+                name, t['count'], t['failed'], t['wall'], t['cpu'], \
+                t['bytesIn'] / 1e6, t['bytesOut'] / 1e6, rate)
+        logging.info("Workers: %d; utilisation %.0f%%; queue depth " \
+            "average %.1f, maximum %d", pool.workers, \
+            100 * pool.getUtilisation(), pool.getAverageDepth(), \
+            pool.maxDepth)
+
+    def writeRun(self, pool):
+        if self.jsonFile == None:
+            return
+        with self.lock:
+            self.jsonFile.write(json.dumps({'time': time.time(), \
+                'stage': 'run', 'workers': pool.workers, \
+                'utilisation': pool.getUtilisation(), \
+                'queueDepthAverage': pool.getAverageDepth(), \
+                'queueDepthMax': pool.maxDepth, \
+                'outcomes': pool.summary.getCounts()}) + '\n')
+            self.jsonFile.flush()
+
+    def writePrometheus(self, path, pool):
+        """Writes a node_exporter textfile collector file (atomically)"""
+        with self.lock:
+            stages = dict((k, dict(v)) for (k, v) in self.stages.items())
+
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append('# HELP validate_audio_%s %s' % (name, text))
+            lines.append('# TYPE validate_audio_%s %s' % (name, kind))
+            for (labels, value) in samples:
+                lines.append('validate_audio_%s%s %s' % (name, labels, \
+                    repr(float(value))))
+
+        for (field, name, text) in ( \
+                ('count', 'stage_runs', 'Stage executions'), \
+                ('failed', 'stage_failures', 'Stage failures'), \
+                ('wall', 'stage_wall_seconds', 'Stage wall time'), \
+                ('cpu', 'stage_cpu_seconds', 'Stage CPU time'), \
+                ('bytesIn', 'stage_read_bytes', 'Stage input bytes'), \
+                ('bytesOut', 'stage_written_bytes', 'Stage output bytes')):
+            metric(name, 'gauge', text + ' in the last run', \
+                [('{stage="%s"}' % k, stages[k][field]) for k in \
+                sorted(stages)])
+        counts = pool.summary.getCounts()
+        metric('files', 'gauge', 'Files by outcome in the last run', \
+            [('{outcome="%s"}' % k, counts[k]) for k in sorted(counts)])
+        metric('workers', 'gauge', 'Worker threads', [('', pool.workers)])
+        metric('worker_utilisation', 'gauge', 'Fraction of worker time ' \
+            'spent running jobs', [('', pool.getUtilisation())])
+        metric('queue_depth_max', 'gauge', 'Maximum job queue depth', \
+            [('', pool.maxDepth)])
+        metric('last_run_timestamp_seconds', 'gauge', 'Completion time of ' \
+            'the last run', [('', time.time())])
+
+        tmp = path + '.tmp'
+        fd = open(tmp, 'w')
+        try:
+            fd.write('\n'.join(lines) + '\n')
+        finally:
+            fd.close()
+        os.rename(tmp, path)
+
+    def close(self):
+        if self.jsonFile != None:
+            self.jsonFile.close()
+            self.jsonFile = None
+
+
+class Summary(object):
+    """Thread-safe tally of the outcomes of processed jobs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    def count(self, outcome):
+        with self.lock:
+            return self.counts.get(outcome, 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def getCounts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def log(self):
+        with self.lock:
+            counts = dict(self.counts)
+        logging.info("Processed %d file(s): %s", sum(counts.values()), \
+            ', '.join('%s=%d' % (k, counts[k]) for k in sorted(counts)) \
+            or 'nothing to do')
+
+
+class InotifyWatcher(object):
+    """Recursive watch for files finished being written to, or moved into,
+    a set of directory trees (Linux 'inotify', through 'ctypes')."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x00080000
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or \
+            'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.roots = []
+
+    def count(self):
+        return len(self.watches)
+
+    def add(self, path):
+        mask = InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_TO | \
+            InotifyWatcher.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            logging.error("Unable to watch [%s]: %s", path, \
+                os.strerror(ctypes.get_errno()))
+            return
+        self.watches[wd] = path
+
+    def addTree(self, top):
+        if not top in self.roots:
+            self.roots.append(top)
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            self.add(dirpath)
+
+    def read(self, timeout=None):
+        """Waits up to 'timeout' seconds for events.
+
+        Returns a list of (path, True if it is a directory to be scanned).
+        """
+        try:
+            (readable, w, x) = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 1<<16)
+        results = []
+        offset = 0
+        while offset + InotifyWatcher.EVENT.size <= len(data):
+            (wd, mask, cookie, length) = InotifyWatcher.EVENT.unpack_from( \
+                data, offset)
+            offset += InotifyWatcher.EVENT.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                logging.warning("Missed events; rescanning...")
+                results += [(root, True) for root in self.roots]
+                continue
+            if mask & InotifyWatcher.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if not wd in self.watches:
+                continue
+
+            path = os.path.join(self.watches[wd], name)
+            if mask & InotifyWatcher.IN_ISDIR:
+                if mask & (InotifyWatcher.IN_CREATE | \
+                        InotifyWatcher.IN_MOVED_TO):
+                    self.addTree(path)
+                    self.roots.remove(path)
+                    results.append((path, True))
+            elif mask & (InotifyWatcher.IN_CLOSE_WRITE | \
+                    InotifyWatcher.IN_MOVED_TO):
+                results.append((path, False))
+        return results
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Pipeline(object):
+    """A decoder feeding one or more encoders.
+
+    The decoded stream is copied to the encoders through non-blocking
+    pipes, so a decoder that fails or stalls is caught before the encoders
+    see the end of their input: everything is killed and the partial
+    output removed. Driven by 'run' from a worker thread, or by
+    'EventEngine'.
+    """
+
+    def __init__(self, v, conv, targets, timeout=None):
+        self.v = v
+        self.conv = conv
+        self.targets = targets
+        self.timeout = timeout
+        self.start = time.time()
+        self.progress = self.start
+        self.usage = {}
+        self.eof = False
+        self.error = None
+        self.encoders = []
+        self.sinks = []
+        self.pcmBytes = 0
+        self.aborted = None
+
+        self.src = conv.getRawStream(v)
+        self.decoder = conv.decoder
+        try:
+            args = [v.wrapCommand(profile.getArgs(outpath, conv.tagSize)) \
+                for (profile, outpath) in targets]
+            if len(targets) == 1 and self.decoder == None:
+                # Nothing to supervise; the encoder reads the file itself
+                self.encoders.append(subprocess.Popen(args[0], \
+                    stdin=self.src))
+                self.src.close()
+                self.src = None
+                self.pcmBytes = None
+                return
+            for a in args:
+                encoder = subprocess.Popen(a, stdin=subprocess.PIPE)
+                self.encoders.append(encoder)
+                setNonBlocking(encoder.stdin.fileno())
+                self.sinks.append([encoder.stdin, ''])
+        except Exception:
+            self.fail("unable to start the encoders")
+            raise
+
+    def getProcesses(self):
+        if self.decoder == None:
+            return self.encoders[:]
+        return [self.decoder] + self.encoders
+
+    def getCpu(self):
+        return sum(cpuTime(u) or 0.0 for u in self.usage.values())
+
+    def getReaders(self):
+        # Only read more once every encoder has taken the last block
+        if self.src == None or [s for s in self.sinks if s[1]]:
+            return []
+        return [self.src]
+
+    def getWriters(self):
+        return [sink for (sink, pending) in self.sinks if pending]
+
+    def isFeeding(self):
+        return self.src != None or len(self.getWriters()) > 0
+
+    def pump(self, readable, writable):
+        if self.src != None and self.src in readable:
+            data = os.read(self.src.fileno(), 1<<16)
+            if data:
+                self.pcmBytes += len(data)
+                self.progress = time.time()
+                for s in self.sinks:
+                    s[1] = data
+            else:
+                self.eof = True
+                self.src.close()
+                self.src = None
+
+        for s in list(self.sinks):
+            (sink, pending) = s
+            if not pending or sink not in writable:
+                continue
+            try:
+                s[1] = pending[os.write(sink.fileno(), pending):]
+                self.progress = time.time()
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                logging.warning("Encoder input closed early: %s", e)
+                self.sinks.remove(s)
+                sink.close()
+
+        if self.src != None and not self.sinks:
+            # Every encoder has gone; stop decoding
+            self.src.close()
+            self.src = None
+
+    def reap(self):
+        """Collects exited processes and enforces the pipeline's health.
+
+        Returns True once every process has exited.
+        """
+        for proc in self.getProcesses():
+            if proc.returncode != None:
+                continue
+            try:
+                (pid, status, usage) = os.wait4(proc.pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                proc.returncode = 0
+                continue
+            if pid == 0:
+                continue
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            self.usage[proc] = usage
+
+        decoder = self.decoder
+        running = [p for p in self.getProcesses() if p.returncode == None]
+        if self.error == None:
+            if self.aborted != None:
+                self.fail(self.aborted)
+            elif decoder != None and decoder.returncode not in (None, 0):
+                self.fail("decoder exited with status %d" % \
+                    decoder.returncode)
+            elif running and self.timeout and \
+                    time.time() - self.progress > self.timeout:
+                self.fail("no progress for %.0f seconds" % self.timeout)
+
+        # Only let the encoders finish once the decoder has succeeded
+        if self.eof and self.error == None and \
+                (decoder == None or decoder.returncode == 0):
+            for s in list(self.sinks):
+                if not s[1]:
+                    self.sinks.remove(s)
+                    s[0].close()
+
+        if decoder != None and decoder.returncode == None and \
+                not [e for e in self.encoders if e.returncode == None]:
+            # Nothing is reading the decoder any more
+            self.kill(decoder)
+        return not [p for p in self.getProcesses() if p.returncode == None]
+
+    def run(self):
+        """Supervises the pipeline from the calling thread until it exits"""
+        interval = min(self.timeout or 1.0, 1.0)
+        while not self.reap():
+            if self.isFeeding():
+                try:
+                    (readable, writable, x) = select.select( \
+                        self.getReaders(), self.getWriters(), [], interval)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                self.pump(readable, writable)
+            elif self.decoder != None and self.decoder.returncode == None:
+                # The decoder has closed its output; give it time to exit
+                time.sleep(0.01)
+            else:
+                for encoder in self.encoders:
+                    if encoder.returncode == None:
+                        self.usage[encoder] = waitProcess(encoder)
+
+    def abort(self, reason):
+        """Kills the pipeline's processes from another thread; the owning
+        thread fails it when it next reaps them"""
+        self.aborted = reason
+        for proc in self.getProcesses():
+            self.kill(proc)
+
+    def fail(self, reason):
+        """Kills the whole pipeline"""
+        self.error = reason
+        if self.src != None:
+            self.src.close()
+            self.src = None
+        for (sink, pending) in self.sinks:
+            sink.close()
+        self.sinks = []
+        for proc in self.getProcesses():
+            self.kill(proc)
+
+    def kill(self, proc):
+        if proc.returncode == None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def complete(self):
+        """Records metrics; returns True if every process succeeded.
+
+        The outputs of a failed pipeline are removed.
+        """
+        v = self.v
+        wall = time.time() - self.start
+        success = (self.error == None)
+        if not success:
+            logging.error("Aborted conversion of [%s]: %s", \
+                self.conv.nameForLog(v), self.error)
+        if self.decoder != None:
+            v.metrics.record(self.conv.path, 'decode:%s' % self.conv.t, \
+                wall, cpuTime(self.usage.get(self.decoder)), \
+                fileSize(self.conv.path), self.pcmBytes, \
+                self.decoder.returncode)
+        for ((profile, outpath), encoder) in zip(self.targets, self.encoders):
+            v.metrics.record(self.conv.path, 'encode:%s' % profile.name, \
+                wall, cpuTime(self.usage.get(encoder)), self.pcmBytes, \
+                fileSize(outpath), encoder.returncode)
+            if encoder.returncode != 0 and self.error == None:
+                logging.error( "Recieved return code [%d] after %s " \
+                    "conversion!", encoder.returncode, profile.name )
+                success = False
+
+        if not success:
+            for (profile, outpath) in self.targets:
+                if os.path.exists(outpath):
+                    logging.info("Removing partial output [%s]", outpath)
+                    os.remove(outpath)
+        return success
+
+
+class EventEngine(object):
+    """Single-threaded alternative to 'WorkerPool'.
+
+    Conversions run as subprocess pipelines supervised from one event loop
+    (woken by SIGCHLD), capped at 'workers' at once; cheap jobs such as
+    deletes and skips run inline, without a thread each. Segmented and
+    deduplicated conversions are not supported.
+    """
+
+    def __init__(self, v, workers):
+        self.v = v
+        self.workers = max(1, workers)
+        self.summary = Summary()
+        self.pipelines = []
+        self.started = time.time()
+        self.finished = None
+        self.busy = 0.0
+        self.maxDepth = 0
+        self.aborted = False
+
+    def getUtilisation(self):
+        elapsed = (self.finished or time.time()) - self.started
+        if elapsed <= 0:
+            return 0.0
+        return min(1.0, self.busy / (elapsed * self.workers))
+
+    def getAverageDepth(self):
+        return 0.0
+
+    def run(self, jobs):
+        self.started = time.time()
+        (wakeRead, wakeWrite) = os.pipe()
+        setNonBlocking(wakeRead)
+        setNonBlocking(wakeWrite)
+        oldWakeup = signal.set_wakeup_fd(wakeWrite)
+        oldHandler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        try:
+            jobs = iter(jobs)
+            pending = True
+            while pending or self.pipelines:
+                while pending and not self.aborted and \
+                        len(self.pipelines) < self.workers:
+                    try:
+                        job = jobs.next()
+                    except StopIteration:
+                        pending = False
+                        break
+                    self.startJob(job)
+                if self.aborted:
+                    pending = False
+                if self.pipelines:
+                    self.poll(wakeRead)
+        except KeyboardInterrupt:
+            logging.warning("Interrupted; waiting for running pipelines...")
+            self.aborted = True
+            while self.pipelines:
+                self.poll(wakeRead)
+        finally:
+            signal.set_wakeup_fd(oldWakeup)
+            signal.signal(signal.SIGCHLD, oldHandler)
+            os.close(wakeRead)
+            os.close(wakeWrite)
+            self.finished = time.time()
+
+    def startJob(self, job):
+        try:
+            outcome = job.begin()
+            if outcome == None:
+                conv = job.getConverter()
+                if conv == None:
+                    outcome = job.process()
+                else:
+                    logging.info("Running converter [%s] on file [%s]...", \
+                        conv.t, self.v.nameForPath(job.path))
+                    prepared = conv.prepare(self.v)
+                    if prepared != None:
+                        (targets, frames) = prepared
+                        pipeline = Pipeline(self.v, conv, targets, \
+                            self.v.getStallTimeout())
+                        self.pipelines.append((pipeline, job, frames))
+                        return
+                    outcome = OUTCOME_CONVERTED
+                job.finish(outcome)
+        except Exception:
+            logging.exception("Job [%s] failed", job.path)
+            outcome = OUTCOME_FAILED
+        self.summary.record(outcome)
+
+    def poll(self, wakeRead):
+        readers = [wakeRead]
+        writers = []
+        for (p, job, frames) in self.pipelines:
+            readers += p.getReaders()
+            writers += p.getWriters()
+        try:
+            (readable, writable, x) = select.select(readers, writers, [], 1.0)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            (readable, writable) = ([], [])
+        if wakeRead in readable:
+            try:
+                os.read(wakeRead, 4096)
+            except OSError:
+                pass
+
+        for entry in list(self.pipelines):
+            (p, job, frames) = entry
+            try:
+                p.pump(readable, writable)
+                if not p.reap():
+                    continue
+            except Exception, e:
+                logging.exception("Pipeline for [%s] failed", job.path)
+                p.fail(str(e))
+                continue
+            self.pipelines.remove(entry)
+            self.busy += time.time() - p.start
+            self.completeJob(p, job, frames)
+
+    def completeJob(self, p, job, frames):
+        outcome = OUTCOME_FAILED
+        try:
+            try:
+                if p.complete():
+                    p.conv.copyTagsToTargets(self.v, p.targets, frames)
+                    if p.conv.publish(self.v):
+                        self.v.deletePath(p.conv.path)
+                        outcome = OUTCOME_CONVERTED
+            finally:
+                p.conv.discardStaged()
+            job.finish(outcome)
+        except Exception:
+            logging.exception("Job [%s] failed", job.path)
+            outcome = OUTCOME_FAILED
+        self.summary.record(outcome)
+
+
+class StageLimits(object):
+    """Separate concurrency limits for CPU-bound and I/O-bound stages.
+
+    Decoding and encoding hold a 'cpu' slot; tag writes, deletes, copies
+    and hashing hold an 'io' slot. Slots are never nested.
+    """
+
+    def __init__(self, cpuJobs, ioJobs):
+        self.cpuJobs = max(1, cpuJobs)
+        self.ioJobs = max(1, ioJobs)
+        self.cpu = threading.BoundedSemaphore(self.cpuJobs)
+        self.io = threading.BoundedSemaphore(self.ioJobs)
+
+    def getWorkerCount(self):
+        # Enough workers to keep both kinds of stage busy at once
+        return self.cpuJobs + self.ioJobs
+
+
+class WorkerThread(threading.Thread):
+    """Long-lived worker that runs jobs pulled from its pool's queue"""
+
+    def __init__(self, pool, index):
+        super(WorkerThread, self).__init__(name='worker-%d' % index)
+        self.daemon = True
+        self.pool = pool
+
+    def run(self):
+        while True:
+            job = self.pool.queue.get()
+            try:
+                if job is None:
+                    return
+                self.pool.runJob(job)
+            finally:
+                self.pool.queue.task_done()
+
+
+class WorkerPool(object):
+    """Fixed set of worker threads fed through a bounded job queue.
+
+    Jobs are callables returning an outcome string. With a single worker,
+    jobs are run directly in the submitting thread.
+    """
+
+    def __init__(self, workers, backlog=None):
+        self.workers = max(1, workers)
+        if backlog == None:
+            backlog = self.workers * 4
+        self.queue = Queue.Queue(backlog)
+        self.summary = Summary()
+        self.threads = []
+        self.aborted = threading.Event()
+
+        # Utilisation and queue depth statistics
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.busy = 0.0
+        self.depthTotal = 0
+        self.depthSamples = 0
+        self.maxDepth = 0
+
+    def start(self):
+        self.started = time.time()
+        if self.workers == 1:
+            return
+        for i in range(self.workers):
+            t = WorkerThread(self, i)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, job):
+        if self.aborted.is_set():
+            return
+        if not self.threads:
+            self.runJob(job)
+            return
+
+        self.put(job)
+
+    def put(self, job):
+        depth = self.queue.qsize()
+        with self.lock:
+            self.depthTotal += depth
+            self.depthSamples += 1
+            self.maxDepth = max(self.maxDepth, depth)
+
+        # Block with a timeout so that the submitting thread remains
+        # responsive to KeyboardInterrupt
+        while True:
+            try:
+                self.queue.put(job, True, 1.0)
+                return
+            except Queue.Full:
+                pass
+
+    def runJob(self, job):
+        if self.aborted.is_set():
+            return
+        start = time.time()
+        try:
+            outcome = job()
+        except Exception:
+            logging.exception("Job [%s] failed", getattr(job, 'path', job))
+            outcome = OUTCOME_FAILED
+        with self.lock:
+            self.busy += time.time() - start
+        self.summary.record(outcome)
+
+    def getUtilisation(self):
+        elapsed = (self.finished or time.time()) - self.started
+        if elapsed <= 0:
+            return 0.0
+        with self.lock:
+            return min(1.0, self.busy / (elapsed * self.workers))
+
+    def getAverageDepth(self):
+        with self.lock:
+            if self.depthSamples == 0:
+                return 0.0
+            return float(self.depthTotal) / self.depthSamples
+
+    def abort(self):
+        """Discards any queued jobs; running jobs are allowed to finish"""
+        self.aborted.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except Queue.Empty:
+                break
+
+    def shutdown(self):
+        for t in self.threads:
+            self.put(None)
+        for t in self.threads:
+            while t.is_alive():
+                t.join(1.0)
+        self.threads = []
+        self.finished = time.time()
+
+
+class Coordinator(object):
+    """Serves a 'JobTable' to worker validators on other hosts.
+
+    Discovery, the manifest and the outcome summary stay here; workers
+    (see 'CoordinatedWorker') claim, heartbeat and report over XML-RPC.
+    Paths must be the same on every host.
+    """
+
+    def __init__(self, v, table, address):
+        self.v = v
+        self.table = table
+        self.address = address
+        self.summary = Summary()
+        self.jobs = {}
+        self.clients = {}
+        self.released = set()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.maxDepth = 0
+
+    @property
+    def workers(self):
+        with self.lock:
+            return len(self.clients)
+
+    def getUtilisation(self):
+        return 0.0
+
+    def getAverageDepth(self):
+        return 0.0
+
+    def populate(self, files):
+        try:
+            for job in self.v.filterRecorded(self.v.discover(files), \
+                    self.summary):
+                try:
+                    size = job.stat and job.stat.st_size or \
+                        os.path.getsize(job.path)
+                except OSError, e:
+                    logging.error("Unable to stat [%s]: %s", job.path, e)
+                    continue
+                jobId = self.table.add(job.path, job.getExtension(), size)
+                if jobId != None:
+                    with self.lock:
+                        self.jobs[jobId] = job
+        except Exception:
+            logging.exception("Discovery failed")
+        finally:
+            self.table.seal()
+            logging.info("Discovery finished: %s", self.table.getCounts())
+
+    def serve(self, files):
+        server = SimpleXMLRPCServer.SimpleXMLRPCServer(self.address, \
+            logRequests=False, allow_none=True)
+        server.timeout = 1.0
+        # The port actually bound, if it was left to the system
+        self.address = server.server_address[:2]
+        for name in ('hello', 'claim', 'heartbeat', 'commit', 'report'):
+            server.register_function(getattr(self, name), name)
+        logging.info("Coordinating on %s:%d", *server.server_address[:2])
+
+        discovery = threading.Thread(target=self.populate, args=(files,), \
+            name='discovery')
+        discovery.daemon = True
+        discovery.start()
+        try:
+            while not self.table.isFinished():
+                # Returns at least once a second, so leases held by workers
+                # that have died expire even when nothing else is calling
+                server.handle_request()
+                self.expire()
+
+            # Linger until every worker has been told that there is nothing
+            # left, or has had a lease's time to ask
+            deadline = time.time() + self.table.leaseTime
+            while time.time() < deadline:
+                with self.lock:
+                    if self.released.issuperset(self.clients):
+                        break
+                server.handle_request()
+        except KeyboardInterrupt:
+            logging.warning("Interrupted; unfinished jobs remain in the " \
+                "job table")
+        finally:
+            server.server_close()
+            self.finished = time.time()
+        return self.summary
+
+    def hello(self, worker):
+        """Registers a worker; returns the roots for relative paths"""
+        logging.info("Worker [%s] connected", worker)
+        with self.lock:
+            self.clients[worker] = time.time()
+        return {'roots': self.v.roots, 'leaseTime': self.table.leaseTime}
+
+    def expire(self):
+        for (jobId, path) in self.table.expireLeases():
+            self.summary.record(OUTCOME_FAILED)
+            with self.lock:
+                job = self.jobs.pop(jobId, None)
+            if job != None and job.stat != None:
+                job.finish(OUTCOME_FAILED)
+
+    def claim(self, worker, count):
+        with self.lock:
+            self.clients[worker] = time.time()
+        self.expire()
+        jobs = self.table.claim(worker, count, self.v.isPlanning())
+        for (jobId, path, t, size) in jobs:
+            logging.debug("Leased [%s] to [%s]", path, worker)
+        finished = self.table.isFinished()
+        if finished:
+            with self.lock:
+                self.released.add(worker)
+        return {'jobs': jobs, 'finished': finished}
+
+    def heartbeat(self, worker, jobIds):
+        with self.lock:
+            self.clients[worker] = time.time()
+        return self.table.heartbeat(worker, jobIds)
+
+    def commit(self, worker, jobId):
+        return self.table.commit(worker, jobId)
+
+    def report(self, worker, jobId, outcome):
+        path = self.table.report(worker, jobId, outcome)
+        if path == None:
+            logging.warning("Ignoring [%s] from [%s]: job %d is not leased " \
+                "to it", outcome, worker, jobId)
+            return False
+        logging.info("[%s] %s [%s]", worker, outcome, self.v.nameForPath(path))
+        self.summary.record(outcome)
+        with self.lock:
+            job = self.jobs.pop(jobId, None)
+        if job != None and job.stat != None:
+            job.finish(outcome)
+        return True
+
+
+class WatchedJob(object):
+    """A job queued by 'Validator.watch'; its path is in 'active' until it
+    is done, so that it is not queued twice"""
+
+    def __init__(self, processor, active, lock):
+        self.processor = processor
+        self.path = processor.path
+        self.active = active
+        self.lock = lock
+        with lock:
+            active.add(self.path)
+
+    def __call__(self):
+        try:
+            return self.processor.process()
+        finally:
+            with self.lock:
+                self.active.discard(self.path)
+
+
+class LeasedJob(object):
+    """A job claimed from a coordinator; reports its outcome when done"""
+
+    def __init__(self, worker, jobId, processor):
+        self.worker = worker
+        self.jobId = jobId
+        self.processor = processor
+        self.path = processor.path
+
+    def __call__(self):
+        outcome = OUTCOME_FAILED
+        try:
+            outcome = self.processor.process()
+            return outcome
+        finally:
+            self.worker.finishJob(self, outcome)
+
+    def abort(self):
+        logging.warning("Lease on [%s] was lost; abandoning it", self.path)
+        self.processor.abort("lease lost")
+
+
+class CoordinatedWorker(object):
+    """Runs jobs claimed from a 'Coordinator' on a local 'WorkerPool'.
+
+    Leases are extended by a heartbeat while their jobs run. A job whose
+    lease is lost is abandoned at once, its processes killed. Outputs are
+    written under a temporary name and only renamed into place, and the
+    source deleted, once the lease is confirmed; so a job that was
+    reassigned after its lease expired never has two workers writing the
+    same file.
+    """
+
+    POLL_INTERVAL = 2.0
+
+    def __init__(self, v, url, threads, name=None):
+        self.v = v
+        self.proxy = xmlrpclib.ServerProxy(url, allow_none=True)
+        self.proxyLock = threading.Lock()
+        self.threads = max(1, threads)
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.running = {}
+        self.lost = set()
+        self.stopping = threading.Event()
+        self.leaseTime = DEFAULT_LEASE_TIME
+
+    def call(self, method, *args):
+        with self.proxyLock:
+            return getattr(self.proxy, method)(self.name, *args)
+
+    def run(self):
+        pool = WorkerPool(self.threads, backlog=self.threads)
+        heartbeat = None
+        try:
+            hello = self.call('hello')
+            self.v.roots = hello['roots']
+            self.leaseTime = hello['leaseTime']
+            self.v.setDeleteGuard(self.confirmDelete)
+            self.v.setStagingSuffix('.%s.part' % \
+                re.sub(r'[^\w.-]', '_', self.name))
+
+            heartbeat = threading.Thread(target=self.heartbeat, \
+                name='heartbeat')
+            heartbeat.daemon = True
+            heartbeat.start()
+
+            pool.start()
+            while True:
+                with self.lock:
+                    free = self.threads - len(self.running)
+                if free <= 0:
+                    time.sleep(0.1)
+                    continue
+                reply = self.call('claim', free)
+                if not reply['jobs']:
+                    if reply['finished']:
+                        break
+                    time.sleep(CoordinatedWorker.POLL_INTERVAL)
+                    continue
+                for (jobId, path, t, size) in reply['jobs']:
+                    job = LeasedJob(self, jobId, FileProcessor(self.v, path))
+                    with self.lock:
+                        self.running[path] = job
+                    pool.submit(job)
+        except (socket.error, xmlrpclib.Error), e:
+            logging.error("Lost contact with the coordinator: %s", e)
+            pool.abort()
+        except KeyboardInterrupt:
+            logging.warning("Interrupted; waiting for running jobs...")
+            pool.abort()
+        finally:
+            pool.shutdown()
+            self.stopping.set()
+            if heartbeat != None:
+                heartbeat.join()
+            self.v.setDeleteGuard(None)
+            self.v.setStagingSuffix(None)
+        return pool
+
+    def heartbeat(self):
+        while not self.stopping.wait(self.leaseTime / 3.0):
+            with self.lock:
+                jobIds = [job.jobId for job in self.running.values()]
+            if not jobIds:
+                continue
+            try:
+                lost = self.call('heartbeat', jobIds)
+            except (socket.error, xmlrpclib.Error), e:
+                logging.warning("Heartbeat failed: %s", e)
+                continue
+            with self.lock:
+                self.lost.update(lost)
+                jobs = [job for job in self.running.values() \
+                    if job.jobId in lost]
+            for job in jobs:
+                job.abort()
+
+    def confirmDelete(self, path):
+        with self.lock:
+            job = self.running.get(path)
+        if job == None:
+            return True
+        return job.jobId not in self.lost and self.call('commit', job.jobId)
+
+    def finishJob(self, job, outcome):
+        with self.lock:
+            del self.running[job.path]
+        try:
+            if not self.call('report', job.jobId, outcome):
+                logging.warning("Outcome for [%s] was not accepted; its " \
+                    "lease had expired", job.path)
+        except (socket.error, xmlrpclib.Error), e:
+            logging.error("Unable to report [%s]: %s", job.path, e)
 
 
 class Validator(object):
@@ -242,6 +3056,26 @@ class Validator(object):
         self.fullPaths = False
         self.preserveFiles = False
         self.verbose = False
+        self.manifest = None
+        self.targets = [buildProfile('mp3')]
+        self.roots = []
+        self.segmentThreshold = None
+        self.segmentJobs = defaultThreadCount()
+        self.verifySegments = False
+        self.segmentDir = None
+        self.planning = False
+        self.metrics = Metrics()
+        self.prometheusPath = None
+        self.deduplicator = None
+        self.limits = StageLimits(defaultThreadCount(), DEFAULT_IO_JOBS)
+        self.priority = []
+        self.eventDriven = False
+        self.stallTimeout = DEFAULT_STALL_TIMEOUT
+        self.checkingMp3 = False
+        self.deepChecking = False
+        self.quarantine = None
+        self.deleteGuard = None
+        self.stagingSuffix = None
     
     def isSimulation(self):
         raise NotImplementedError
@@ -264,45 +3098,339 @@ class Validator(object):
     def isPreservingFiles(self):
         return self.preserveFiles
 
-    def operate(self, files, threads=1):
+    def setManifest(self, manifest):
+        self.manifest = manifest
+
+    def getManifest(self):
+        return self.manifest
+
+    def setTargets(self, targets):
+        self.targets = targets
+
+    def getTargets(self):
+        return self.targets
+
+    def isOutputPath(self, path):
+        """True if 'path' is in (or is) a target's output directory, or a
+        segmented encode's scratch directory"""
+        if os.sep + SEGMENT_DIR_PREFIX in path:
+            return True
+        dirs = [profile.outdir for profile in self.targets]
+        for d in dirs + [self.segmentDir]:
+            if d != None and (path == d or path.startswith(d + os.sep)):
+                return True
+        return False
+
+    def setSegmentThreshold(self, seconds):
+        self.segmentThreshold = seconds
+
+    def getSegmentThreshold(self):
+        return self.segmentThreshold
+
+    def setSegmentJobs(self, jobs):
+        self.segmentJobs = jobs
+
+    def getSegmentJobs(self):
+        return self.segmentJobs
+
+    def setVerifySegments(self, value):
+        self.verifySegments = value
+
+    def isVerifyingSegments(self):
+        return self.verifySegments
+
+    def setSegmentDir(self, path):
+        self.segmentDir = path
+
+    def getSegmentDir(self):
+        return self.segmentDir
+
+    def setMp3Check(self, value, deep=False, quarantine=None):
+        self.checkingMp3 = value
+        self.deepChecking = deep
+        self.quarantine = quarantine
+
+    def isCheckingMp3(self):
+        return self.checkingMp3
+
+    def isDeepChecking(self):
+        return self.deepChecking
+
+    def setDeleteGuard(self, guard):
+        """Sets a callable that must return True before a path is deleted"""
+        self.deleteGuard = guard
+
+    def setStagingSuffix(self, suffix):
+        """Has outputs written to their path plus 'suffix' until published"""
+        self.stagingSuffix = suffix
+
+    def stagePath(self, outpath):
+        if self.stagingSuffix == None:
+            return outpath
+        return outpath + self.stagingSuffix
+
+    def confirmPath(self, path):
+        """True if the delete guard (if any) allows work on 'path' to be
+        completed"""
+        return self.deleteGuard == None or self.deleteGuard(path)
+
+    def setStallTimeout(self, seconds):
+        self.stallTimeout = seconds
+
+    def getStallTimeout(self):
+        return self.stallTimeout
+
+    def setEventDriven(self, value):
+        self.eventDriven = value
+
+    def isEventDriven(self):
+        return self.eventDriven
+
+    def setLimits(self, limits):
+        self.limits = limits
+
+    def setPriority(self, nice=None, ioClass=None):
+        """Sets the scheduling priority of decoders and encoders"""
+        self.priority = []
+        if nice != None:
+            self.priority += ['nice', '-n', str(nice)]
+        if ioClass != None:
+            self.priority += ['ionice', '-c', str(ioClass)]
+
+    def wrapCommand(self, args):
+        return self.priority + args
+
+    def setDeduplicator(self, deduplicator):
+        self.deduplicator = deduplicator
+
+    def getDeduplicator(self):
+        return self.deduplicator
+
+    def setPrometheusPath(self, path):
+        self.prometheusPath = path
+
+    def setPlanning(self, value):
+        self.planning = value
+
+    def isPlanning(self):
+        return self.planning
+
+    def relativePath(self, path):
+        """Returns 'path' relative to the deepest root containing it"""
+        best = None
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                if best == None or len(root) > len(best):
+                    best = root
+        if best == None:
+            return os.path.basename(path)
+        return os.path.relpath(path, best)
+
+    def operate(self, files, threads=None):
         if type(files) in types.StringTypes:
             # Turn a single string into a list
             files = [files]
+        if threads == None:
+            threads = self.limits.getWorkerCount()
+
+        self.roots = [os.path.abspath(os.path.expanduser(f)) \
+                for f in files if os.path.isdir(f)]
+
+        if self.isEventDriven():
+            logging.debug("Validating with up to %d pipelines...", \
+                self.limits.cpuJobs)
+            engine = EventEngine(self, self.limits.cpuJobs)
+            jobs = self.filterRecorded(self.discover(files), engine.summary)
+            if self.isPlanning():
+                jobs = self.plan(jobs, engine.workers)
+            engine.run(jobs)
+            return self.report(engine)
+
+        logging.debug("Validating over %d threads...", threads)
+        pool = WorkerPool(threads)
+        pool.start()
+        try:
+            # Discovery is lazy (unless planning); the bounded pool queue
+            # paces the walk
+            jobs = self.filterRecorded(self.discover(files), pool.summary)
+            if self.isPlanning():
+                jobs = self.plan(jobs, threads)
+            for job in jobs:
+                pool.submit(job)
+        except KeyboardInterrupt:
+            logging.warning("Interrupted; waiting for running jobs...")
+            pool.abort()
+        finally:
+            pool.shutdown()
+
+        return self.report(pool)
+
+    def coordinate(self, files, address, table):
+        """Hands the given files out to 'work'ers until all are done"""
+        self.roots = [os.path.abspath(os.path.expanduser(f)) \
+                for f in files if os.path.isdir(f)]
+        coordinator = Coordinator(self, table, address)
+        coordinator.serve(files)
+        logging.info("Job table: %s", table.getCounts())
+        return self.report(coordinator)
+
+    def work(self, url, threads=None):
+        """Processes files claimed from the coordinator at 'url'"""
+        if threads == None:
+            threads = self.limits.getWorkerCount()
+        worker = CoordinatedWorker(self, url, threads)
+        logging.info("Working for [%s] as [%s]...", url, worker.name)
+        return self.report(worker.run())
+
+    def watch(self, dirs, threads=None, settle=DEFAULT_SETTLE):
+        """Processes files as they arrive beneath 'dirs' until interrupted.
+
+        Files are queued once nothing has written to or moved them for
+        'settle' seconds; the process sleeps in the kernel otherwise.
+        """
+        if threads == None:
+            threads = self.limits.getWorkerCount()
+        self.roots = [os.path.abspath(os.path.expanduser(d)) for d in dirs]
+
+        watcher = InotifyWatcher()
+        pool = WorkerPool(threads)
+        pool.start()
+
+        # Paths queued or being converted
+        active = set()
+        lock = threading.Lock()
+        try:
+            for root in self.roots:
+                watcher.addTree(root)
+
+            # Catch up with anything that arrived while not watching
+            for job in self.filterRecorded(self.discover(self.roots), \
+                    pool.summary):
+                pool.submit(WatchedJob(job, active, lock))
+            logging.info("Watching %d directories for new files...", \
+                watcher.count())
+
+            pending = {}
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0.0, min(pending.values()) + settle - \
+                        time.time())
+
+                now = time.time()
+                for (path, isDir) in watcher.read(timeout):
+                    if isDir:
+                        for f in walkFiles(path, self.isOutputPath):
+                            pending[os.path.abspath(f)] = now
+                    else:
+                        pending[path] = now
+
+                # Dispatch the batch of files that have settled
+                now = time.time()
+                ready = sorted(p for (p, t) in pending.items() \
+                    if now - t >= settle)
+                for path in ready:
+                    del pending[path]
+                    if not os.path.isfile(path):
+                        continue
+                    with lock:
+                        busy = path in active
+                    if busy:
+                        # Written again while its job runs (e.g. by a
+                        # tagger); look again once that job is done
+                        pending[path] = now
+                        continue
+                    for job in self.filterRecorded( \
+                            self.buildProcessor(path), pool.summary):
+                        pool.submit(WatchedJob(job, active, lock))
+        except KeyboardInterrupt:
+            logging.info("Stopping; waiting for running jobs...")
+            pool.abort()
+        finally:
+            pool.shutdown()
+            watcher.close()
+
+        return self.report(pool)
+
+    def report(self, pool):
+        pool.summary.log()
+        if self.deduplicator != None:
+            self.deduplicator.log()
+        self.metrics.log(pool)
+        self.metrics.writeRun(pool)
+        if self.prometheusPath != None and not self.isSimulation():
+            self.metrics.writePrometheus(self.prometheusPath, pool)
+        return pool.summary
+
+    def filterRecorded(self, jobs, summary):
+        for job in jobs:
+            if self.isRecorded(job):
+                summary.record(OUTCOME_UNCHANGED)
+                continue
+            yield job
+
+    def plan(self, jobs, threads):
+        """Orders jobs longest first, by their estimated CPU cost"""
+        planned = []
+        for job in jobs:
+            try:
+                cost = job.estimateCost()
+            except Exception:
+                logging.exception("Unable to estimate the cost of [%s]", \
+                    job.path)
+                cost = 0.0
+            planned.append((cost, job))
+        planned.sort(key=lambda p: p[0], reverse=True)
+
+        # Estimate the wall time of greedily assigning jobs to workers
+        workers = [0.0] * max(1, threads)
+        for (cost, job) in planned:
+            heapq.heapreplace(workers, workers[0] + cost)
+
+        if self.isSimulation():
+            log = logging.info
+        else:
+            log = logging.debug
+        log("Plan (estimated CPU seconds, longest first):")
+        for (cost, job) in planned:
+            log("%10.1f  %s", cost, self.nameForPath(job.path))
+        logging.info("Planned %d file(s): estimated %.0fs CPU, %.0fs wall " \
+            "time over %d threads", len(planned), \
+            sum(cost for (cost, job) in planned), max(workers), threads)
+        return [job for (cost, job) in planned]
+
+    def isRecorded(self, job):
+        """Cheap manifest check (size and time only) made before queueing"""
+        if self.manifest == None:
+            return False
 
-        # Build the thread list
-        threadList = []
+        try:
+            job.stat = os.stat(job.path)
+        except OSError, e:
+            logging.error("Unable to stat [%s]: %s", job.path, e)
+            return False
+        return self.manifest.isUnchanged(job.path, job.stat)
+
+    def discover(self, files):
         for f in files:
             if not os.path.exists(f):
                 logging.warning("Provided path [%s] does not exist!", f)
                 continue
             elif os.path.isfile(f):
-                threadList += self.buildThread(f)
+                for job in self.buildProcessor(f):
+                    yield job
             else:
-                threadList += self.processDir(f)
-
-        logging.debug("Validating over %d threads...", threads)
-        sem = threading.Semaphore(threads)
-        for t in threadList:
-            sem.acquire()
-            t.setSem(sem)
-            if threads > 1:
-                t.start()
-            else:
-                t.run()
-    
+                for job in self.processDir(f):
+                    yield job
 
     def processDir(self, d):
         logging.debug( "Processing directory [%s]...", d)
 
-        threads = []
-        for (dirpath, dirnames, filenames) in os.walk(d):
-            for name in filenames:
-                path = os.path.join(dirpath, name)
-                threads += self.buildThread(path)
+        # Never pick up (and so delete) the outputs of a target
+        for path in walkFiles(d, self.isOutputPath):
+            yield FileProcessor(self, os.path.abspath(path))
 
-        return threads
-
-    def buildThread(self, path):
+    def buildProcessor(self, path):
         logging.debug( "Processing path [%s]", path )
 
         # Expand and resolve the path
@@ -310,14 +3438,44 @@ class Validator(object):
         if not os.path.isfile(path):
             logging.error("Unknown file type for [%s]", path)
             return []
+        if self.isOutputPath(path):
+            logging.debug("Skipping target output [%s]", path)
+            return []
 
-        return [FileProcessorThread(self, path)]
+        return [FileProcessor(self, path)]
       
     def deletePath(self, path):
+        if self.deleteGuard != None and not self.deleteGuard(path):
+            logging.warning("Not deleting [%s]: it has been handed to " \
+                "another worker", self.nameForPath(path))
+            return
         if not self.isPreservingFiles():
             logging.info("Deleting file: [%s]", self.nameForPath(path))
             if not self.isSimulation():
-                os.remove(path)
+                with self.limits.io, self.metrics.stage(path, 'delete') \
+                        as stage:
+                    stage.bytesIn = fileSize(path)
+                    os.remove(path)
+
+    def quarantinePath(self, path):
+        """Moves a damaged file beneath the quarantine directory, if any"""
+        if self.quarantine == None:
+            return
+        dest = os.path.join(self.quarantine, self.relativePath(path))
+        logging.info("Quarantining file: [%s] -> [%s]", \
+            self.nameForPath(path), dest)
+        if self.isSimulation():
+            return
+
+        base = dest
+        count = 1
+        while os.path.exists(dest):
+            dest = '%s.%d' % (base, count)
+            count += 1
+        with self.limits.io:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.move(path, dest)
 
     def nameForPath(self, path):
         if self.isFullPaths():
@@ -336,6 +3494,86 @@ class RealValidator(Validator):
     
     def isSimulation(self):
         return False
+
+
+def walkFiles(top, skip=None):
+    """Lazily yields the regular files beneath 'top'.
+
+    Uses 'scandir' where available so that the directory entry type is
+    reused rather than issuing a stat per entry. Like 'os.walk', symbolic
+    links to directories are not followed. Directories for which 'skip'
+    returns True (given their absolute path) are not descended into.
+    """
+    if skip == None:
+        skip = lambda d: False
+    if skip(os.path.abspath(top)):
+        return
+
+    if scandir == None:
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            dirnames[:] = [n for n in dirnames \
+                if not skip(os.path.abspath(os.path.join(dirpath, n)))]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.isfile(path):
+                    yield path
+                else:
+                    logging.error("Unknown file type for [%s]", path)
+        return
+
+    pending = [top]
+    while pending:
+        d = pending.pop()
+        try:
+            entries = list(scandir(d))
+        except OSError, e:
+            logging.error("Unable to list directory [%s]: %s", d, e)
+            continue
+
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink() and \
+                        not skip(os.path.abspath(entry.path)):
+                    subdirs.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+            else:
+                logging.error("Unknown file type for [%s]", entry.path)
+
+        # Preserve top-down, in-order traversal
+        pending += reversed(subdirs)
+
+
+def hashPath(path, blockSize=1<<20):
+    h = hashlib.sha1()
+    fd = open(path, 'rb')
+    try:
+        hashStream(fd, h, blockSize=blockSize)
+    finally:
+        fd.close()
+    return h.hexdigest()
+
+
+def hashStream(fd, h, length=None, blockSize=1<<20):
+    """Feeds 'length' bytes (or everything) from 'fd' into the hash 'h'"""
+    while length == None or length > 0:
+        if length == None:
+            data = fd.read(blockSize)
+        else:
+            data = fd.read(min(blockSize, length))
+            length -= len(data)
+        if not data:
+            break
+        h.update(data)
+
+
+def defaultThreadCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
   
 def main():
     usage = '%prog: [options] dirs...'
@@ -354,8 +3592,121 @@ def main():
             action='store_true', dest='preserve', default=False, \
             help='Causes no files to be deleted')
     parser.add_option('-t', '--threads', metavar='COUNT', \
-            action='store', dest='threads', default=1, \
-            help='Distributes processing among COUNT threads')
+            action='store', type='int', dest='threads', default=None, \
+            help='Distributes processing among COUNT worker threads ' \
+                 '(default: CPU jobs plus I/O jobs)')
+    parser.add_option('--cpu-jobs', metavar='COUNT', \
+            action='store', type='int', dest='cpuJobs', \
+            default=defaultThreadCount(), \
+            help='Runs at most COUNT decode/encode stages at once ' \
+                 '(default: %default)')
+    parser.add_option('--io-jobs', metavar='COUNT', \
+            action='store', type='int', dest='ioJobs', \
+            default=DEFAULT_IO_JOBS, \
+            help='Runs at most COUNT tag, delete, copy and hash stages ' \
+                 'at once (default: %default)')
+    parser.add_option('-n', '--nice', metavar='LEVEL', \
+            action='store', type='int', dest='nice', default=None, \
+            help='Runs decoders and encoders at niceness LEVEL')
+    parser.add_option('--ionice', metavar='CLASS', \
+            action='store', type='int', dest='ionice', default=None, \
+            help='Runs decoders and encoders in I/O scheduling CLASS ' \
+                 '(1: realtime, 2: best-effort, 3: idle)')
+    parser.add_option('-T', '--target', metavar='PROFILE[:DIR]', \
+            action='append', dest='targets', default=[], \
+            help='Encodes to PROFILE (one of: %s), writing beneath DIR ' \
+                 'or alongside the source; may be repeated to encode ' \
+                 'several targets from a single decode (default: mp3)' % \
+                 ', '.join(sorted(ENCODER_PROFILES)))
+    parser.add_option('-s', '--segment', metavar='SECONDS', \
+            action='store', type='float', dest='segmentThreshold', \
+            default=None, \
+            help='Splits inputs at least SECONDS long into segments that ' \
+                 'are encoded in parallel and joined into one MP3')
+    parser.add_option('--segment-jobs', metavar='COUNT', \
+            action='store', type='int', dest='segmentJobs', \
+            default=defaultThreadCount(), \
+            help='Encodes up to COUNT segments of an input at once ' \
+                 '(default: %default)')
+    parser.add_option('--segment-verify', \
+            action='store_true', dest='segmentVerify', default=False, \
+            help='Checks segmented output against a single pass encode, ' \
+                 'keeping the single pass encode if they differ')
+    parser.add_option('--segment-dir', metavar='DIR', \
+            action='store', dest='segmentDir', default=None, \
+            help='Spools the decoded audio of segmented inputs beneath DIR ' \
+                 '(default: the output directory)')
+    parser.add_option('-P', '--plan', \
+            action='store_true', dest='plan', default=False, \
+            help='Reads file headers before starting and processes the ' \
+                 'most expensive files first; simulated runs print the plan')
+    parser.add_option('-d', '--dedup', \
+            action='store_true', dest='dedup', default=False, \
+            help='Encodes identical audio (ignoring tags) only once, ' \
+                 'cloning the output for duplicates')
+    parser.add_option('--metrics', metavar='PATH', \
+            action='store', dest='metrics', default=None, \
+            help='Appends per-stage metrics to PATH as JSON lines')
+    parser.add_option('--prometheus', metavar='PATH', \
+            action='store', dest='prometheus', default=None, \
+            help='Writes run metrics to PATH for the node_exporter ' \
+                 'textfile collector')
+    parser.add_option('-w', '--watch', \
+            action='store_true', dest='watch', default=False, \
+            help='Keeps running, processing files as they are written ' \
+                 'to or moved into the given directories')
+    parser.add_option('--settle', metavar='SECONDS', \
+            action='store', type='float', dest='settle', \
+            default=DEFAULT_SETTLE, \
+            help='In watch mode, waits until a file has been left alone ' \
+                 'for SECONDS before processing it (default: %default)')
+    parser.add_option('-e', '--events', \
+            action='store_true', dest='events', default=False, \
+            help='Supervises decoder/encoder pipelines from a single ' \
+                 'event loop instead of worker threads (up to --cpu-jobs ' \
+                 'at once)')
+    parser.add_option('--stall-timeout', metavar='SECONDS', \
+            action='store', type='float', dest='stallTimeout', \
+            default=DEFAULT_STALL_TIMEOUT, \
+            help='Kills a decoder and its encoders when no audio has moved ' \
+                 'between them for SECONDS; 0 never does (default: %default)')
+    parser.add_option('-c', '--check-mp3', \
+            action='store_true', dest='checkMp3', default=False, \
+            help='Checks the framing of existing MP3s (sync, frame ' \
+                 'lengths, CRCs and the info tag) and reports damaged ones')
+    parser.add_option('--check-deep', \
+            action='store_true', dest='checkDeep', default=False, \
+            help='Also checks the LAME music CRC, which reads all of the ' \
+                 'audio data')
+    parser.add_option('-q', '--quarantine', metavar='DIR', \
+            action='store', dest='quarantine', default=None, \
+            help='Moves damaged MP3s beneath DIR (implies --check-mp3)')
+    parser.add_option('--coordinate', metavar='[HOST:]PORT', \
+            action='store', dest='coordinate', default=None, \
+            help='Hands the files out to --worker instances (on this or ' \
+                 'other hosts, with the same paths) instead of processing ' \
+                 'them; listens on %s unless HOST is given (e.g. ' \
+                 '0.0.0.0 for every interface)' % DEFAULT_COORDINATOR_HOST)
+    parser.add_option('--job-table', metavar='PATH', \
+            action='store', dest='jobTable', default=':memory:', \
+            help='Keeps the coordinator\'s job table at PATH, so that an ' \
+                 'interrupted run can be resumed')
+    parser.add_option('--lease', metavar='SECONDS', \
+            action='store', type='float', dest='lease', \
+            default=DEFAULT_LEASE_TIME, \
+            help='Reassigns a job when its worker has not heartbeated for ' \
+                 'SECONDS (default: %default)')
+    parser.add_option('--worker', metavar='URL', \
+            action='store', dest='worker', default=None, \
+            help='Processes files claimed from the coordinator at URL ' \
+                 '(e.g. http://host:port/)')
+    parser.add_option('-m', '--manifest', metavar='PATH', \
+            action='store', dest='manifest', default=None, \
+            help='Records outcomes in the manifest at PATH and skips files ' \
+                 'that are unchanged since they were last recorded')
+    parser.add_option('--manifest-hash', \
+            action='store_true', dest='manifestHash', default=False, \
+            help='Also matches manifest entries by content hash')
             
     (opts, args) = parser.parse_args()
     
@@ -364,7 +3715,7 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
 
     
-    if len(args) == 0:
+    if len(args) == 0 and opts.worker == None:
         logging.error( "You must specify at least one file to process!" )
         parser.print_usage()
         sys.exit(1)
@@ -384,8 +3735,81 @@ def main():
     v.setFullPaths(opts.full)
     v.setPreserveFile(opts.preserve)
     v.setVerbose(opts.verbose)
-    
-    v.operate(args, threads=int(opts.threads))
+    v.setSegmentThreshold(opts.segmentThreshold)
+    v.setSegmentJobs(opts.segmentJobs)
+    v.setVerifySegments(opts.segmentVerify)
+    if opts.segmentDir != None:
+        segmentDir = os.path.abspath(os.path.expanduser(opts.segmentDir))
+        if not os.path.isdir(segmentDir):
+            logging.error("Segment directory [%s] does not exist", segmentDir)
+            sys.exit(1)
+        v.setSegmentDir(segmentDir)
+    v.setPlanning(opts.plan)
+    v.setLimits(StageLimits(opts.cpuJobs, opts.ioJobs))
+    v.setPriority(opts.nice, opts.ionice)
+    v.setStallTimeout(opts.stallTimeout or None)
+    if opts.events:
+        if opts.dedup or opts.segmentThreshold != None or opts.watch:
+            logging.error("--events cannot be combined with --dedup, " \
+                "--segment or --watch")
+            parser.print_usage()
+            sys.exit(1)
+        v.setEventDriven(True)
+    v.setPrometheusPath(opts.prometheus)
+    if opts.checkMp3 or opts.checkDeep or opts.quarantine:
+        quarantine = None
+        if opts.quarantine:
+            quarantine = os.path.abspath(os.path.expanduser(opts.quarantine))
+        v.setMp3Check(True, opts.checkDeep, quarantine)
+    if opts.dedup:
+        v.setDeduplicator(Deduplicator())
+    if opts.metrics:
+        v.metrics.setJsonPath(opts.metrics)
+    if opts.targets:
+        try:
+            v.setTargets(buildTargets(opts.targets))
+        except ValueError, e:
+            logging.error("%s", e)
+            parser.print_usage()
+            sys.exit(1)
+    if opts.manifest:
+        v.setManifest(Manifest(opts.manifest, hashing=opts.manifestHash))
+
+    try:
+        if opts.coordinate:
+            (host, sep, port) = opts.coordinate.rpartition(':')
+            if not port.isdigit():
+                logging.error("Invalid address [%s]", opts.coordinate)
+                parser.print_usage()
+                sys.exit(1)
+            if not host:
+                host = DEFAULT_COORDINATOR_HOST
+            elif not host.startswith('127.') and host != 'localhost':
+                logging.warning("Any host that can reach [%s] can claim " \
+                    "jobs and have sources deleted; there is no " \
+                    "authentication", opts.coordinate)
+            table = JobTable(opts.jobTable, opts.lease)
+            try:
+                summary = v.coordinate(args, (host, int(port)), table)
+            finally:
+                table.close()
+        elif opts.worker:
+            summary = v.work(opts.worker, threads=opts.threads)
+        elif opts.watch:
+            # Stop cleanly when the service manager asks
+            def stop(signum, frame):
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                raise KeyboardInterrupt
+            signal.signal(signal.SIGTERM, stop)
+            summary = v.watch(args, threads=opts.threads, settle=opts.settle)
+        else:
+            summary = v.operate(args, threads=opts.threads)
+    finally:
+        if v.getManifest() != None:
+            v.getManifest().close()
+        v.metrics.close()
+    if summary.count(OUTCOME_FAILED) > 0 or summary.count(OUTCOME_DAMAGED) > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Runs a 'Coordinator' with several XML-RPC workers claiming from it at
+# once, checking that every job is leased to one worker at a time and that
+# the jobs of a worker that dies are handed to another. Then runs '--worker'
+# processes against it, with a stand-in encoder, checking that outputs are
+# only published (and sources deleted) under a lease that still holds.
+
+import os
+import imp
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import wave
+import xmlrpclib
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    os.pardir, 'bin')
+
+try:
+    validator = imp.load_source('validate_auto_audio', \
+        os.path.join(BIN_DIR, 'validate-auto-audio.py'))
+except ImportError, e:
+    # Needs 'mutagen'
+    validator = None
+    reason = str(e)
+
+
+@unittest.skipIf(validator == None, validator == None and reason)
+class CoordinatorTest(unittest.TestCase):
+
+    FILES = 12
+    LEASE_TIME = 1.0
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test-coordinator-')
+        for i in range(self.FILES):
+            fd = open(os.path.join(self.root, 'track%02d.flac' % i), 'w')
+            fd.write('x')
+            fd.close()
+
+        self.v = validator.SimulatedValidator()
+        self.table = validator.JobTable(leaseTime=self.LEASE_TIME)
+        self.coordinator = validator.Coordinator(self.v, self.table, \
+            ('127.0.0.1', 0))
+        self.server = threading.Thread(target=self.coordinator.serve, \
+            args=([self.root],))
+        self.server.daemon = True
+        self.server.start()
+
+        # Wait for the port to be bound
+        deadline = time.time() + 5.0
+        while self.coordinator.address[1] == 0:
+            self.assertTrue(time.time() < deadline, "coordinator not bound")
+            time.sleep(0.01)
+        self.url = 'http://127.0.0.1:%d/' % self.coordinator.address[1]
+
+    def tearDown(self):
+        self.server.join(10.0)
+        self.table.close()
+        shutil.rmtree(self.root, True)
+
+    def connect(self, name):
+        proxy = xmlrpclib.ServerProxy(self.url, allow_none=True)
+        proxy.hello(name)
+        return proxy
+
+    def work(self, name, claimed, lock):
+        """Claims and reports jobs until the coordinator has none left"""
+        proxy = self.connect(name)
+        while True:
+            reply = proxy.claim(name, 2)
+            if not reply['jobs']:
+                if reply['finished']:
+                    return
+                time.sleep(0.05)
+                continue
+            for (jobId, path, t, size) in reply['jobs']:
+                with lock:
+                    claimed.append((name, jobId))
+                self.assertTrue(proxy.heartbeat(name, [jobId]) == [])
+                self.assertTrue(proxy.commit(name, jobId))
+                self.assertTrue(proxy.report(name, jobId, \
+                    validator.OUTCOME_CONVERTED))
+
+    def runWorkers(self, names, claimed):
+        lock = threading.Lock()
+        errors = []
+        def run(name):
+            try:
+                self.work(name, claimed, lock)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(n,)) for n in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30.0)
+        self.assertEqual(errors, [])
+
+    def testEveryJobLeasedOnce(self):
+        claimed = []
+        self.runWorkers(['worker%d' % i for i in range(4)], claimed)
+        self.server.join(10.0)
+        self.assertFalse(self.server.is_alive())
+
+        jobIds = [jobId for (name, jobId) in claimed]
+        self.assertEqual(len(jobIds), self.FILES)
+        self.assertEqual(len(set(jobIds)), self.FILES)
+        self.assertEqual(self.coordinator.summary.count( \
+            validator.OUTCOME_CONVERTED), self.FILES)
+
+    def testDeadWorkerJobsReassigned(self):
+        # Claims jobs, then never heartbeats or reports again
+        dead = self.connect('dead')
+        deadline = time.time() + 5.0
+        lost = []
+        while not lost:
+            self.assertTrue(time.time() < deadline, "no jobs to claim")
+            lost = [row[0] for row in dead.claim('dead', 3)['jobs']]
+
+        # Only expire on the coordinator's own timer before anyone claims
+        time.sleep(self.LEASE_TIME + 1.5)
+        self.assertFalse(self.table.getCounts().get( \
+            validator.JobTable.STATE_LEASED))
+        self.assertEqual(sorted(dead.heartbeat('dead', lost)), sorted(lost))
+        self.assertFalse(dead.report('dead', lost[0], \
+            validator.OUTCOME_CONVERTED))
+
+        claimed = []
+        self.runWorkers(['live0', 'live1'], claimed)
+        self.server.join(10.0)
+        self.assertFalse(self.server.is_alive())
+
+        reassigned = set(jobId for (name, jobId) in claimed)
+        self.assertTrue(set(lost).issubset(reassigned))
+        self.assertEqual(len(reassigned), self.FILES)
+        self.assertEqual(self.coordinator.summary.count( \
+            validator.OUTCOME_CONVERTED), self.FILES)
+
+
+# Stands in for 'opusenc'; the first encode (only) waits for a while, having
+# said that it started, so that its worker can be stopped mid-job
+FAKE_ENCODER = """#!%s
+import os, sys, time
+marker = os.environ['FAKE_ENCODER_MARKER']
+data = sys.stdin.read()
+if not os.path.exists(marker):
+    open(marker, 'w').close()
+    time.sleep(float(os.environ.get('FAKE_ENCODER_DELAY', '0')))
+out = open(sys.argv[-1], 'wb')
+out.write(data[:64])
+out.close()
+""" % sys.executable
+
+
+@unittest.skipIf(validator == None, validator == None and reason)
+class WorkerProcessTest(unittest.TestCase):
+
+    LEASE_TIME = 2.0
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test-workers-')
+        self.src = os.path.join(self.root, 'src')
+        self.out = os.path.join(self.root, 'out')
+        os.mkdir(self.src)
+
+        bindir = os.path.join(self.root, 'bin')
+        os.mkdir(bindir)
+        encoder = os.path.join(bindir, 'opusenc')
+        fd = open(encoder, 'w')
+        fd.write(FAKE_ENCODER)
+        fd.close()
+        os.chmod(encoder, stat.S_IRWXU)
+        self.marker = os.path.join(self.root, 'encoding')
+        self.env = dict(os.environ)
+        self.env['PATH'] = bindir + os.pathsep + self.env['PATH']
+        self.env['FAKE_ENCODER_MARKER'] = self.marker
+        self.workers = []
+
+    def tearDown(self):
+        for proc in self.workers:
+            if proc.poll() == None:
+                proc.send_signal(signal.SIGCONT)
+                proc.kill()
+                proc.wait()
+        if self.server.is_alive():
+            self.server.join(10.0)
+        self.table.close()
+        shutil.rmtree(self.root, True)
+
+    def makeSources(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.src, 'track%02d.wav' % i)
+            w = wave.open(path, 'wb')
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes('\0' * 4 * 4410)
+            w.close()
+            paths.append(path)
+        return paths
+
+    def startCoordinator(self, maxAttempts=3):
+        v = validator.SimulatedValidator()
+        v.setTargets([validator.buildProfile('opus:%s' % self.out)])
+        self.table = validator.JobTable(leaseTime=self.LEASE_TIME, \
+            maxAttempts=maxAttempts)
+        self.coordinator = validator.Coordinator(v, self.table, \
+            ('127.0.0.1', 0))
+        self.server = threading.Thread(target=self.coordinator.serve, \
+            args=([self.src],))
+        self.server.daemon = True
+        self.server.start()
+        deadline = time.time() + 5.0
+        while self.coordinator.address[1] == 0:
+            self.assertTrue(time.time() < deadline, "coordinator not bound")
+            time.sleep(0.01)
+
+    def startWorker(self, delay=0):
+        env = dict(self.env)
+        env['FAKE_ENCODER_DELAY'] = str(delay)
+        url = 'http://127.0.0.1:%d/' % self.coordinator.address[1]
+        proc = subprocess.Popen([sys.executable, \
+            os.path.join(BIN_DIR, 'validate-auto-audio.py'), '-g', \
+            '-t', '1', '-T', 'opus:%s' % self.out, '--worker', url], \
+            env=env)
+        self.workers.append(proc)
+        return proc
+
+    def waitFor(self, condition, what, timeout=20.0):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, "timed out: %s" % what)
+            time.sleep(0.05)
+
+    def getOutput(self, path):
+        return os.path.join(self.out, \
+            os.path.splitext(os.path.basename(path))[0] + '.opus')
+
+    def getLeftovers(self):
+        return [os.path.join(d, n) for (d, dirs, names) in \
+            os.walk(self.root) for n in names if n.endswith('.part')]
+
+    def testWorkerProcesses(self):
+        sources = self.makeSources(6)
+        self.startCoordinator()
+        for i in range(2):
+            self.startWorker()
+        for proc in self.workers:
+            self.waitFor(lambda: proc.poll() != None, "worker exit")
+        self.server.join(10.0)
+
+        for path in sources:
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(self.getOutput(path)))
+        self.assertEqual(self.getLeftovers(), [])
+        self.assertEqual(self.coordinator.summary.count( \
+            validator.OUTCOME_CONVERTED), len(sources))
+
+    def testLostLeaseNotPublished(self):
+        # A lease that expires is given up on rather than reassigned, so
+        # the source stays for the worker that loses it to find
+        sources = self.makeSources(2)
+        self.startCoordinator(maxAttempts=1)
+        worker = self.startWorker(delay=30)
+        self.waitFor(lambda: os.path.exists(self.marker), "encode started")
+
+        # Stop heartbeating until the coordinator gives up on the job
+        worker.send_signal(signal.SIGSTOP)
+        self.waitFor(lambda: self.coordinator.summary.count( \
+            validator.OUTCOME_FAILED) == 1, "lease expiry")
+        worker.send_signal(signal.SIGCONT)
+
+        # Back again, the worker abandons the job and does the other one
+        self.waitFor(lambda: worker.poll() != None, "worker exit", 60.0)
+        self.server.join(10.0)
+
+        kept = [path for path in sources if os.path.exists(path)]
+        self.assertEqual(len(kept), 1)
+        self.assertFalse(os.path.exists(self.getOutput(kept[0])))
+        converted = [path for path in sources if path not in kept]
+        self.assertTrue(os.path.exists(self.getOutput(converted[0])))
+        self.assertEqual(self.getLeftovers(), [])
+        self.assertEqual(self.coordinator.summary.count( \
+            validator.OUTCOME_CONVERTED), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Runs 'process' from resample-mp3.py with a stand-in 'lame' that, like the
+# real one, truncates its output before reading any input, checking that an
+# output hard linked to its source by an earlier pass through is replaced
+# rather than written through.
+
+import os
+import imp
+import shutil
+import stat
+import tempfile
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    os.pardir, 'bin')
+
+try:
+    resampler = imp.load_source('resample_mp3', \
+        os.path.join(BIN_DIR, 'resample-mp3.py'))
+except ImportError, e:
+    # Needs 'mutagen'
+    resampler = None
+    reason = str(e)
+
+FAKE_LAME = """#!/bin/sh
+# Opens (so truncates) the output first, then encodes stdin
+for out in "$@"; do :; done
+: > "$out"
+cat > "$out.in"
+echo encoded >> "$out"
+"""
+
+SOURCE = 'original audio\n'
+
+
+@unittest.skipIf(resampler == None, resampler == None and reason)
+class PassThroughTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test-resample-')
+        bindir = os.path.join(self.root, 'bin')
+        os.mkdir(bindir)
+        lame = os.path.join(bindir, 'lame')
+        fd = open(lame, 'w')
+        fd.write(FAKE_LAME)
+        fd.close()
+        os.chmod(lame, stat.S_IRWXU)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + self.path
+
+        # Tags aren't under test, and the stand-in output isn't an MP3
+        self.copyTags = resampler.copyTags
+        resampler.copyTags = lambda handler, path: None
+
+        self.source = os.path.join(self.root, 'src', 'song.mp3')
+        os.mkdir(os.path.dirname(self.source))
+        fd = open(self.source, 'w')
+        fd.write(SOURCE)
+        fd.close()
+        self.output = os.path.join(self.root, 'out')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        resampler.copyTags = self.copyTags
+        shutil.rmtree(self.root, True)
+
+    def getHandler(self, quality=None):
+        handler = resampler.Mp3AudioFile(self.source)
+        handler.bitrate = ('CBR', 96)
+        handler.quality = quality
+        return handler
+
+    def read(self, path):
+        fd = open(path)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def testLinkThenReencode(self):
+        handler = self.getHandler()
+        self.assertTrue(resampler.process(handler, self.output))
+        self.assertTrue(handler.passedThrough)
+        resamplePath = resampler.getResamplePath(handler, self.output)
+        self.assertEqual(self.read(resamplePath), SOURCE)
+
+        # No longer fits at -V9, so is encoded over the earlier output
+        handler = self.getHandler(len(resampler.VBR_BITRATES) - 1)
+        self.assertTrue(resampler.process(handler, self.output))
+        self.assertFalse(handler.passedThrough)
+
+        self.assertEqual(self.read(self.source), SOURCE)
+        self.assertEqual(self.read(resamplePath), 'encoded\n')
+        partialPath = resampler.getPartialPath(resamplePath)
+        self.assertEqual(self.read(partialPath + '.in'), SOURCE)
+        self.assertFalse(os.path.exists(partialPath))
+        self.assertNotEqual(os.stat(self.source).st_ino, \
+            os.stat(resamplePath).st_ino)
+
+
+if __name__ == '__main__':
+    unittest.main()